@@ -4,47 +4,234 @@ Get arXiv papers
 
 import os
 import json
+import datetime
 import arxiv
 from tqdm import tqdm
-from llm import is_paper_match, translate_abstract
-import re
+from llm import are_papers_match, translate_abstracts_batch
+from utils import get_llm_concurrency, map_concurrently
+from keyword_matcher import KeywordMatcher, get_keyword_matcher
+from history import PaperHistory
+from paper import Paper, dumps
+from metrics import get_run_metrics
+from translation_store import get_translation_store
 
 
-def get_latest_papers(category, max_results=100):
+class FetchWatermarks:
     """
-    Get the latest papers from arXiv
-    :param category: the category of papers
-    :param max_results: the maximum number of papers to get
-    :return: a list of papers
+    Per-category watermarks of the newest submissions fetched so far
+    For each category, the submission time of the newest fetched paper and the ids fetched within the overlap window
+    before it are kept. The overlap window catches papers which show up late in the listing (e.g. held for moderation).
+    The submission time ranges skipped by a fetch which hit its cap before the watermark are kept as `gaps`.
+    """
+
+    def __init__(self, file_path: str, overlap_hours: float = 24):
+        """
+        :param file_path: the JSON file of the watermarks
+        :param overlap_hours: the number of hours before the watermark that are fetched again
+        """
+        self.file_path = file_path
+        self.overlap = datetime.timedelta(hours=overlap_hours)
+        self.watermarks = {}
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                self.watermarks = json.load(f)
+
+    def get(self, category: str):
+        """
+        Get the watermark of a category
+        :param category: the category of papers
+        :return: (the time before which fetching stops or None if never fetched, the ids fetched after that time)
+        """
+        watermark = self.watermarks.get(category)
+        if not watermark:
+            return None, set()
+        since = datetime.datetime.fromisoformat(watermark['published']) - self.overlap
+        return since, set(watermark['seen'])
+
+    def update(self, category: str, fetched: list):
+        """
+        Move the watermark of a category forward
+        :param category: the category of papers
+        :param fetched: a list of (submission time, paper id) of the fetched papers
+        """
+        watermark = self.watermarks.get(category) or {'published': None, 'seen': {}}
+        seen = {paper_id: datetime.datetime.fromisoformat(published) for paper_id, published in watermark['seen'].items()}
+        seen.update({paper_id: published for published, paper_id in fetched})
+        if not seen:
+            return
+        newest = max(seen.values())
+        self.watermarks[category] = {
+            'published': newest.isoformat(),
+            'seen': {paper_id: published.isoformat() for paper_id, published in seen.items() if published >= newest - self.overlap}
+        }
+        if watermark.get('gaps'):
+            self.watermarks[category]['gaps'] = watermark['gaps']
+
+    def record_gap(self, category: str, start: datetime.datetime, end: datetime.datetime):
+        """
+        Record a submission time range of a category which was not fetched (e.g. to backfill it)
+        :param category: the category of papers
+        :param start: the start of the range
+        :param end: the end of the range
+        """
+        if category in self.watermarks:
+            self.watermarks[category].setdefault('gaps', []).append([start.isoformat(), end.isoformat()])
+
+    def save(self):
+        tmp_file = self.file_path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.watermarks, f, indent=4)
+        os.replace(tmp_file, self.file_path)
+
+
+class ArxivClient(arxiv.Client):
+    """
+    arXiv API client recording the pages requested and the politeness delay slept in the run metrics
+    """
+
+    def _parse_feed(self, url: str, first_page: bool = True, _try_index: int = 0):
+        metrics = get_run_metrics()
+        # Mirror the delay enforced by `arxiv.Client` before each request (retries come back through here)
+        if self._last_request_dt is not None:
+            since_last_request = (datetime.datetime.now() - self._last_request_dt).total_seconds()
+            metrics.increment('arxiv_sleep_seconds', max(self.delay_seconds - since_last_request, 0.0))
+        metrics.increment('arxiv_pages')
+        if _try_index:
+            metrics.increment('arxiv_retries')
+        return super()._parse_feed(url, first_page=first_page, _try_index=_try_index)
+
+
+_arxiv_client = None
+
+
+def get_arxiv_client():
+    """
+    Get the shared arXiv API client
+    Sharing a single client keeps the 3-second politeness delay between all requests of a run, and lets a query
+    continue paging without reconnecting.
+    """
+    global _arxiv_client
+    if _arxiv_client is None:
+        _arxiv_client = ArxivClient(page_size=200, delay_seconds=3)
+    return _arxiv_client
+
+
+def get_paper_id(result: arxiv.Result) -> str:
+    """
+    Get the id of a search result without the version number
+    """
+    paper_id = result.get_short_id()
+    version_pos = paper_id.find('v')
+    if version_pos != -1:
+        paper_id = paper_id[:version_pos]
+    return paper_id
+
+
+def paper_from_result(result: arxiv.Result, categories: list) -> Paper:
+    """
+    Make a Paper from a search result
+    :param result: the search result
+    :param categories: the requested categories the paper belongs to
+    """
+    return Paper(
+        title=result.title,
+        id=get_paper_id(result),
+        abstract=result.summary.replace('\n', ' '),  # Remove line breaks
+        url=result.entry_id,
+        published=result.published.date().isoformat(),  # Get the date in ISO format
+        comment=result.comment or '',
+        categories=categories
+    )
+
+
+def iter_latest_papers(category, max_results=100, watermarks=None, max_results_since_watermark=2000):
+    """
+    Get the latest papers from arXiv page by page
+    Each page is yielded as soon as it is downloaded, so later stages can work while the client waits for the
+    politeness delay before the next page.
+    :param category: the category of papers, or a list of categories fetched with a single `cat:A OR cat:B` query
+    :param max_results: the maximum number of papers to get per category (when there is no watermark yet)
+    :param watermarks: the FetchWatermarks, if given only the papers newer than the watermark of the category are
+        fetched (paging until the watermark is crossed) and the watermark is moved forward once all pages are consumed
+        (call `save` to persist it)
+    :param max_results_since_watermark: the maximum number of papers to get when paging until the watermark, the
+        papers between the watermark and the oldest one fetched are then reported and recorded as a gap
+    :return: an iterator of lists of papers, `categories` of each paper lists the requested categories it belongs to
     """
-    client = arxiv.Client(page_size=200, delay_seconds=3)
-    search_query = f'cat:{category}'
+    categories = [category] if isinstance(category, str) else list(category)
+    # A merged query has a watermark of its own, since its results interleave all categories
+    watermark_key = ' OR '.join(categories)
+    since, seen = watermarks.get(watermark_key) if watermarks is not None else (None, set())
+    client = get_arxiv_client()
+    search_query = ' OR '.join(f'cat:{category}' for category in categories)
     search = arxiv.Search(
         query=search_query,
-        max_results=max_results,
+        max_results=max_results * len(categories) if since is None else max_results_since_watermark,
         sort_by=arxiv.SortCriterion.SubmittedDate,
         sort_order=arxiv.SortOrder.Descending,
     )
-    
-    papers = []
+    page_size = getattr(client, 'page_size', 200)
+
+    page = []
+    page_count = 0  # Number of results of the current page, including skipped ones
+    fetched = []
+    category_counts = {category: 0 for category in categories}
+    crossed = False
     for result in client.results(search):
-        # Remove the version number from the id
-        paper_id = result.get_short_id()
-        version_pos = paper_id.find('v')
-        if version_pos != -1:
-            paper_id = paper_id[:version_pos]
-
-        paper = {
-            'title': result.title,
-            'id': paper_id,
-            'abstract': result.summary.replace('\n', ' '),  # Remove line breaks
-            'url': result.entry_id,
-            'published': result.published.date().isoformat(),  # Get the date in ISO format
-            'comment': result.comment
-        }
-        papers.append(paper)
+        # Results are sorted by submission time, stop paging once the watermark is crossed
+        if since is not None and result.published < since:
+            crossed = True
+            break
+        # Without a watermark, stop once every category has `max_results` papers
+        if since is None and len(categories) > 1 and min(category_counts.values()) >= max_results:
+            break
 
-    return papers
+        paper_id = get_paper_id(result)
+        paper_categories = [category for category in categories if category in result.categories] or categories[:1]
+        for paper_category in paper_categories:
+            category_counts[paper_category] += 1
+
+        fetched.append((result.published, paper_id))
+        page_count += 1
+        if paper_id not in seen:
+            page.append(paper_from_result(result, paper_categories))
+
+        # The next result would trigger the download of the next page, hand over the current one first
+        if page_count == page_size:
+            if page:
+                yield page
+            page = []
+            page_count = 0
+
+    if page:
+        yield page
+    if watermarks is not None:
+        watermarks.update(watermark_key, fetched)
+        if since is not None and not crossed and len(fetched) >= max_results_since_watermark:
+            # The watermark moves on regardless, the older papers would never be fetched by the next runs either
+            oldest = min(published for published, _ in fetched)
+            print('Warning: {}: stopped at incremental_max_results ({}) before the watermark, the papers submitted '
+                  'between {} and {} were not fetched (see `python cli.py backfill`)'.format(
+                      watermark_key, max_results_since_watermark, since.isoformat(), oldest.isoformat()))
+            watermarks.record_gap(watermark_key, since, oldest)
+            get_run_metrics().increment('arxiv_watermark_gaps')
+
+
+def get_latest_papers(category, max_results=100, watermarks=None, max_results_since_watermark=2000):
+    """
+    Get the latest papers from arXiv
+    :param category: the category of papers, or a list of categories fetched with a single `cat:A OR cat:B` query
+    :param max_results: the maximum number of papers to get per category (when there is no watermark yet)
+    :param watermarks: the FetchWatermarks, if given only the papers newer than the watermark of the category are
+        fetched (paging until the watermark is crossed) and the watermark is moved forward (call `save` to persist it)
+    :param max_results_since_watermark: the maximum number of papers to get when paging until the watermark
+    :return: a list of papers, `categories` of each paper lists the requested categories it belongs to
+    """
+    return [
+        paper
+        for page in iter_latest_papers(category, max_results, watermarks, max_results_since_watermark)
+        for paper in page
+    ]
 
 
 def deduplicate_papers_across_categories(papers):
@@ -64,42 +251,22 @@ def deduplicate_papers_across_categories(papers):
     return deduplicated_papers
 
 
-def filter_papers_by_keyword(papers, keyword_list):
+def filter_papers_by_keyword(papers, keyword_list, return_matches=False):
     """
     Filter papers by keywords
     :param papers: a list of papers
-    :param keyword_list: a list of keywords
-    :return: a list of filtered papers
+    :param keyword_list: a list of keywords (exclude keywords start with '-'), or a compiled KeywordMatcher
+    :param return_matches: whether to also return the matched include keywords of each filtered paper
+    :return: a list of filtered papers, or a list of (paper, matched keywords) if `return_matches` is True
     """
+    # A paper is kept if any include keyword and no exclude keyword occurs in its title or abstract as a whole word.
+    # All keywords are compiled into a single matcher, so each paper is scanned once.
+    matcher = keyword_list if isinstance(keyword_list, KeywordMatcher) else get_keyword_matcher(keyword_list)
     results = []
-
-    # Below is a less efficient way to filter papers by keywords
-    # keyword_list = [keyword.lower() for keyword in keyword_list]
-    # for paper in papers:
-    #     if any(keyword in paper['abstract'].lower() for keyword in keyword_list):
-    #         results.append(paper)
-    use_keyword_list = []
-    unused_keyword_list = []
-    for keyword in keyword_list:
-        keyword = keyword.lower()
-        if keyword.startswith('-'):
-            unused_keyword_list.append(keyword[1:])
-        else:
-            use_keyword_list.append(keyword)
-
     for paper in papers:
-        title_lower = paper['title'].lower()
-        abstract_lower = paper['abstract'].lower()
-
-        paper_text = title_lower + ' ' + abstract_lower
-        # Check if any of the use_keywords (as continuous phrases) are in the abstract
-        # Check if any of the use_keywords (as whole words) are in the abstract
-        has_use_keyword = any(re.search(r'\b' + re.escape(keyword) + r'\b', paper_text, re.IGNORECASE) for keyword in use_keyword_list)
-        # Check if any of the unused_keywords (as whole words) are in the abstract
-        has_unused_keyword = any(re.search(r'\b' + re.escape(keyword) + r'\b', paper_text, re.IGNORECASE) for keyword in unused_keyword_list)
-        
-        if has_use_keyword and not has_unused_keyword:
-            results.append(paper)
+        include, exclude = matcher.find_in_paper(paper)
+        if include and not exclude:
+            results.append((paper, include) if return_matches else paper)
     return results
 
 
@@ -111,20 +278,32 @@ def filter_papers_using_llm(papers, paper_to_hunt, config: dict):
     :param config: the configuration of LLM Server
     :return: a list of filtered papers
     """
-    results = []
-    for paper in papers:
-        if is_paper_match(paper, paper_to_hunt, config):
-            results.append(paper)
-    return results
+    # Papers are checked concurrently (see `llm_max_concurrency` in config.yaml), `llm_filter_batch_size` papers
+    # per request, the results keep the input order. `llm_requests_per_minute` is applied by the shared LLM client.
+    max_concurrency, _ = get_llm_concurrency(config)
+    batch_size = max(int(config.get('llm_filter_batch_size') or 1), 1)
+    batches = [papers[i:i + batch_size] for i in range(0, len(papers), batch_size)]
+    batch_matches = map_concurrently(
+        lambda batch: are_papers_match(batch, paper_to_hunt, config),
+        batches,
+        max_concurrency=max_concurrency
+    )
+    matches = [match for batch in batch_matches for match in batch]
+    return [paper for paper, match in zip(papers, matches) if match]
 
 
-def deduplicate_papers(papers, file_path):
+def deduplicate_papers(papers, history):
     """
     Deduplicate papers according to the previous records
     :param papers: a list of papers
-    :param file_path: the file path of the previous records
+    :param history: the PaperHistory of the previous records, or the file path of the legacy `papers.json`
     :return: the deduplicated papers
     """
+    if isinstance(history, PaperHistory):
+        # Only the compact index of seen ids is loaded, not the records
+        seen_ids = history.seen_ids
+        return [d for d in papers if d['id'] not in seen_ids]
+    file_path = history
     if os.path.exists(file_path):
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
@@ -141,6 +320,7 @@ def deduplicate_papers(papers, file_path):
 def prepend_to_json_file(file_path, data):
     """
     Prepend data to a JSON file
+    **Note**: Rewrites the whole file, `history.PaperHistory` is used for the paper history instead
     :param file_path: the file path
     :param data: the data to prepend
     """
@@ -155,34 +335,58 @@ def prepend_to_json_file(file_path, data):
         content = []
 
     with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data + content, f, indent=4, ensure_ascii=False)
+        f.write(dumps(data + content, indent=True))
 
 
-def translate_abstracts(papers: list, config: dict):
+def translate_abstracts(papers: list, config: dict, progress=True, max_concurrency=None):
     """
     Translate the abstracts using the specified translation service
+    The translations stored for the same paper id and abstract are reused, the other abstracts are packed
+    `llm_translate_batch_size` per LLM request and the new translations are stored as soon as each request is done.
     :param papers: a list of papers
     :param config: the configuration of LLM Server
+    :param progress: whether to show a progress bar
+    :param max_concurrency: the maximum number of requests in flight (default: `llm_max_concurrency`)
     :return: the translated papers
     """
-    for paper in tqdm(papers, desc='Translating Abstracts'):
-        abstract = paper["abstract"]
-        zh_abstract = translate_abstract(abstract, config)
-        paper["zh_abstract"] = None
-        if zh_abstract:
-            paper["zh_abstract"] = zh_abstract
+    store = get_translation_store(config)
+    stored = store.lookup(papers) if store is not None else {}
+    remaining = []
+    for paper in papers:
+        paper["zh_abstract"] = stored.get(paper["id"])
+        if paper["id"] not in stored:
+            remaining.append(paper)
+    batch_size = max(int(config.get('llm_translate_batch_size') or 1), 1)
+    batches = [remaining[start:start + batch_size] for start in range(0, len(remaining), batch_size)]
+    if max_concurrency is None:
+        max_concurrency, _ = get_llm_concurrency(config)
+
+    with tqdm(total=len(remaining), desc='Translating Abstracts', disable=not progress) as progress_bar:
+        def translate_batch(batch):
+            zh_abstracts = translate_abstracts_batch([paper["abstract"] for paper in batch], config)
+            for paper, zh_abstract in zip(batch, zh_abstracts):
+                paper["zh_abstract"] = zh_abstract or None
+            if store is not None:
+                store.save(batch)
+            progress_bar.update(len(batch))
+
+        map_concurrently(translate_batch, batches, max_concurrency=max_concurrency)
+
+    metrics = get_run_metrics()
+    metrics.increment('translations_reused', len(stored))
+    metrics.increment('translations_requested', len(remaining))
     return papers
 
 
 if __name__ == '__main__':
     papers = get_latest_papers('cs.CL', max_results=50)
-    print(json.dumps(papers, indent=4))
+    print(dumps(papers, indent=True))
     print()
     keyword_list = ['safety', 'security', 'adversarial', 'jailbreak', 'backdoor', 'hallucination', 'victim']
     results = filter_papers_by_keyword(papers, keyword_list)
-    print(json.dumps(results, indent=4))
+    print(dumps(results, indent=True))
     print()
     results = deduplicate_papers(results, 'papers.json')
-    print(json.dumps(results, indent=4))
+    print(dumps(results, indent=True))
     print()
     prepend_to_json_file('papers.json', results)
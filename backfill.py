@@ -0,0 +1,289 @@
+"""
+Backfill: Seed the History from a Date Range
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import arxiv
+
+from arxiv_paper import ArxivClient, paper_from_result
+from checkpoint import get_run_lock
+from history import get_history_dir, get_paper_history
+from history_index import get_history_index
+from metrics import get_run_metrics
+from pipeline import run_pipeline
+from settings import load_paper_to_hunt
+
+
+class ArxivScheduler:
+    """
+    Politeness schedule shared by the arXiv clients of the backfill workers
+    Requests go one at a time, each starting at least `delay_seconds` after the previous one ended, as the arXiv API
+    terms of use ask. Retries of a request (see `arxiv.Client.num_retries`) keep the slot.
+    """
+
+    def __init__(self, delay_seconds: float = 3):
+        self.delay_seconds = delay_seconds
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._last_end = None
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            depth = getattr(self._local, 'depth', 0)
+            self._local.depth = depth + 1
+            try:
+                if depth == 0 and self._last_end is not None:
+                    delay = self._last_end + self.delay_seconds - time.monotonic()
+                    if delay > 0:
+                        get_run_metrics().increment('arxiv_sleep_seconds', delay)
+                        time.sleep(delay)
+                yield
+            finally:
+                self._local.depth = depth
+                self._last_end = time.monotonic()
+
+
+class ScheduledArxivClient(ArxivClient):
+    """
+    arXiv API client whose requests are spaced by a shared ArxivScheduler
+    """
+
+    def __init__(self, scheduler: ArxivScheduler, page_size=2000):
+        # The scheduler enforces the delay between the requests of every client
+        super().__init__(page_size=page_size, delay_seconds=scheduler.delay_seconds)
+        self.scheduler = scheduler
+
+    def _parse_feed(self, url: str, first_page: bool = True, _try_index: int = 0):
+        with self.scheduler.slot():
+            return super()._parse_feed(url, first_page=first_page, _try_index=_try_index)
+
+
+def date_windows(since: datetime.date, until: datetime.date, window_days=7) -> list:
+    """
+    Split a date range into windows
+    :param since: the first date
+    :param until: the last date (included)
+    :param window_days: the number of days per window
+    :return: a list of (first date, last date), oldest first
+    """
+    windows = []
+    start = since
+    while start <= until:
+        end = min(start + datetime.timedelta(days=max(int(window_days), 1) - 1), until)
+        windows.append((start, end))
+        start = end + datetime.timedelta(days=1)
+    return windows
+
+
+def window_query(category: str, start: datetime.date, end: datetime.date) -> str:
+    """
+    Get the search query of the papers of a category submitted within a window (dates in GMT, both included)
+    """
+    return 'cat:{} AND submittedDate:[{:%Y%m%d}0000 TO {:%Y%m%d}2359]'.format(category, start, end)
+
+
+def fetch_window(client: arxiv.Client, category: str, start: datetime.date, end: datetime.date, max_results=10000) -> list:
+    """
+    Fetch the papers of a category submitted within a window, oldest first
+    :return: a list of Papers (at most `max_results`)
+    """
+    search = arxiv.Search(
+        query=window_query(category, start, end),
+        max_results=max_results,
+        sort_by=arxiv.SortCriterion.SubmittedDate,
+        sort_order=arxiv.SortOrder.Ascending,
+    )
+    return [paper_from_result(result, [category]) for result in client.results(search)]
+
+
+class BackfillState:
+    """
+    Record of the windows finished by a backfill, so that an interrupted backfill resumes without fetching them again
+    A window is finished once its papers are recorded in the history. A window with more papers than a query returns
+    is split in halves, the split is recorded as well. A single day with more papers than a query returns cannot be
+    split: its first papers are recorded and the day is recorded as truncated (not finished), so that it can be fetched
+    again with a higher `backfill_max_results_per_window`.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.windows = {}
+        self.splits = set()
+        self.truncated = {}
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.windows = state.get('windows', {})
+            self.splits = set(state.get('splits', []))
+            self.truncated = state.get('truncated', {})
+
+    @staticmethod
+    def key(category: str, start: datetime.date, end: datetime.date) -> str:
+        return '{}|{}|{}'.format(category, start.isoformat(), end.isoformat())
+
+    def is_done(self, category, start, end) -> bool:
+        return self.key(category, start, end) in self.windows
+
+    def is_split(self, category, start, end) -> bool:
+        return self.key(category, start, end) in self.splits
+
+    def mark_done(self, category, start, end, fetched: int, kept: int):
+        self.windows[self.key(category, start, end)] = {
+            'fetched': fetched, 'kept': kept, 'finished_at': datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        }
+        self.save()
+
+    def is_truncated(self, category, start, end, max_results: int) -> bool:
+        """
+        Whether the window was recorded as truncated with (at least) this maximum number of results
+        """
+        record = self.truncated.get(self.key(category, start, end))
+        return record is not None and record['max_results'] >= max_results
+
+    def mark_truncated(self, category, start, end, fetched: int, kept: int, max_results: int):
+        self.truncated[self.key(category, start, end)] = {
+            'fetched': fetched, 'kept': kept, 'max_results': max_results,
+            'finished_at': datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        }
+        self.save()
+
+    def mark_split(self, category, start, end):
+        self.splits.add(self.key(category, start, end))
+        self.save()
+
+    def save(self):
+        tmp_file = self.file_path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'windows': self.windows, 'splits': sorted(self.splits), 'truncated': self.truncated}, f, indent=4)
+        os.replace(tmp_file, self.file_path)
+
+
+def get_backfill_state(config: dict) -> BackfillState:
+    """
+    Get the backfill state of the history described by the configuration (`<history_dir>/backfill.json`)
+    """
+    return BackfillState(os.path.join(get_history_dir(config), 'backfill.json'))
+
+
+def _split_window(start: datetime.date, end: datetime.date) -> list:
+    middle = start + (end - start) // 2
+    return [(start, middle), (middle + datetime.timedelta(days=1), end)]
+
+
+def run_backfill(config: dict, since: datetime.date, until: datetime.date, category_list=None, window_days=None,
+                 workers=None, use_llm_for_filtering=None, use_llm_for_translation=None, scheduler=None) -> dict:
+    """
+    Fetch the papers submitted within a date range and record the ones passing the filters in the history
+    The range is split into windows of `backfill_window_days` per category, fetched by `backfill_fetch_workers`
+    workers sharing the arXiv politeness delay. Each fetched window runs through the usual deduplication, keyword and
+    LLM filters (and translation) while the next windows are being fetched, then its papers are appended to the
+    history and the window is recorded as finished. A window failing to fetch is left pending for the next backfill.
+    Nothing is posted to Lark.
+    :param config: the configuration
+    :param since: the first submission date
+    :param until: the last submission date (included)
+    :param category_list: the categories (default: `category_list`)
+    :param window_days: the number of days per window (default: `backfill_window_days`)
+    :param workers: the number of windows fetched at the same time (default: `backfill_fetch_workers`)
+    :param use_llm_for_filtering: whether to filter by LLM (default: `use_llm_for_filtering`)
+    :param use_llm_for_translation: whether to translate the abstracts (default: `use_llm_for_translation`)
+    :param scheduler: the ArxivScheduler (default: a new one with the 3-second delay)
+    :return: the counters of the backfill
+    """
+    category_list = category_list or config['category_list']
+    window_days = window_days or config.get('backfill_window_days', 7)
+    workers = max(int(workers or config.get('backfill_fetch_workers', 2)), 1)
+    max_results = int(config.get('backfill_max_results_per_window', 10000))
+    if use_llm_for_filtering is None:
+        use_llm_for_filtering = config['use_llm_for_filtering']
+    if use_llm_for_translation is None:
+        use_llm_for_translation = config['use_llm_for_translation']
+    paper_to_hunt = load_paper_to_hunt(config) if use_llm_for_filtering else None
+    scheduler = scheduler or ArxivScheduler()
+
+    lock = get_run_lock(config)
+    if not lock.acquire():
+        raise RuntimeError('Another run is in progress')
+    try:
+        history = get_paper_history(config)
+        index = get_history_index(config)
+        state = get_backfill_state(config)
+        clients = threading.local()
+
+        def fetch(category, start, end):
+            if getattr(clients, 'client', None) is None:
+                clients.client = ScheduledArxivClient(scheduler)
+            return fetch_window(clients.client, category, start, end, max_results)
+
+        def expand(category, start, end):
+            if state.is_split(category, start, end):
+                return [window for half in _split_window(start, end) for window in expand(category, *half)]
+            if state.is_done(category, start, end) or state.is_truncated(category, start, end, max_results):
+                return []
+            return [(category, start, end)]
+
+        pending = [window for category in category_list for start, end in date_windows(since, until, window_days)
+                   for window in expand(category, start, end)]
+        stats = {'windows': len(pending), 'fetched': 0, 'kept': 0, 'truncated': 0, 'failed': 0}
+        print('Backfill {} to {}: {} windows to fetch'.format(since, until, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, *window): window for window in pending[:workers]}
+            pending = pending[workers:]
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    category, start, end = futures.pop(future)
+                    try:
+                        papers = future.result()
+                    except Exception as e:
+                        # Left pending, fetched again by the next backfill
+                        print('Window {} {} to {} failed: {}'.format(category, start, end, e))
+                        stats['failed'] += 1
+                        continue
+                    capped = len(papers) >= max_results
+                    if capped and start < end:
+                        # The query is capped, fetch the halves of the window instead
+                        print('Window {} {} to {} has more than {} papers, splitting it'.format(category, start, end, max_results))
+                        state.mark_split(category, start, end)
+                        pending = [(category, *half) for half in _split_window(start, end)] + pending
+                        stats['windows'] += 1
+                        continue
+                    # Filtered (by LLM) here while the other windows are being fetched
+                    kept, _ = run_pipeline(
+                        [papers], config, seen_ids=history.seen_ids, paper_to_hunt=paper_to_hunt,
+                        keyword_list=config['keyword_list'], use_llm_for_filtering=use_llm_for_filtering,
+                        use_llm_for_translation=use_llm_for_translation
+                    )
+                    with get_run_metrics().stage('history'):
+                        # Newest first, as recorded by the daily runs
+                        history.append(kept[::-1], date=start)
+                        if index is not None:
+                            index.sync(history, tag=config.get('tag'), recorded=start.isoformat())
+                    if capped:
+                        # A single day cannot be split, the papers past the first `max_results` are missing
+                        print('Warning: window {} {} has more than {} papers, only the first {} are recorded '
+                              '(raise backfill_max_results_per_window to fetch it again)'.format(category, start, max_results, max_results))
+                        state.mark_truncated(category, start, end, len(papers), len(kept), max_results)
+                        stats['truncated'] += 1
+                    else:
+                        state.mark_done(category, start, end, len(papers), len(kept))
+                    stats['fetched'] += len(papers)
+                    stats['kept'] += len(kept)
+                    print('Window {} {} to {}: {} papers fetched, {} kept'.format(category, start, end, len(papers), len(kept)))
+                while pending and len(futures) < workers:
+                    window = pending.pop(0)
+                    futures[executor.submit(fetch, *window)] = window
+        if stats['failed']:
+            print('Backfill: {} windows failed, run the same command again to fetch them'.format(stats['failed']))
+        print('Backfill finished: {} papers fetched, {} recorded'.format(stats['fetched'], stats['kept']))
+        return stats
+    finally:
+        lock.release()
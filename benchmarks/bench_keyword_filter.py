@@ -0,0 +1,101 @@
+"""
+Micro-benchmark of `filter_papers_by_keyword` against the previous per-keyword regex implementation
+
+Usage:
+    python -m benchmarks.bench_keyword_filter [--papers 10000]
+"""
+
+import re
+import time
+import random
+import argparse
+
+from arxiv_paper import filter_papers_by_keyword
+from keyword_matcher import KeywordMatcher
+
+KEYWORD_LIST = [
+    'agent', 'RL', 'Reinforcement learning', 'agentic', 'safety', 'security', 'jailbreak', 'backdoor',
+    '-Embodied', '-Histopathology', '-Vehicle', '-UAV', '-Protein', '-Traffic', '-biomedical', '-clinical',
+    '-image generation', '-Video', '-Music', '-Autonomous Driving'
+]
+
+VOCABULARY = (
+    'we propose a novel method for large language models that improves reasoning on benchmark tasks with '
+    'transformer architecture attention retrieval augmented generation diffusion training data evaluation '
+    'results show significant gains over strong baselines in accuracy efficiency and robustness across '
+    'multiple datasets including vision language multimodal tasks graph neural networks optimization'
+).split()
+
+
+def filter_papers_by_keyword_reference(papers, keyword_list):
+    """
+    The previous implementation: one `re.search` per keyword and paper
+    """
+    results = []
+    use_keyword_list = []
+    unused_keyword_list = []
+    for keyword in keyword_list:
+        keyword = keyword.lower()
+        if keyword.startswith('-'):
+            unused_keyword_list.append(keyword[1:])
+        else:
+            use_keyword_list.append(keyword)
+
+    for paper in papers:
+        paper_text = paper['title'].lower() + ' ' + paper['abstract'].lower()
+        has_use_keyword = any(re.search(r'\b' + re.escape(keyword) + r'\b', paper_text, re.IGNORECASE) for keyword in use_keyword_list)
+        has_unused_keyword = any(re.search(r'\b' + re.escape(keyword) + r'\b', paper_text, re.IGNORECASE) for keyword in unused_keyword_list)
+        if has_use_keyword and not has_unused_keyword:
+            results.append(paper)
+    return results
+
+
+def make_synthetic_papers(count, seed=0):
+    """
+    Make synthetic papers with ~150-word abstracts, some of them containing the keywords
+    """
+    rng = random.Random(seed)
+    keywords = [keyword.lstrip('-') for keyword in KEYWORD_LIST]
+    papers = []
+    for i in range(count):
+        words = [rng.choice(VOCABULARY) for _ in range(150)]
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        papers.append({
+            'title': ' '.join(rng.choice(VOCABULARY) for _ in range(10)).title(),
+            'id': '2501.{:05d}'.format(i),
+            'abstract': ' '.join(words) + '.',
+        })
+    return papers
+
+
+def bench(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark keyword filtering')
+    parser.add_argument('--papers', type=int, default=10000, help='number of synthetic papers')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repetitions (best time is reported)')
+    args = parser.parse_args()
+
+    papers = make_synthetic_papers(args.papers)
+    reference_time, expected = bench(lambda: filter_papers_by_keyword_reference(papers, KEYWORD_LIST), args.repeat)
+    matcher = KeywordMatcher(KEYWORD_LIST)
+    matcher_time, results = bench(lambda: filter_papers_by_keyword(papers, matcher), args.repeat)
+    assert results == expected, 'Compiled matcher disagrees with the reference implementation'
+
+    print('Papers: {}, keywords: {}, kept: {}'.format(len(papers), len(KEYWORD_LIST), len(results)))
+    print('Per-keyword regex : {:8.1f} ms ({:6.1f} us/paper)'.format(reference_time * 1e3, reference_time / len(papers) * 1e6))
+    print('Compiled matcher  : {:8.1f} ms ({:6.1f} us/paper)'.format(matcher_time * 1e3, matcher_time / len(papers) * 1e6))
+    print('Speedup           : {:8.1f}x'.format(reference_time / matcher_time))
+
+
+if __name__ == '__main__':
+    main()
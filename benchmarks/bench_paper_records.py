@@ -0,0 +1,71 @@
+"""
+Benchmark of the paper records: plain dicts with the standard `json` module vs `Paper` with `paper.dumps`/`paper.loads`
+
+Usage:
+    python -m benchmarks.bench_paper_records [--papers 100000]
+"""
+
+import gc
+import json
+import time
+import argparse
+import tracemalloc
+
+import paper as paper_json
+from paper import Paper
+
+
+def make_records(count):
+    """
+    Make history records shaped like the ones written by `PaperHistory.append`
+    """
+    return [
+        {
+            'title': 'Title of paper {}'.format(i),
+            'id': '25{:02d}.{:05d}'.format(i // 30000 % 12 + 1, i % 30000),
+            'abstract': 'word ' * 200,
+            'url': 'http://arxiv.org/abs/2501.{:05d}v1'.format(i % 30000),
+            'published': '2025-01-01',
+            'comment': '10 pages',
+            'categories': ['cs.CL'],
+            'zh_abstract': '中文摘要' * 50,
+        }
+        for i in range(count)
+    ]
+
+
+def measure(label, dump, parse, lines):
+    """
+    Time the serialization of the records and the parsing of the lines, and measure the memory held by the parsed records
+    """
+    start = time.perf_counter()
+    parsed = [parse(line) for line in lines]
+    parse_time = time.perf_counter() - start
+    del parsed
+    gc.collect()
+
+    tracemalloc.start()
+    parsed = [parse(line) for line in lines]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    text = ''.join(dump(record) + '\n' for record in parsed)
+    dump_time = time.perf_counter() - start
+    print('{:<28} parse {:8.1f} ms   serialize {:8.1f} ms   memory {:7.1f} MB ({:.0f} bytes/paper, {:.0f} MB of JSON)'.format(
+        label, parse_time * 1e3, dump_time * 1e3, memory / 1e6, memory / len(lines), len(text.encode('utf-8')) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the paper records')
+    parser.add_argument('--papers', type=int, default=100000, help='number of papers in the history')
+    args = parser.parse_args()
+
+    lines = [json.dumps(record, ensure_ascii=False) for record in make_records(args.papers)]
+    print('{} papers, backend: {}'.format(args.papers, 'orjson' if paper_json.orjson else 'msgspec' if paper_json.msgspec else 'json'))
+    measure('dict + json', lambda record: json.dumps(record, ensure_ascii=False), json.loads, lines)
+    measure('Paper + paper.dumps/loads', paper_json.dumps, lambda line: Paper.from_dict(paper_json.loads(line)), lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Offline end-to-end benchmark of the pipeline against local stand-ins of arXiv, the LLM server and Lark
+
+Each stage function and `main.run_task` are driven against the stand-ins in `benchmarks/stand_ins.py` at several
+corpus sizes. The per-stage wall time, throughput and latency are printed and stored in `benchmarks/results/`,
+and compared with a previous result file to spot regressions.
+
+Usage:
+    python -m benchmarks.bench_pipeline [--sizes 100 1000 10000] [--llm-latency 0.05] [--compare latest]
+"""
+
+import os
+import io
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import contextlib
+import subprocess
+
+import arxiv_paper
+import lark_post
+from arxiv_paper import get_latest_papers, filter_papers_by_keyword, filter_papers_using_llm, translate_abstracts
+from history import PaperHistory
+from lark_post import post_to_lark_webhook
+from metrics import get_run_metrics
+from llm import is_paper_match
+from utils import RateLimiter, map_concurrently
+from benchmarks.bench_keyword_filter import KEYWORD_LIST
+from benchmarks.stand_ins import ArxivFeedServer, ChatCompletionsServer, LarkWebhookSink
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+CATEGORIES = ['cs.CL', 'cs.AI', 'cs.CV']
+PAPER_TO_HUNT = 'LLM agents trained with reinforcement learning, and the safety and security of such agents.'
+
+
+def make_config(llm_url: str, lark_url: str, directory: str, args) -> dict:
+    return {
+        'webhook_url': lark_url,
+        'template_id': 'benchmark',
+        'template_version_name': '1.0.0',
+        'lark_outbox_dir': os.path.join(directory, 'outbox'),
+        'tag': 'Benchmark',
+        'category_list': CATEGORIES,
+        'keyword_list': KEYWORD_LIST,
+        'merged_category_query': True,
+        'incremental_fetch': False,
+        'history_dir': os.path.join(directory, 'history'),
+        'model': 'stand-in',
+        'base_url': llm_url,
+        'api_key': 'benchmark',
+        'llm_max_concurrency': args.llm_concurrency,
+        'llm_requests_per_minute': 0,
+        'llm_backoff_seconds': 0.05,
+        'llm_max_retries': 5,
+        'llm_cache_enabled': False,
+        'use_llm_for_filtering': True,
+        'llm_filter_batch_size': args.batch_size,
+        'use_relevance_prefilter': False,
+        'use_llm_for_translation': True,
+        'llm_translate_batch_size': args.translate_batch_size,
+    }
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool):
+    """
+    Silence the progress output of the stages
+    """
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def measure(name: str, func, items_in: int, verbose: bool):
+    """
+    Run a stage once and record its wall time, throughput and latency per item
+    """
+    with quiet(not verbose):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+    record = {
+        'stage': name,
+        'items_in': items_in,
+        'items_out': len(result) if isinstance(result, list) else None,
+        'seconds': elapsed,
+        'items_per_second': items_in / elapsed if elapsed > 0 else None,
+        'ms_per_item': elapsed * 1000 / items_in if items_in else None,
+    }
+    return record, result
+
+
+def run_size(size: int, args) -> list:
+    """
+    Run every stage and the whole task on a corpus of `size` papers
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as directory, \
+            ArxivFeedServer(size, categories=CATEGORIES, page_latency=args.arxiv_latency, page_size=args.arxiv_page_size) as feed, \
+            ChatCompletionsServer(latency=args.llm_latency, max_concurrency=args.llm_server_concurrency, error_rate=args.llm_error_rate,
+                                  token_latency=args.llm_token_latency, reasoning_tokens=args.llm_reasoning_tokens,
+                                  explanation_tokens=args.llm_explanation_tokens) as llm_server, \
+            LarkWebhookSink(latency=args.lark_latency) as lark_sink:
+        config = make_config(llm_server.url + '/v1/chat/completions', lark_sink.url + '/webhook', directory, args)
+        client = arxiv_paper.ArxivClient(page_size=args.arxiv_page_size, delay_seconds=0)
+        client.query_url_format = feed.query_url_format
+        arxiv_paper._arxiv_client = client
+        # Lark's 100 requests per minute would dominate the timings, the limiter itself is not under test
+        lark_post._lark_limiter = RateLimiter(args.lark_requests_per_minute, burst=lark_post.LARK_BURST)
+
+        record, papers = measure('fetch', lambda: get_latest_papers(CATEGORIES, max_results=size), size, args.verbose)
+        records.append(record)
+        record, papers = measure('keyword_filter', lambda: filter_papers_by_keyword(papers, KEYWORD_LIST), len(papers), args.verbose)
+        records.append(record)
+        record, _ = measure('llm_classify', lambda: map_concurrently(
+            lambda paper: is_paper_match(paper, PAPER_TO_HUNT, config), papers, max_concurrency=args.llm_concurrency
+        ), len(papers), args.verbose)
+        record['llm_requests'] = llm_server.requests
+        records.append(record)
+        record_requests = llm_server.requests
+        record, papers = measure('llm_filter', lambda: filter_papers_using_llm(papers, PAPER_TO_HUNT, config), len(papers), args.verbose)
+        record['llm_requests'] = llm_server.requests - record_requests
+        records.append(record)
+        requests_before = llm_server.requests
+        record, _ = measure('translate', lambda: translate_abstracts(papers, config, progress=False), len(papers), args.verbose)
+        record['llm_requests'] = llm_server.requests - requests_before
+        records.append(record)
+        record, _ = measure('lark_post', lambda: post_to_lark_webhook('Benchmark', papers, config), len(papers), args.verbose)
+        record['lark_requests'] = lark_sink.requests
+        records.append(record)
+
+        import main
+        llm_requests, lark_requests = llm_server.requests, lark_sink.requests
+        config['max_results'] = size
+        history = PaperHistory(config['history_dir'])
+        record, _ = measure('run_task', lambda: main.run_task(config, PAPER_TO_HUNT, history), size, args.verbose)
+        record['llm_requests'] = llm_server.requests - llm_requests
+        record['lark_requests'] = lark_sink.requests - lark_requests
+        record['run_report'] = get_run_metrics().report()
+        records.append(record)
+
+        for record in records:
+            record['papers'] = size
+        records.append({
+            'stage': 'stand_ins', 'papers': size, 'arxiv_requests': feed.requests, 'llm_requests': llm_server.requests,
+            'llm_throttled': llm_server.throttled, 'llm_max_in_flight': llm_server.max_in_flight,
+            'llm_generated_tokens': llm_server.generated_tokens, 'llm_cancelled': llm_server.cancelled,
+            'lark_requests': lark_sink.requests, 'lark_bytes': lark_sink.bytes,
+        })
+    arxiv_paper._arxiv_client = None
+    return records
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def find_baseline(compare: str):
+    if compare != 'latest':
+        return compare
+    files = sorted(glob.glob(os.path.join(RESULTS_DIR, '*.json')))
+    return files[-1] if files else None
+
+
+def print_report(records: list, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(record['papers'], record['stage']): record for record in baseline['records']}
+    print('{:>7} {:<15} {:>9} {:>10} {:>12} {:>11}{}'.format(
+        'papers', 'stage', 'items', 'seconds', 'items/s', 'ms/item', '  vs baseline' if baseline else ''))
+    for record in records:
+        if 'seconds' not in record:
+            continue
+        line = '{:>7} {:<15} {:>9} {:>10.3f} {:>12.1f} {:>11.3f}'.format(
+            record['papers'], record['stage'], record['items_in'], record['seconds'],
+            record['items_per_second'] or 0, record['ms_per_item'] or 0)
+        old = previous.get((record['papers'], record['stage']))
+        if old and old.get('seconds'):
+            ratio = record['seconds'] / old['seconds']
+            line += '  {:>6.2f}x{}'.format(ratio, '  REGRESSION' if ratio > 1.2 else '')
+        print(line)
+    for record in records:
+        if record['stage'] == 'stand_ins':
+            print('{papers:>7} stand-ins: {arxiv_requests} arXiv pages, {llm_requests} LLM requests '
+                  '({llm_throttled} throttled, {llm_max_in_flight} max in flight, {llm_generated_tokens} tokens generated, '
+                  '{llm_cancelled} streams closed early), {lark_requests} Lark messages '
+                  '({lark_bytes} bytes)'.format(**record))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='corpus sizes')
+    parser.add_argument('--arxiv-latency', type=float, default=0.05, help='latency of each arXiv page in seconds')
+    parser.add_argument('--arxiv-page-size', type=int, default=200, help='papers per arXiv page')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='latency of each LLM response in seconds')
+    parser.add_argument('--llm-token-latency', type=float, default=0.002, help='latency of each generated token in seconds')
+    parser.add_argument('--llm-reasoning-tokens', type=int, default=200, help='length of the <think> block before each Yes/No')
+    parser.add_argument('--llm-explanation-tokens', type=int, default=50, help='length of the explanation after each Yes/No')
+    parser.add_argument('--llm-server-concurrency', type=int, default=16, help='requests served at once before 429 (0 for unlimited)')
+    parser.add_argument('--llm-error-rate', type=float, default=0.01, help='probability of an injected 429')
+    parser.add_argument('--llm-concurrency', type=int, default=8, help='llm_max_concurrency of the client')
+    parser.add_argument('--batch-size', type=int, default=8, help='llm_filter_batch_size')
+    parser.add_argument('--translate-batch-size', type=int, default=4, help='llm_translate_batch_size')
+    parser.add_argument('--lark-latency', type=float, default=0.01, help='latency of each Lark response in seconds')
+    parser.add_argument('--lark-requests-per-minute', type=int, default=0, help='Lark rate limit (0 for unlimited)')
+    parser.add_argument('--compare', default=None, help='result file to compare with, or "latest"')
+    parser.add_argument('--no-save', action='store_true', help='do not store the results')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the stages')
+    args = parser.parse_args()
+
+    baseline_file = find_baseline(args.compare) if args.compare else None
+    baseline = None
+    if baseline_file:
+        with open(baseline_file, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('Comparing with {}'.format(baseline_file))
+
+    records = []
+    for size in args.sizes:
+        print('Running {} papers...'.format(size), file=sys.stderr)
+        records.extend(run_size(size, args))
+    print_report(records, baseline)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        result = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'arguments': vars(args),
+            'records': records,
+        }
+        file_path = os.path.join(RESULTS_DIR, '{:%Y%m%d-%H%M%S}.json'.format(datetime.datetime.now()))
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print('Results saved to {}'.format(file_path))
+
+
+if __name__ == '__main__':
+    main()
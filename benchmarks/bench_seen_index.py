@@ -0,0 +1,74 @@
+"""
+Benchmark of the seen-id index used by `deduplicate_papers`
+
+Usage:
+    python -m benchmarks.bench_seen_index [--ids 1000000] [--legacy-papers 50000]
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from history import SeenIdIndex
+
+
+def make_arxiv_ids(count, seed=0):
+    """
+    Make unique new-style arXiv ids spread over the last years
+    """
+    rng = random.Random(seed)
+    ids = set()
+    while len(ids) < count:
+        ids.add('{:02d}{:02d}.{:05d}'.format(rng.randint(15, 25), rng.randint(1, 12), rng.randint(1, 29999)))
+    return sorted(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the seen-id index')
+    parser.add_argument('--ids', type=int, default=1000000, help='number of historical ids')
+    parser.add_argument('--lookups', type=int, default=270, help='number of ids to deduplicate (one daily run)')
+    parser.add_argument('--legacy-papers', type=int, default=50000, help='size of the legacy papers.json to compare with (0 to skip)')
+    args = parser.parse_args()
+
+    ids = make_arxiv_ids(args.ids)
+    queries = random.Random(1).sample(ids, args.lookups // 2) + make_arxiv_ids(args.lookups - args.lookups // 2, seed=2)
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        SeenIdIndex(directory).rebuild(ids, history_size=0)
+        build_time = time.perf_counter() - start
+        index_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        start = time.perf_counter()
+        index = SeenIdIndex(directory)
+        assert index.load(history_size=0)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        seen = sum(query in index for query in queries)
+        lookup_time = time.perf_counter() - start
+        assert seen >= args.lookups // 2
+
+        print('Historical ids: {}, index size: {:.1f} MB ({:.1f} bytes/id)'.format(len(ids), index_bytes / 1e6, index_bytes / len(ids)))
+        print('Build (one-time) : {:8.1f} ms'.format(build_time * 1e3))
+        print('Load             : {:8.1f} ms'.format(load_time * 1e3))
+        print('{} lookups      : {:8.3f} ms ({:.2f} us/lookup)'.format(len(queries), lookup_time * 1e3, lookup_time / len(queries) * 1e6))
+
+        if args.legacy_papers:
+            legacy_file = os.path.join(directory, 'papers.json')
+            abstract = 'word ' * 200
+            with open(legacy_file, 'w', encoding='utf-8') as f:
+                json.dump([{'title': 'Title', 'id': paper_id, 'abstract': abstract, 'zh_abstract': abstract} for paper_id in ids[:args.legacy_papers]], f, indent=4)
+            start = time.perf_counter()
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                content_id = set(d['id'] for d in json.load(f))
+            legacy_time = time.perf_counter() - start
+            assert ids[0] in content_id
+            print('Legacy papers.json ({} papers): {:8.1f} ms to build the id set'.format(args.legacy_papers, legacy_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
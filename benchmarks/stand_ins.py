@@ -0,0 +1,332 @@
+"""
+Local stand-ins of the external services, for offline benchmarks and tests
+
+- ArxivFeedServer: arXiv API Atom feed with configurable page latency and page size
+- ChatCompletionsServer: OpenAI-compatible chat completions with configurable latency, concurrency limit and 429 injection
+- LarkWebhookSink: Lark custom bot Webhook which records the messages
+"""
+
+import re
+import json
+import time
+import random
+import threading
+import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+
+from benchmarks.bench_keyword_filter import make_synthetic_papers
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body: bytes, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+
+class _StandInServer:
+    """
+    Base class running a ThreadingHTTPServer in a background thread
+    """
+
+    handler_class = _Handler
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        server = self
+
+        class Handler(self.handler_class):
+            stand_in = server
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ArxivHandler(_Handler):
+    def do_GET(self):
+        stand_in = self.stand_in
+        query = parse_qs(urlparse(self.path).query)
+        categories = re.findall(r'cat:([\w.\-]+)', query.get('search_query', [''])[0])
+        start = int(query.get('start', ['0'])[0])
+        max_results = min(int(query.get('max_results', ['10'])[0]), stand_in.page_size)
+        with stand_in.lock:
+            stand_in.requests += 1
+        time.sleep(stand_in.page_latency)
+        matching = stand_in.matching(categories)
+        self._send(200, stand_in.render_feed(matching, start, max_results), content_type='application/atom+xml')
+
+
+class ArxivFeedServer(_StandInServer):
+    """
+    arXiv API stand-in serving a synthetic corpus, newest submission first
+    Point an `arxiv.Client` to it with `client.query_url_format = server.query_url_format`.
+    """
+
+    handler_class = _ArxivHandler
+
+    def __init__(self, num_papers: int, categories=('cs.CL', 'cs.AI', 'cs.CV'), page_latency: float = 0.0,
+                 page_size: int = 2000, newest=None, seed: int = 0):
+        """
+        :param num_papers: the number of papers in the corpus
+        :param categories: the categories papers are assigned to (round robin, every 5th paper is cross-listed)
+        :param page_latency: the delay of each response in seconds
+        :param page_size: the maximum number of entries per response
+        :param newest: the submission time of the newest paper (default: now)
+        :param seed: the random seed of the synthetic abstracts
+        """
+        super().__init__()
+        self.page_latency = page_latency
+        self.page_size = page_size
+        self.categories = list(categories)
+        newest = newest or datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.papers = make_synthetic_papers(num_papers, seed=seed)
+        for i, paper in enumerate(self.papers):
+            paper['id'] = '{}.{:05d}'.format(newest.strftime('%y%m'), num_papers - i)
+            paper['published'] = newest - datetime.timedelta(minutes=i)
+            primary = self.categories[i % len(self.categories)]
+            paper['categories'] = [primary] + ([self.categories[(i + 1) % len(self.categories)]] if i % 5 == 0 and len(self.categories) > 1 else [])
+        self._matching = {}
+
+    @property
+    def query_url_format(self) -> str:
+        return self.url + '/api/query?{}'
+
+    def matching(self, categories: list) -> list:
+        key = tuple(sorted(categories))
+        with self.lock:
+            if key not in self._matching:
+                self._matching[key] = [paper for paper in self.papers if not categories or set(paper['categories']) & set(categories)]
+            return self._matching[key]
+
+    def render_feed(self, papers: list, start: int, max_results: int) -> bytes:
+        entries = []
+        for paper in papers[start:start + max_results]:
+            published = paper['published'].strftime('%Y-%m-%dT%H:%M:%SZ')
+            entries.append(
+                '<entry><id>http://arxiv.org/abs/{id}v1</id><updated>{published}</updated><published>{published}</published>'
+                '<title>{title}</title><summary>{summary}</summary><author><name>Author</name></author>'
+                '<arxiv:comment>10 pages</arxiv:comment>'
+                '<link href="http://arxiv.org/abs/{id}v1" rel="alternate" type="text/html"/>'
+                '<arxiv:primary_category term="{primary}"/>{categories}</entry>'.format(
+                    id=paper['id'], published=published, title=escape(paper['title']), summary=escape(paper['abstract']),
+                    primary=paper['categories'][0],
+                    categories=''.join('<category term="{}"/>'.format(category) for category in paper['categories'])
+                )
+            )
+        feed = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+            'xmlns:arxiv="http://arxiv.org/schemas/atom">'
+            '<opensearch:totalResults>{}</opensearch:totalResults><opensearch:startIndex>{}</opensearch:startIndex>'
+            '<opensearch:itemsPerPage>{}</opensearch:itemsPerPage>{}</feed>'
+        ).format(len(papers), start, max_results, ''.join(entries))
+        return feed.encode('utf-8')
+
+
+class _ChatHandler(_Handler):
+    def do_POST(self):
+        stand_in = self.stand_in
+        data = self._read_json()
+        with stand_in.lock:
+            stand_in.requests += 1
+            stand_in.in_flight += 1
+            stand_in.max_in_flight = max(stand_in.max_in_flight, stand_in.in_flight)
+            overloaded = stand_in.max_concurrency and stand_in.in_flight > stand_in.max_concurrency
+            throttled = overloaded or stand_in.rng.random() < stand_in.error_rate
+            if throttled:
+                stand_in.throttled += 1
+        try:
+            if throttled:
+                self._send(429, b'{"error": {"message": "Too Many Requests"}}', headers={'Retry-After': str(stand_in.retry_after)})
+                return
+            time.sleep(stand_in.latency)
+            messages = data.get('messages', [])
+            system = '\n'.join(message.get('content') or '' for message in messages if message.get('role') == 'system')
+            prompt = '\n'.join(message.get('content') or '' for message in messages if message.get('role') != 'system')
+            content = stand_in.respond(prompt, system)
+            # Prefix cache: the system prompt is served from the cache once seen
+            with stand_in.lock:
+                cached_tokens = len(system) // 4 if system in stand_in.prefixes else 0
+                stand_in.prefixes.add(system)
+            prompt = system + '\n' + prompt if system else prompt
+            if content in ('Yes', 'No'):
+                content += '.' + ' Because' * stand_in.explanation_tokens
+                if stand_in.reasoning_tokens:
+                    content = '<think>' + ' hmm' * stand_in.reasoning_tokens + '</think>\n\n' + content
+            tokens = re.findall(r'\s*\S+', content)
+            if data.get('max_tokens'):
+                tokens = tokens[:data['max_tokens']]
+            if data.get('stream'):
+                self._stream(data, prompt, tokens, cached_tokens)
+                return
+            time.sleep(stand_in.token_latency * len(tokens))
+            with stand_in.lock:
+                stand_in.generated_tokens += len(tokens)
+            content = ''.join(tokens)
+            usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(tokens), 'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            body = {
+                'id': 'chatcmpl-stand-in', 'object': 'chat.completion', 'model': data.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': usage
+            }
+            self._send(200, json.dumps(body, ensure_ascii=False).encode('utf-8'))
+        finally:
+            with stand_in.lock:
+                stand_in.in_flight -= 1
+
+
+    def _stream(self, data: dict, prompt: str, tokens: list, cached_tokens=0):
+        """
+        Send the tokens as Server-Sent Events, stopping when the client closes the connection
+        """
+        stand_in = self.stand_in
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        sent = 0
+        try:
+            for token in tokens:
+                time.sleep(stand_in.token_latency)
+                chunk = {'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+                self.wfile.write('data: {}\n\n'.format(json.dumps(chunk, ensure_ascii=False)).encode('utf-8'))
+                self.wfile.flush()
+                sent += 1
+            if (data.get('stream_options') or {}).get('include_usage'):
+                usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': sent, 'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+                usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+                self.wfile.write('data: {}\n\n'.format(json.dumps({'choices': [], 'usage': usage})).encode('utf-8'))
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        with stand_in.lock:
+            stand_in.generated_tokens += sent
+            if sent < len(tokens):
+                stand_in.cancelled += 1
+
+
+class ChatCompletionsServer(_StandInServer):
+    """
+    OpenAI-compatible chat completions stand-in, streaming with Server-Sent Events when asked to
+    Answers the prompts of `llm.py`: single-paper Yes/No, batched JSON verdicts and translations. A paper matches when
+    its title (or number in a batch) hashes to an even value, so the verdicts are deterministic. System prompts seen
+    before are reported as `cached_tokens`, like a server with prefix caching.
+    """
+
+    handler_class = _ChatHandler
+
+    def __init__(self, latency: float = 0.0, max_concurrency: int = 0, error_rate: float = 0.0, retry_after: float = 0.05, seed: int = 0,
+                 token_latency: float = 0.0, reasoning_tokens: int = 0, explanation_tokens: int = 0):
+        """
+        :param latency: the delay of each response in seconds (time to first token)
+        :param max_concurrency: the number of requests served at the same time, requests beyond get a 429 (0 for unlimited)
+        :param error_rate: the probability of injecting a 429 response
+        :param retry_after: the `Retry-After` of 429 responses in seconds
+        :param seed: the random seed of the 429 injection
+        :param token_latency: the delay of each generated token in seconds
+        :param reasoning_tokens: the length of the `<think>` block before each Yes/No answer, like a reasoning model
+        :param explanation_tokens: the length of the explanation after each Yes/No answer
+        """
+        super().__init__()
+        self.latency = latency
+        self.token_latency = token_latency
+        self.reasoning_tokens = reasoning_tokens
+        self.explanation_tokens = explanation_tokens
+        self.generated_tokens = 0
+        self.cancelled = 0
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.throttled = 0
+        self.prefixes = set()
+
+    @staticmethod
+    def _match(text: str) -> bool:
+        return sum(text.encode('utf-8')) % 2 == 0
+
+    def respond(self, prompt: str, system: str = '') -> str:
+        numbers = re.findall(r'^\[(\d+)\]', prompt, flags=re.MULTILINE)
+        if numbers and 'match' in system + prompt:
+            titles = re.findall(r'^\[\d+\]\n标题：(.*)$', prompt, flags=re.MULTILINE)
+            return json.dumps([{'id': int(number), 'match': self._match(title)} for number, title in zip(numbers, titles)])
+        abstracts = re.split(r'^<<<(\d+)>>>$', prompt.split('**注意**')[0], flags=re.MULTILINE)[1:]
+        if abstracts:
+            # Batch translation, about one character per three of the abstract
+            return '\n'.join('<<<{}>>>\n{}'.format(number, '译' * (len(abstract) // 3 + 1))
+                             for number, abstract in zip(abstracts[::2], abstracts[1::2]))
+        if '翻译' in prompt:
+            return '这是一段中文翻译。' * 20
+        title = re.search(r'标题：(.*)', prompt)
+        return 'Yes' if self._match(title.group(1) if title else prompt) else 'No'
+
+
+class _LarkHandler(_Handler):
+    def do_POST(self):
+        stand_in = self.stand_in
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        time.sleep(stand_in.latency)
+        with stand_in.lock:
+            stand_in.requests += 1
+            stand_in.bytes += len(body)
+            stand_in.messages.append(json.loads(body))
+        self._send(200, b'{"code": 0, "msg": "success", "data": {}}')
+
+
+class LarkWebhookSink(_StandInServer):
+    """
+    Lark custom bot Webhook stand-in recording the messages it receives
+    """
+
+    handler_class = _LarkHandler
+
+    def __init__(self, latency: float = 0.0):
+        """
+        :param latency: the delay of each response in seconds
+        """
+        super().__init__()
+        self.latency = latency
+        self.bytes = 0
+        self.messages = []
@@ -0,0 +1,233 @@
+"""
+Run Checkpoint: Resume Interrupted Runs
+"""
+
+import os
+import json
+import datetime
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from history import get_history_dir
+from paper import Paper, dumps, loads
+
+
+class RunCheckpoint:
+    """
+    Journal of the work finished by a run, so that an interrupted run resumes where it stopped
+    Records are appended as JSON Lines and flushed one by one, so a crash costs only the requests in flight:
+    - page: a page of fetched papers, and fetch_complete once all pages are fetched (with the watermarks state)
+    - verdicts / translations: the LLM verdicts and translated abstracts by paper id
+    - result: the papers kept by the pipeline, and recorded once they are appended to the history
+    - batch: the key of each Lark message delivered (or saved to the outbox)
+    The file is removed when the run finishes.
+    """
+
+    def __init__(self, file_path: str, max_age_hours=24):
+        """
+        :param file_path: the file path of the journal
+        :param max_age_hours: a journal started longer ago is discarded instead of resumed (0 for never)
+        """
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self.started_at = None
+        self.pages = []
+        self.fetch_complete = False
+        self.watermarks = None
+        self.verdicts = {}
+        self.translations = {}
+        self.result = None
+        self.recorded = False
+        self.batches = set()
+        self.resumed = self._load(max_age_hours)
+        if not self.resumed:
+            self.started_at = datetime.datetime.now().astimezone()
+            with open(self.file_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'type': 'run', 'started_at': self.started_at.isoformat()}) + '\n')
+        self._file = open(self.file_path, 'a', encoding='utf-8')
+
+    def _load(self, max_age_hours) -> bool:
+        if not os.path.exists(self.file_path):
+            return False
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(loads(line))
+            except ValueError:
+                # Torn last line of an interrupted write
+                break
+        if not records or records[0].get('type') != 'run':
+            return False
+        started_at = datetime.datetime.fromisoformat(records[0]['started_at'])
+        if max_age_hours and datetime.datetime.now().astimezone() - started_at > datetime.timedelta(hours=max_age_hours):
+            print('Discarding the checkpoint of the run started at {}'.format(started_at))
+            return False
+        self.started_at = started_at
+        for record in records[1:]:
+            record_type = record['type']
+            if record_type == 'page':
+                self.pages.append([Paper.from_dict(paper) for paper in record['papers']])
+            elif record_type == 'fetch_restart':
+                self.pages = []
+            elif record_type == 'fetch_complete':
+                self.fetch_complete = True
+                self.watermarks = record.get('watermarks')
+            elif record_type == 'verdicts':
+                self.verdicts.update(record['verdicts'])
+            elif record_type == 'translations':
+                self.translations.update(record['translations'])
+            elif record_type == 'result':
+                self.result = [Paper.from_dict(paper) for paper in record['papers']]
+            elif record_type == 'recorded':
+                self.recorded = True
+            elif record_type == 'batch':
+                self.batches.add(record['key'])
+        # Drop the torn tail so that new records start on a fresh line
+        with open(self.file_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(dumps(record) + '\n' for record in records))
+        return True
+
+    def _write(self, record: dict, sync=False):
+        line = dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def record_pages(self, pages, watermarks=None):
+        """
+        Record the pages of papers while they are fetched
+        :param pages: an iterator of lists of papers
+        :param watermarks: the FetchWatermarks updated by the fetch (if any), its state is recorded once all pages are fetched
+        :return: an iterator of the same pages
+        """
+        if self.pages:
+            # Pages of an interrupted fetch are fetched again
+            self.pages = []
+            self._write({'type': 'fetch_restart'})
+        for page in pages:
+            self.pages.append(page)
+            self._write({'type': 'page', 'papers': page})
+            yield page
+        self.fetch_complete = True
+        self.watermarks = watermarks.watermarks if watermarks is not None else None
+        self._write({'type': 'fetch_complete', 'watermarks': self.watermarks}, sync=True)
+
+    def add_verdicts(self, verdicts: dict):
+        """
+        :param verdicts: the LLM verdicts by paper id
+        """
+        if verdicts:
+            with self._lock:
+                self.verdicts.update(verdicts)
+            self._write({'type': 'verdicts', 'verdicts': verdicts})
+
+    def add_translation(self, paper_id: str, zh_abstract):
+        with self._lock:
+            self.translations[paper_id] = zh_abstract
+        self._write({'type': 'translations', 'translations': {paper_id: zh_abstract}})
+
+    def set_result(self, papers: list):
+        self.result = papers
+        self._write({'type': 'result', 'papers': papers}, sync=True)
+
+    def mark_recorded(self):
+        self.recorded = True
+        self._write({'type': 'recorded'}, sync=True)
+
+    def add_batch(self, key: str):
+        with self._lock:
+            self.batches.add(key)
+        self._write({'type': 'batch', 'key': key}, sync=True)
+
+    def finish(self):
+        """
+        Remove the journal once the run is complete
+        """
+        self._file.close()
+        os.remove(self.file_path)
+
+    def close(self):
+        self._file.close()
+
+
+def open_run_checkpoint(config: dict, directory: str):
+    """
+    Open the checkpoint of the run, resuming the unfinished one (if any)
+    :param config: the configuration, fields include `checkpoint_enabled`, `checkpoint_max_age_hours`
+    :param directory: the directory of the checkpoint file (the history directory)
+    :return: the RunCheckpoint or None if disabled
+    """
+    if not config.get('checkpoint_enabled', True):
+        return None
+    # Not `*.jsonl`, which are the segments of the history
+    file_path = os.path.join(directory, 'run.checkpoint')
+    checkpoint = RunCheckpoint(file_path, max_age_hours=config.get('checkpoint_max_age_hours', 24))
+    if checkpoint.resumed:
+        print('Resuming the run started at {}: {} page(s) fetched{}, {} verdict(s), {} translation(s), {} message(s) delivered'.format(
+            checkpoint.started_at, len(checkpoint.pages), ' (complete)' if checkpoint.fetch_complete else '',
+            len(checkpoint.verdicts), len(checkpoint.translations), len(checkpoint.batches)
+        ))
+    return checkpoint
+
+
+class RunLock:
+    """
+    Exclusive lock of the runs sharing a history directory, held by one run at a time (across processes)
+    The lock is an OS file lock, so it is released by the OS if the process dies. The file keeps the pid of the holder.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: the file path of the lock
+        """
+        self.file_path = file_path
+        self._file = None
+
+    def acquire(self) -> bool:
+        """
+        Acquire the lock without waiting
+        :return: True if acquired, False if another run holds it
+        """
+        f = os.fdopen(os.open(self.file_path, os.O_RDWR | os.O_CREAT), 'r+', encoding='utf-8')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+def get_run_lock(config: dict) -> RunLock:
+    """
+    Get the lock of the runs of the configuration, in the (top-level) history directory
+    """
+    directory = get_history_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    return RunLock(os.path.join(directory, 'run.lock'))
@@ -0,0 +1,261 @@
+"""
+Command Line Interface
+Each subcommand only imports the modules it uses, so that short operations (history search, outbox resend) start fast.
+"""
+
+import os
+import sys
+import argparse
+import contextlib
+
+
+class Context:
+    """
+    Options shared by the subcommands, the configuration is loaded once on first use
+    """
+
+    def __init__(self, config_file=None):
+        self.config_file = config_file
+        self._config = None
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            from settings import load_config
+            self._config = load_config(self.config_file)
+        return self._config
+
+
+def read_papers(file_path: str) -> list:
+    """
+    Read a JSON list of papers from a file, or from the standard input if '-'
+    """
+    from paper import loads_papers
+    if file_path == '-':
+        return loads_papers(sys.stdin.buffer.read())
+    with open(file_path, 'rb') as f:
+        return loads_papers(f.read())
+
+
+def write_papers(papers: list, file_path=None):
+    """
+    Write a JSON list of papers to a file, or to the standard output
+    """
+    from paper import dumps
+    if file_path:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(dumps(papers, indent=True))
+        print('Wrote {} papers to {}'.format(len(papers), file_path), file=sys.stderr)
+    else:
+        sys.stdout.write(dumps(papers, indent=True) + '\n')
+
+
+def progress_to_stderr():
+    """
+    Keep the standard output for the JSON result
+    """
+    return contextlib.redirect_stdout(sys.stderr)
+
+
+def cmd_fetch(args, context: Context):
+    from arxiv_paper import get_latest_papers
+    config = context.config
+    with progress_to_stderr():
+        papers = get_latest_papers(args.categories or config['category_list'], max_results=args.max_results or config.get('max_results', 90))
+    write_papers(papers, args.output)
+
+
+def cmd_filter(args, context: Context):
+    from keyword_matcher import get_keyword_matcher
+    config = context.config
+    papers = read_papers(args.input)
+    if args.new_only:
+        from history import get_paper_history
+        seen_ids = get_paper_history(config, migrate_legacy=False).seen_ids
+        papers = [paper for paper in papers if paper['id'] not in seen_ids]
+    keyword_list = config['keyword_list'] if args.keywords is None else args.keywords
+    if keyword_list:
+        matcher = get_keyword_matcher(keyword_list)
+        papers = [paper for paper in papers if matcher.is_match(paper)]
+    if args.llm:
+        from llm import are_papers_match
+        from settings import load_paper_to_hunt
+        from utils import get_llm_concurrency, map_concurrently
+        paper_to_hunt = load_paper_to_hunt(config)
+        batch_size = max(int(config.get('llm_filter_batch_size') or 1), 1)
+        batches = [papers[i:i + batch_size] for i in range(0, len(papers), batch_size)]
+        with progress_to_stderr():
+            matches = map_concurrently(lambda batch: are_papers_match(batch, paper_to_hunt, config), batches,
+                                       max_concurrency=get_llm_concurrency(config)[0])
+        papers = [paper for paper, match in zip(papers, (match for batch in matches for match in batch)) if match]
+    write_papers(papers, args.output)
+
+
+def cmd_translate(args, context: Context):
+    from arxiv_paper import translate_abstracts
+    papers = read_papers(args.input)
+    with progress_to_stderr():
+        translate_abstracts(papers, context.config)
+    write_papers(papers, args.output)
+
+
+def cmd_post(args, context: Context):
+    from lark_post import post_to_lark_webhook, resend_outbox
+    config = context.config
+    resend_outbox(config)
+    if args.input:
+        summary = post_to_lark_webhook(args.tag or config['tag'], read_papers(args.input), config)
+        print('Posted: {} sent, {} failed'.format(summary['sent'], summary['failed']))
+
+
+def cmd_run(args, context: Context):
+    if args.daemon:
+        from daemon import Daemon
+        daemon = Daemon(context.config_file) if context.config_file else Daemon()
+        try:
+            daemon.run_forever()
+        except KeyboardInterrupt:
+            print('Stopped')
+        return
+    from main import task
+    task(context.config)
+
+
+def cmd_backfill(args, context: Context):
+    import datetime
+    from backfill import run_backfill
+    run_backfill(
+        context.config, datetime.date.fromisoformat(args.since), datetime.date.fromisoformat(args.until),
+        category_list=args.categories, window_days=args.window_days, workers=args.workers,
+        use_llm_for_filtering=False if args.no_llm else None, use_llm_for_translation=False if args.no_translate else None
+    )
+
+
+def cmd_history(args, context: Context):
+    from history import get_paper_history
+    from history_index import HistoryIndex
+    from settings import get_history_index_file, get_profiles
+    config = context.config
+    # Searching works even with `history_index_enabled: false`, the index is then built on demand
+    file_path = get_history_index_file(config)
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    index = HistoryIndex(file_path)
+    if args.history_command == 'reindex':
+        index.clear()
+    # Catch up with the papers recorded without the index (only the lines appended since the last sync are read)
+    for history_config in [config] + get_profiles(config):
+        index.sync(get_paper_history(history_config, migrate_legacy=False))
+    if args.history_command == 'reindex':
+        print('Indexed {} papers'.format(len(index)))
+        return
+
+    papers = index.search(' '.join(args.query), since=args.since, until=args.until, tag=args.tag, category=args.category,
+                          date_field=args.date_field, limit=args.limit)
+    if args.json:
+        write_papers(papers)
+        return
+    for paper in papers:
+        print('{}  {}  [{}]  {}'.format(paper[args.date_field] or '----------', paper['id'], ', '.join(paper['tags'] + paper['categories']), paper['title']))
+        if args.abstract:
+            print('    ' + (paper['zh_abstract'] or paper['abstract']))
+    print('{} paper(s)'.format(len(papers)), file=sys.stderr)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='ArXiv Today: fetch, filter, translate and post arXiv papers to Lark')
+    parser.add_argument('--config', default=None, help='config file (default: config.yaml)')
+    parser.add_argument('--profile-import', action='store_true', help='report the import time of the modules after the command')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = subparsers.add_parser('fetch', help='fetch the latest papers as JSON')
+    fetch_parser.add_argument('--categories', nargs='+', default=None, help='categories (default: category_list)')
+    fetch_parser.add_argument('--max-results', type=int, default=None, help='papers per category (default: max_results)')
+    fetch_parser.add_argument('-o', '--output', default=None, help='output file (default: standard output)')
+    fetch_parser.set_defaults(func=cmd_fetch)
+
+    filter_parser = subparsers.add_parser('filter', help='filter a JSON list of papers by keyword (and LLM)')
+    filter_parser.add_argument('input', nargs='?', default='-', help="input file ('-' for standard input)")
+    filter_parser.add_argument('--keywords', nargs='*', default=None, help='keywords (default: keyword_list)')
+    filter_parser.add_argument('--llm', action='store_true', help='filter by LLM with paper_to_hunt as well')
+    filter_parser.add_argument('--new-only', action='store_true', help='drop the papers in the history')
+    filter_parser.add_argument('-o', '--output', default=None, help='output file (default: standard output)')
+    filter_parser.set_defaults(func=cmd_filter)
+
+    translate_parser = subparsers.add_parser('translate', help='translate the abstracts of a JSON list of papers')
+    translate_parser.add_argument('input', nargs='?', default='-', help="input file ('-' for standard input)")
+    translate_parser.add_argument('-o', '--output', default=None, help='output file (default: standard output)')
+    translate_parser.set_defaults(func=cmd_translate)
+
+    post_parser = subparsers.add_parser('post', help='resend the outbox, then post a JSON list of papers to Lark (if given)')
+    post_parser.add_argument('input', nargs='?', default=None, help="input file ('-' for standard input)")
+    post_parser.add_argument('--tag', default=None, help='tag of the message (default: tag)')
+    post_parser.set_defaults(func=cmd_post)
+
+    run_parser = subparsers.add_parser('run', help='run the whole task (same as main.py)')
+    run_parser.add_argument('--daemon', action='store_true', help='keep running on schedule (same as daemon.py)')
+    run_parser.set_defaults(func=cmd_run)
+
+    backfill_parser = subparsers.add_parser('backfill', help='record the papers of a date range in the history (resumable)')
+    backfill_parser.add_argument('--since', required=True, help='first submission date (YYYY-MM-DD)')
+    backfill_parser.add_argument('--until', required=True, help='last submission date (YYYY-MM-DD)')
+    backfill_parser.add_argument('--categories', nargs='+', default=None, help='categories (default: category_list)')
+    backfill_parser.add_argument('--window-days', type=int, default=None, help='days per window (default: backfill_window_days)')
+    backfill_parser.add_argument('--workers', type=int, default=None, help='windows fetched at the same time (default: backfill_fetch_workers)')
+    backfill_parser.add_argument('--no-llm', action='store_true', help='filter by keyword only')
+    backfill_parser.add_argument('--no-translate', action='store_true', help='do not translate the abstracts')
+    backfill_parser.set_defaults(func=cmd_backfill)
+
+    history_parser = subparsers.add_parser('history', help='search the paper history')
+    history_subparsers = history_parser.add_subparsers(dest='history_command', required=True)
+    search_parser = history_subparsers.add_parser('search', help='full-text search, newest first')
+    search_parser.add_argument('query', nargs='*', help='keywords, "quoted phrases", -excluded, prefix*')
+    search_parser.add_argument('--since', default=None, help='first date (YYYY-MM-DD)')
+    search_parser.add_argument('--until', default=None, help='last date (YYYY-MM-DD)')
+    search_parser.add_argument('--date-field', choices=('recorded', 'published'), default='recorded', help='date of the range')
+    search_parser.add_argument('--tag', default=None, help='tag of the run (profile)')
+    search_parser.add_argument('--category', default=None, help='arXiv category')
+    search_parser.add_argument('--limit', type=int, default=20, help='maximum number of papers')
+    search_parser.add_argument('--abstract', action='store_true', help='show the abstracts')
+    search_parser.add_argument('--json', action='store_true', help='output JSON')
+    history_subparsers.add_parser('reindex', help='rebuild the search index from the histories')
+    history_parser.set_defaults(func=cmd_history)
+    return parser
+
+
+def profile_imports(argv: list) -> int:
+    """
+    Run the command again with `-X importtime` and report the modules which took the longest to import
+    """
+    import subprocess
+    process = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + argv,
+                             stderr=subprocess.PIPE, text=True)
+    imports, total = [], 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            sys.stderr.write(line + '\n')
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # Header
+        self_us, cumulative_us, name = int(fields[0]), int(fields[1]), fields[2]
+        total += self_us
+        if not name[1:].startswith(' '):
+            # Imported by the command itself (top level)
+            imports.append((cumulative_us, name.strip()))
+    print('\nImport time: {:.1f} ms in total'.format(total / 1000), file=sys.stderr)
+    for cumulative_us, name in sorted(imports, reverse=True)[:15]:
+        print('{:>10.1f} ms  {}'.format(cumulative_us / 1000, name), file=sys.stderr)
+    return process.returncode
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = build_parser().parse_args(argv)
+    if args.profile_import:
+        return profile_imports([arg for arg in argv if arg != '--profile-import'])
+    args.func(args, Context(args.config))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
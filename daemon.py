@@ -0,0 +1,306 @@
+"""
+Daemon: Scheduled Runs with Warm State
+"""
+
+import os
+import json
+import datetime
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import main
+from checkpoint import get_run_lock
+from history import get_history_dir, get_paper_history
+from settings import CONFIG_FILE, get_paper_to_hunt_file, get_profiles, load_config, load_paper_to_hunt
+
+# arXiv announces the new submissions at 20:00 US Eastern time, Sunday to Thursday
+ANNOUNCEMENT_TIME = datetime.time(20, 0)
+ANNOUNCEMENT_WEEKDAYS = (6, 0, 1, 2, 3)
+
+
+def _us_eastern_offset(day: datetime.date) -> datetime.timedelta:
+    """
+    UTC offset of US Eastern time in the evening of `day` (daylight saving from the second Sunday of March to the
+    first Sunday of November), for systems without the time zone database (e.g. Windows without `tzdata`)
+    """
+    march = datetime.date(day.year, 3, 8)
+    november = datetime.date(day.year, 11, 1)
+    dst_start = march + datetime.timedelta(days=(6 - march.weekday()) % 7)
+    dst_end = november + datetime.timedelta(days=(6 - november.weekday()) % 7)
+    return datetime.timedelta(hours=-4 if dst_start <= day < dst_end else -5)
+
+
+def _announcement_time(day: datetime.date) -> datetime.datetime:
+    try:
+        return datetime.datetime.combine(day, ANNOUNCEMENT_TIME, tzinfo=ZoneInfo('America/New_York'))
+    except ZoneInfoNotFoundError:
+        return datetime.datetime.combine(day, ANNOUNCEMENT_TIME, tzinfo=datetime.timezone(_us_eastern_offset(day)))
+
+
+def next_announcement_run(after: datetime.datetime, delay_minutes: float = 30) -> datetime.datetime:
+    """
+    Get the time of the first run after `after` following an arXiv announcement
+    :param after: an aware datetime
+    :param delay_minutes: the delay of the run after the announcement (the listing takes a while to be updated)
+    :return: an aware datetime
+    """
+    delay = datetime.timedelta(minutes=delay_minutes)
+    day = (after - delay).astimezone(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+    while True:
+        run_time = _announcement_time(day) + delay
+        if day.weekday() in ANNOUNCEMENT_WEEKDAYS and run_time > after:
+            return run_time
+        day += datetime.timedelta(days=1)
+
+
+def next_scheduled_run(after: datetime.datetime, run_times: list) -> datetime.datetime:
+    """
+    Get the time of the first run after `after` at one of the local times `run_times`
+    :param after: an aware datetime
+    :param run_times: a list of local times like '10:17'
+    :return: an aware datetime
+    """
+    local = after.astimezone()
+    candidates = []
+    for day in (local.date(), local.date() + datetime.timedelta(days=1)):
+        for run_time in run_times:
+            hour, minute = map(int, str(run_time).split(':'))
+            candidate = datetime.datetime.combine(day, datetime.time(hour, minute)).astimezone()
+            if candidate > after:
+                candidates.append(candidate)
+    return min(candidates)
+
+
+def next_run_time(config: dict, after: datetime.datetime) -> datetime.datetime:
+    """
+    Get the time of the next run described by the configuration
+    :param config: the configuration, fields include `daemon_run_times`, `daemon_announcement_delay_minutes`
+    """
+    if config.get('daemon_run_times'):
+        return next_scheduled_run(after, config['daemon_run_times'])
+    return next_announcement_run(after, config.get('daemon_announcement_delay_minutes', 30))
+
+
+class Daemon:
+    """
+    Long-running process which runs the task on schedule, keeping its state warm between runs
+    The modules, the HTTP sessions (arXiv, LLM, Lark), the compiled keyword matchers, the LLM cache and the seen-id index
+    of each history are loaded once and reused by every run. The configuration and the `paper_to_hunt` files are
+    reloaded when they change. Runs never overlap: they are started one by one by the scheduler loop and hold the run
+    lock of the history directory, so a `main.py` started by cron at the same time is skipped.
+    """
+
+    def __init__(self, config_file=CONFIG_FILE):
+        """
+        :param config_file: the file path of the configuration
+        """
+        self.config_file = config_file
+        self.config = None
+        self.config_error = None
+        self.config_loaded_at = None
+        self._watched = {}
+        self.histories = {}
+        self._status_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._run_requested = False
+        self._stopped = False
+        self.started_at = datetime.datetime.now().astimezone()
+        self.state = 'idle'
+        self.next_run = None
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.reload_config()
+
+    def _watched_files(self, config: dict) -> list:
+        files = [self.config_file] + [get_paper_to_hunt_file(profile) for profile in [config] + get_profiles(config)]
+        return list(dict.fromkeys(files))
+
+    @staticmethod
+    def _mtimes(files: list) -> dict:
+        return {file_path: os.path.getmtime(file_path) if os.path.exists(file_path) else None for file_path in files}
+
+    def reload_config(self) -> bool:
+        """
+        Reload the configuration if the configuration or a `paper_to_hunt` file changed
+        An invalid configuration is reported (see `status`) and the previous one is kept.
+        :return: True if reloaded
+        """
+        if self.config is not None and self._mtimes(list(self._watched)) == self._watched:
+            return False
+        try:
+            config = load_config(self.config_file)
+            get_profiles(config)
+            watched = self._watched_files(config)
+        except Exception as e:
+            if self.config_error is None:
+                print('Invalid configuration, keeping the previous one: {}'.format(e))
+            self.config_error = str(e)
+            if self.config is None:
+                raise
+            # Retried once the files change again
+            self._watched = self._mtimes(list(self._watched))
+            return False
+        self._watched = self._mtimes(watched)
+        if self.config is not None:
+            print('Configuration reloaded')
+        self.config = config
+        self.config_error = None
+        self.config_loaded_at = datetime.datetime.now().astimezone()
+        self.next_run = next_run_time(config, datetime.datetime.now().astimezone())
+        return True
+
+    def run_once(self, reason='schedule') -> bool:
+        """
+        Run the task with the current configuration, unless another run holds the lock
+        :param reason: why the run is started (reported by `status`)
+        :return: True if the run succeeded
+        """
+        config = self.config
+        lock = get_run_lock(config)
+        if not lock.acquire():
+            print('Another run is in progress, skipping')
+            return False
+        started_at = datetime.datetime.now().astimezone()
+        with self._status_lock:
+            self.state = 'running'
+            self.last_run = {'reason': reason, 'started_at': started_at.isoformat(), 'finished_at': None, 'ok': None}
+        print('Task: {} ({})'.format(started_at.strftime('%Y-%m-%d %H:%M:%S'), reason))
+        ok, error, papers = False, None, None
+        try:
+            for history in self.histories.values():
+                # Another process may have appended to the history between the runs
+                if history.refresh():
+                    print('History {} changed since the previous run, reloading its seen-id index'.format(history.directory))
+            profiles = get_profiles(config)
+            if profiles:
+                results = main.run_profiles(config, profiles, histories=self.histories)
+                papers = {name: len(profile_papers) for name, profile_papers in results.items()}
+            else:
+                history_dir = get_history_dir(config)
+                if history_dir not in self.histories:
+                    self.histories[history_dir] = get_paper_history(config)
+                paper_to_hunt = load_paper_to_hunt(config) if config['use_llm_for_filtering'] else None
+                papers = len(main.run_task(config, paper_to_hunt, self.histories[history_dir]))
+            ok = True
+        except Exception as e:
+            # The daemon keeps running, the checkpoint lets the next run resume the work done
+            traceback.print_exc()
+            error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            lock.release()
+            with self._status_lock:
+                self.state = 'idle'
+                self.runs += 1
+                self.failures += 0 if ok else 1
+                self.last_run.update({
+                    'finished_at': datetime.datetime.now().astimezone().isoformat(),
+                    'ok': ok, 'error': error, 'papers': papers
+                })
+        return ok
+
+    def request_run(self):
+        """
+        Ask the scheduler loop for a run now (after the current one, if any)
+        """
+        self._run_requested = True
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def status(self) -> dict:
+        with self._status_lock:
+            return {
+                'state': self.state,
+                'healthy': self.config_error is None and (self.last_run is None or self.last_run['ok'] is not False),
+                'pid': os.getpid(),
+                'started_at': self.started_at.isoformat(),
+                'config_loaded_at': self.config_loaded_at.isoformat() if self.config_loaded_at else None,
+                'config_error': self.config_error,
+                'next_run': self.next_run.isoformat() if self.next_run else None,
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_run': dict(self.last_run) if self.last_run else None,
+            }
+
+    def serve_status(self, host='127.0.0.1', port=8765) -> ThreadingHTTPServer:
+        """
+        Serve the status in a background thread
+        - GET /health: 200 if the configuration is valid and the last run succeeded, 503 otherwise
+        - GET /status: the full status (see `status`)
+        - POST /run: run now
+        """
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def _send(self, code: int, data: dict):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                status = daemon.status()
+                if self.path == '/health':
+                    self._send(200 if status['healthy'] else 503, {'healthy': status['healthy'], 'state': status['state']})
+                elif self.path == '/status':
+                    self._send(200, status)
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if self.path == '/run':
+                    daemon.request_run()
+                    self._send(202, {'requested': True})
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), StatusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('Status endpoint: http://{}:{}/status'.format(host, server.server_address[1]))
+        return server
+
+    def run_forever(self):
+        """
+        Run the task at each scheduled time until stopped, checking the configuration every `daemon_poll_seconds`
+        """
+        server = None
+        port = self.config.get('daemon_status_port', 8765)
+        if port:
+            server = self.serve_status(self.config.get('daemon_status_host', '127.0.0.1'), port)
+        if self.config.get('daemon_run_on_start', False):
+            self.request_run()
+        try:
+            while not self._stopped:
+                print('Next run: {}'.format(self.next_run.astimezone().strftime('%Y-%m-%d %H:%M:%S')))
+                while not self._stopped and not self._run_requested and datetime.datetime.now().astimezone() < self.next_run:
+                    timeout = (self.next_run - datetime.datetime.now().astimezone()).total_seconds()
+                    self._wakeup.wait(max(min(timeout, self.config.get('daemon_poll_seconds', 30)), 0))
+                    self._wakeup.clear()
+                    self.reload_config()
+                if self._stopped:
+                    break
+                reason = 'request' if self._run_requested else 'schedule'
+                self._run_requested = False
+                self.run_once(reason)
+                self.next_run = next_run_time(self.config, datetime.datetime.now().astimezone())
+        finally:
+            if server is not None:
+                server.shutdown()
+
+
+if __name__ == '__main__':
+    daemon = Daemon()
+    try:
+        daemon.run_forever()
+    except KeyboardInterrupt:
+        print('Stopped')
@@ -0,0 +1,426 @@
+"""
+Paper History Store
+"""
+
+import os
+import re
+import json
+import glob
+import bisect
+import datetime
+import argparse
+from array import array
+
+from paper import SCHEMA_VERSION, Paper, dumps, loads, loads_papers, read_schema_header, schema_header
+
+
+ARXIV_ID_PATTERN = re.compile(r'^(\d{4})\.(\d{4,5})$')
+
+
+def pack_arxiv_id(paper_id: str):
+    """
+    Pack a new-style arXiv id (`YYMM.NNNN` or `YYMM.NNNNN`, without version) into an integer
+    The 4-digit (until 1412) and 5-digit (since 1501) numbering never share a month, so the packed integer is unique.
+    :param paper_id: the arXiv id
+    :return: the packed integer or None if the id is not a new-style arXiv id
+    """
+    match = ARXIV_ID_PATTERN.match(paper_id)
+    if not match:
+        return None
+    return int(match.group(1)) * 100000 + int(match.group(2))
+
+
+def _write_atomic(file_path: str, data: bytes):
+    tmp_file = file_path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file_path)
+
+
+class SeenIdIndex:
+    """
+    Compact index of the ids of the papers in the history
+    New-style arXiv ids are packed into 8-byte integers and kept in a sorted array (binary search lookup), other ids
+    (old-style or custom) are kept in a plain set. Ids added since the last compaction are appended to a delta file,
+    so adding ids costs O(new ids). The index records the size of the history it reflects and is rebuilt from the
+    history when they disagree (e.g. after a crash between the history append and the index update).
+    """
+
+    COMPACT_THRESHOLD = 4096
+
+    def __init__(self, directory: str):
+        """
+        :param directory: the directory of the index files
+        """
+        self.base_file = os.path.join(directory, 'seen_ids.bin')
+        self.delta_file = os.path.join(directory, 'seen_ids.delta')
+        self.other_file = os.path.join(directory, 'seen_ids.other')
+        self.meta_file = os.path.join(directory, 'seen_ids.json')
+        self._base = array('Q')
+        self._delta = set()
+        self._other = set()
+        self.history_size = None
+
+    def load(self, history_size: int) -> bool:
+        """
+        Load the index from disk
+        :param history_size: the current size of the history in bytes
+        :return: True if the index is consistent with the history, False if it has to be rebuilt
+        """
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('history_size') != history_size:
+            return False
+        self._base = array('Q')
+        if os.path.exists(self.base_file):
+            with open(self.base_file, 'rb') as f:
+                self._base.frombytes(f.read())
+        if os.path.exists(self.delta_file):
+            delta = array('Q')
+            with open(self.delta_file, 'rb') as f:
+                data = f.read()
+            delta.frombytes(data[:len(data) - len(data) % delta.itemsize])
+            self._delta = set(delta)
+        if os.path.exists(self.other_file):
+            with open(self.other_file, 'r', encoding='utf-8') as f:
+                self._other = set(line.rstrip('\n') for line in f if line.strip())
+        self.history_size = history_size
+        return True
+
+    def __contains__(self, paper_id: str) -> bool:
+        packed = pack_arxiv_id(paper_id)
+        if packed is None:
+            return paper_id in self._other
+        if packed in self._delta:
+            return True
+        position = bisect.bisect_left(self._base, packed)
+        return position < len(self._base) and self._base[position] == packed
+
+    def __len__(self):
+        return len(self._base) + len(self._delta) + len(self._other)
+
+    def add(self, paper_ids, history_size: int):
+        """
+        Add ids to the index and persist them
+        :param paper_ids: the ids to add
+        :param history_size: the size of the history in bytes after the ids were appended
+        """
+        new_packed = array('Q')
+        new_other = []
+        for paper_id in paper_ids:
+            if paper_id in self:
+                continue
+            packed = pack_arxiv_id(paper_id)
+            if packed is None:
+                self._other.add(paper_id)
+                new_other.append(paper_id)
+            else:
+                self._delta.add(packed)
+                new_packed.append(packed)
+        if new_packed:
+            with open(self.delta_file, 'ab') as f:
+                f.write(new_packed.tobytes())
+        if new_other:
+            with open(self.other_file, 'a', encoding='utf-8') as f:
+                f.write(''.join(paper_id + '\n' for paper_id in new_other))
+        if len(self._delta) > max(self.COMPACT_THRESHOLD, len(self._base) // 100):
+            self.compact()
+        self._write_meta(history_size)
+
+    def rebuild(self, paper_ids, history_size: int):
+        """
+        Rebuild the index from scratch
+        :param paper_ids: all ids in the history
+        :param history_size: the size of the history in bytes
+        """
+        packed_ids = set()
+        self._other = set()
+        for paper_id in paper_ids:
+            packed = pack_arxiv_id(paper_id)
+            if packed is None:
+                self._other.add(paper_id)
+            else:
+                packed_ids.add(packed)
+        self._base = array('Q', sorted(packed_ids))
+        self._delta = set()
+        _write_atomic(self.base_file, self._base.tobytes())
+        _write_atomic(self.other_file, ''.join(paper_id + '\n' for paper_id in sorted(self._other)).encode('utf-8'))
+        _write_atomic(self.delta_file, b'')
+        self._write_meta(history_size)
+
+    def compact(self):
+        """
+        Merge the delta into the sorted base array
+        """
+        self._base = array('Q', sorted(set(self._base).union(self._delta)))
+        self._delta = set()
+        _write_atomic(self.base_file, self._base.tobytes())
+        _write_atomic(self.delta_file, b'')
+
+    def _write_meta(self, history_size: int):
+        _write_atomic(self.meta_file, json.dumps({'history_size': history_size}).encode('utf-8'))
+        self.history_size = history_size
+
+
+class PaperHistory:
+    """
+    Append-only store of the papers sent so far
+    Papers are stored as JSON Lines in monthly segment files (`<directory>/YYYY-MM.jsonl`). Each run appends its papers
+    as a single block, so the cost of a run only depends on the number of new papers. Lines are kept in chronological
+    order (each block is written in reverse), hence reading the lines backwards gives the newest-first order of the
+    legacy `papers.json`.
+    The first line of each segment is a header with the schema version of its records (see `paper.SCHEMA_VERSION`).
+    The size of each segment is recorded in `<directory>/committed.json` once a block is on disk. A crash during an
+    append can leave any part of the block in the segment: the bytes past the committed size are ignored by the readers
+    and truncated by the next append.
+    """
+
+    COMMIT_FILE = 'committed.json'
+
+    def __init__(self, directory: str):
+        """
+        :param directory: the directory of the segment files
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._seen_ids = None
+
+    def segment_files(self):
+        """
+        Get the segment files, oldest first
+        """
+        return sorted(glob.glob(os.path.join(self.directory, '*.jsonl')))
+
+    def committed_sizes(self):
+        """
+        Get the committed size of each segment file
+        :return: a dict of the segment file name to its size in bytes, or None for a store written before the sizes
+            were recorded (every segment counts as committed up to its end)
+        """
+        try:
+            with open(os.path.join(self.directory, self.COMMIT_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _committed_size(self, file_path: str, sizes) -> int:
+        if sizes is None:
+            return os.path.getsize(file_path)
+        return min(sizes.get(os.path.basename(file_path), 0), os.path.getsize(file_path))
+
+    def committed_size(self, file_path: str) -> int:
+        """
+        Get the committed size of a segment file in bytes (the bytes past it belong to an interrupted append)
+        """
+        return self._committed_size(file_path, self.committed_sizes())
+
+    def is_empty(self) -> bool:
+        return self.size() == 0
+
+    def size(self) -> int:
+        """
+        Get the total committed size of the segment files in bytes
+        """
+        sizes = self.committed_sizes()
+        return sum(self._committed_size(file_path, sizes) for file_path in self.segment_files())
+
+    @property
+    def seen_ids(self) -> SeenIdIndex:
+        """
+        The index of the stored paper ids, loaded (or rebuilt from the segments) on first use
+        """
+        if self._seen_ids is None:
+            index = SeenIdIndex(self.directory)
+            history_size = self.size()
+            if not index.load(history_size):
+                index.rebuild((paper['id'] for paper in self.iter_papers(newest_first=False)), history_size)
+            self._seen_ids = index
+        return self._seen_ids
+
+    def refresh(self) -> bool:
+        """
+        Drop the loaded index of the paper ids if another process (e.g. cron, backfill) appended to the history since
+        :return: True if dropped, the index is loaded again on next use
+        """
+        if self._seen_ids is None or self._seen_ids.history_size == self.size():
+            return False
+        self._seen_ids = None
+        return True
+
+    @staticmethod
+    def _repair_tail(file_path: str):
+        """
+        Truncate a torn last line left by a crash during an append (stores without committed sizes)
+        """
+        with open(file_path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            # Scan backwards for the end of the last complete line
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                chunk = f.read(step)
+                index = chunk.rfind(b'\n')
+                if index != -1:
+                    f.truncate(position + index + 1)
+                    return
+            f.truncate(0)
+
+    def append(self, papers: list, date=None):
+        """
+        Append the papers of a run atomically
+        :param papers: a list of papers, newest first (same order as the legacy `papers.json`)
+        :param date: the date of the run, which selects the segment file (default: today)
+        """
+        if not papers:
+            return
+        date = date or datetime.date.today()
+        file_path = os.path.join(self.directory, '{:%Y-%m}.jsonl'.format(date))
+        sizes = self.committed_sizes()
+        if sizes is None:
+            # First append since the sizes are recorded, every complete line so far counts as committed
+            sizes = {}
+            for segment in self.segment_files():
+                self._repair_tail(segment)
+                sizes[os.path.basename(segment)] = os.path.getsize(segment)
+        committed = sizes.get(os.path.basename(file_path), 0)
+        if os.path.exists(file_path) and os.path.getsize(file_path) > committed:
+            print('Rolling back {} bytes of an interrupted append to {}'.format(os.path.getsize(file_path) - committed, file_path))
+            with open(file_path, 'rb+') as f:
+                f.truncate(committed)
+        block = ''.join(dumps(paper) + '\n' for paper in reversed(papers))
+        if committed == 0:
+            # A new segment starts with the schema version of its records
+            block = dumps(schema_header()) + '\n' + block
+        block = block.encode('utf-8')
+        seen_ids = self.seen_ids  # Make sure the index reflects the history before the append
+        with open(file_path, 'ab') as f:
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        # The block counts once its size is recorded, a crash before leaves it past the committed size
+        sizes[os.path.basename(file_path)] = committed + len(block)
+        _write_atomic(os.path.join(self.directory, self.COMMIT_FILE), json.dumps(sizes, sort_keys=True).encode('utf-8'))
+        seen_ids.add((paper['id'] for paper in papers), self.size())
+
+    def iter_papers(self, newest_first=True):
+        """
+        Iterate over the stored papers
+        :param newest_first: whether to iterate newest first (the order of the legacy `papers.json`)
+        :return: an iterator of Papers
+        """
+        files = self.segment_files()
+        sizes = self.committed_sizes()
+        for file_path in (reversed(files) if newest_first else files):
+            with open(file_path, 'rb') as f:
+                lines = f.read(self._committed_size(file_path, sizes)).splitlines()
+            version = SCHEMA_VERSION  # Segments written before the header have the first schema
+            if lines:
+                try:
+                    header = read_schema_header(loads(lines[0]))
+                except ValueError:
+                    header = None
+                if header is not None:
+                    version = header
+                    lines = lines[1:]
+            for line in (reversed(lines) if newest_first else lines):
+                try:
+                    record = loads(line)
+                except ValueError:
+                    # Torn last line of an interrupted append (stores without committed sizes)
+                    continue
+                # An unknown schema version raises
+                yield Paper.from_dict(record, version)
+
+    def ids(self) -> set:
+        """
+        Get the ids of all stored papers
+        **Note**: Parses the whole history, use `seen_ids` for membership checks
+        """
+        return set(paper['id'] for paper in self.iter_papers(newest_first=False))
+
+    def migrate_from_json(self, json_file: str) -> int:
+        """
+        Import the legacy newest-first `papers.json` into an empty store
+        :param json_file: the file path of the legacy JSON file
+        :return: the number of imported papers
+        """
+        if not self.is_empty():
+            raise RuntimeError('Paper history in {} is not empty, refusing to migrate'.format(self.directory))
+        with open(json_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        papers = loads_papers(content) if content else []
+        if papers:
+            self.append(papers, date=datetime.date(1970, 1, 1))  # Legacy records sort before every new segment
+        return len(papers)
+
+    def export_json(self, json_file: str) -> int:
+        """
+        Export the store as the legacy newest-first `papers.json`
+        :param json_file: the file path of the exported JSON file
+        :return: the number of exported papers
+        """
+        papers = list(self.iter_papers(newest_first=True))
+        tmp_file = json_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(dumps(papers, indent=True))
+        os.replace(tmp_file, json_file)
+        return len(papers)
+
+
+def get_history_dir(config: dict) -> str:
+    """
+    Get the absolute path of the history directory described by the configuration
+    :param config: the configuration, fields include `history_dir`
+    """
+    directory = config.get('history_dir') or 'history'
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(__file__), directory)
+    return directory
+
+
+def get_paper_history(config: dict, migrate_legacy=True) -> PaperHistory:
+    """
+    Get the paper history store described by the configuration, migrating the legacy `papers.json` on first use
+    :param config: the configuration, fields include `history_dir`
+    :param migrate_legacy: whether to import the legacy `papers.json` into an empty store
+    :return: the PaperHistory
+    """
+    directory = get_history_dir(config)
+    history = PaperHistory(directory)
+    legacy_file = os.path.join(os.path.dirname(__file__), 'papers.json')
+    if migrate_legacy and os.path.exists(legacy_file) and history.is_empty():
+        count = history.migrate_from_json(legacy_file)
+        print('Migrated {} papers from {} to {}'.format(count, legacy_file, directory))
+    return history
+
+
+if __name__ == '__main__':
+    from settings import load_config
+    parser = argparse.ArgumentParser(description='Paper history store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='export the history as the legacy newest-first papers.json')
+    export_parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'papers.json'), help='output file path')
+    migrate_parser = subparsers.add_parser('migrate', help='import the legacy papers.json into an empty history store')
+    migrate_parser.add_argument('--input', default=os.path.join(os.path.dirname(__file__), 'papers.json'), help='input file path')
+    args = parser.parse_args()
+
+    config = load_config()
+    if args.command == 'migrate':
+        history = get_paper_history(config, migrate_legacy=False)
+        print('Migrated {} papers from {} to {}'.format(history.migrate_from_json(args.input), args.input, history.directory))
+    elif args.command == 'export':
+        history = get_paper_history(config)
+        print('Exported {} papers to {}'.format(history.export_json(args.output), args.output))
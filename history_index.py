@@ -0,0 +1,282 @@
+"""
+Full-Text Index of the Paper History
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+from paper import loads
+from settings import get_history_index_file
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS papers (
+    pk INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, title TEXT NOT NULL, abstract TEXT NOT NULL,
+    zh_abstract TEXT NOT NULL, url TEXT, published TEXT, recorded TEXT
+);
+CREATE INDEX IF NOT EXISTS papers_published ON papers (published);
+CREATE INDEX IF NOT EXISTS papers_recorded ON papers (recorded);
+CREATE TABLE IF NOT EXISTS paper_tags (tag TEXT NOT NULL, paper INTEGER NOT NULL, PRIMARY KEY (tag, paper)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS paper_categories (category TEXT NOT NULL, paper INTEGER NOT NULL, PRIMARY KEY (category, paper)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS paper_tags_paper ON paper_tags (paper);
+CREATE INDEX IF NOT EXISTS paper_categories_paper ON paper_categories (paper);
+CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+    title, abstract, zh_abstract, content='papers', content_rowid='pk', tokenize='porter unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS segments (file TEXT PRIMARY KEY, offset INTEGER NOT NULL);
+'''
+# The trigram tokenizer needs SQLite 3.34+
+ZH_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS papers_zh USING fts5(zh_abstract, content='papers', content_rowid='pk', tokenize='trigram')"
+
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-鿿가-힯豈-﫿]')
+QUERY_TERM_PATTERN = re.compile(r'(-?)"([^"]*)"|(-?)(\S+)')
+SEGMENT_NAME_PATTERN = re.compile(r'^(\d{4})-(\d{2})\.jsonl$')
+DATE_FIELDS = ('recorded', 'published')
+
+
+def parse_query(query: str) -> list:
+    """
+    Parse a search query into terms
+    Terms are separated by spaces, a "quoted phrase" is a single term, a leading '-' excludes the term and a trailing
+    '*' matches the words starting with the term (e.g. `"MCP server" secur* -survey`).
+    :return: a list of (whether the term is excluded, the term)
+    """
+    terms = []
+    for match in QUERY_TERM_PATTERN.finditer(query or ''):
+        negate, term = (match.group(1), match.group(2)) if match.group(4) is None else (match.group(3), match.group(4))
+        if re.search(r'\w', term):
+            terms.append((bool(negate), term))
+    return terms
+
+
+def _fts_phrase(term: str) -> str:
+    prefix = term.endswith('*')
+    return '"{}"{}'.format(term.rstrip('*').replace('"', '""'), '*' if prefix else '')
+
+
+class HistoryIndex:
+    """
+    Full-text index of the paper history in SQLite FTS5
+    Title, abstract and `zh_abstract` are indexed by words (with Porter stemming), and `zh_abstract` by trigrams as well
+    since Chinese has no spaces between words. Each paper keeps its categories, its published date, the date it was
+    recorded and the tags of the runs (profiles) which recorded it. The segments of the history are indexed from the
+    byte offset reached by the previous sync, so a run only indexes the papers it appended.
+    Without the trigram tokenizer (SQLite older than 3.34), Chinese terms are matched with LIKE instead.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: the file path of the SQLite database
+        """
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self.trigram = self._create_zh_table()
+
+    def _create_zh_table(self) -> bool:
+        exists = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'papers_zh'").fetchone() is not None
+        try:
+            with self._conn:
+                self._conn.execute(ZH_SCHEMA)
+                # Also fails on a table created by a newer SQLite
+                self._conn.execute('SELECT rowid FROM papers_zh LIMIT 0')
+                if not exists:
+                    # Papers indexed while the tokenizer was missing
+                    self._conn.execute("INSERT INTO papers_zh (papers_zh) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print('Warning: Chinese search falls back to LIKE, SQLite {} has no trigram tokenizer ({})'.format(sqlite3.sqlite_version, e))
+            return False
+        return True
+
+    def _add(self, paper: dict, tag, recorded) -> bool:
+        text = (paper.get('title') or '', paper.get('abstract') or '', paper.get('zh_abstract') or '')
+        row = self._conn.execute('SELECT pk, title, abstract, zh_abstract FROM papers WHERE id = ?', (paper['id'],)).fetchone()
+        added = row is None
+        if added:
+            pk = self._conn.execute(
+                'INSERT INTO papers (id, title, abstract, zh_abstract, url, published, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (paper['id'],) + text + (paper.get('url'), paper.get('published'), recorded or paper.get('published'))
+            ).lastrowid
+        else:
+            pk = row[0]
+            if tuple(row[1:]) != text:
+                # External content tables are updated by deleting the old text and inserting the new one
+                self._conn.execute("INSERT INTO papers_fts (papers_fts, rowid, title, abstract, zh_abstract) VALUES ('delete', ?, ?, ?, ?)", row)
+                if self.trigram:
+                    self._conn.execute("INSERT INTO papers_zh (papers_zh, rowid, zh_abstract) VALUES ('delete', ?, ?)", (pk, row[3]))
+                self._conn.execute('UPDATE papers SET title = ?, abstract = ?, zh_abstract = ? WHERE pk = ?', text + (pk,))
+        if added or tuple(row[1:]) != text:
+            self._conn.execute('INSERT INTO papers_fts (rowid, title, abstract, zh_abstract) VALUES (?, ?, ?, ?)', (pk,) + text)
+            if self.trigram:
+                self._conn.execute('INSERT INTO papers_zh (rowid, zh_abstract) VALUES (?, ?)', (pk, text[2]))
+        if tag:
+            self._conn.execute('INSERT OR IGNORE INTO paper_tags (tag, paper) VALUES (?, ?)', (tag, pk))
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO paper_categories (category, paper) VALUES (?, ?)',
+            ((category, pk) for category in paper.get('categories') or ())
+        )
+        return added
+
+    def add(self, papers, tag=None, recorded=None) -> int:
+        """
+        Index papers, a paper indexed before is updated (text) and tagged again
+        :param papers: an iterable of papers
+        :param tag: the tag of the run (profile) recording the papers
+        :param recorded: the date the papers were recorded ('YYYY-MM-DD', default: their published date)
+        :return: the number of new papers
+        """
+        with self._lock, self._conn:
+            return sum(self._add(paper, tag, recorded) for paper in papers)
+
+    def sync(self, history, tag=None, recorded=None) -> int:
+        """
+        Index the papers appended to the history since the previous sync
+        :param history: the PaperHistory
+        :param tag: the tag of the papers appended (None when catching up with papers recorded before the index)
+        :param recorded: the date the papers were recorded (default: the month of their segment, or their published date)
+        :return: the number of new papers
+        """
+        count = 0
+        for file_path in history.segment_files():
+            key = os.path.abspath(file_path)
+            # Papers past the committed size belong to an interrupted append
+            size = history.committed_size(file_path)
+            with self._lock:
+                row = self._conn.execute('SELECT offset FROM segments WHERE file = ?', (key,)).fetchone()
+            offset = row[0] if row else 0
+            if offset == size:
+                continue
+            if offset > size:
+                # Rewritten segment, indexing is idempotent
+                offset = 0
+            segment_recorded = recorded
+            match = SEGMENT_NAME_PATTERN.match(os.path.basename(file_path))
+            if segment_recorded is None and match and match.group(1) != '1970':  # 1970: legacy `papers.json`
+                segment_recorded = '{}-{}-01'.format(match.group(1), match.group(2))
+            papers = []
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if offset + len(line) > size or not line.endswith(b'\n'):
+                        # Torn last line of an interrupted append, indexed once repaired
+                        break
+                    offset += len(line)
+                    try:
+                        paper = loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(paper, dict) and 'id' in paper:
+                        papers.append(paper)
+                    if len(papers) == 1000:
+                        count += self.add(papers, tag, segment_recorded)
+                        papers = []
+            count += self.add(papers, tag, segment_recorded)
+            with self._lock, self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO segments (file, offset) VALUES (?, ?)', (key, offset))
+        return count
+
+    def search(self, query='', since=None, until=None, tag=None, category=None, date_field='recorded', limit=20) -> list:
+        """
+        Search the indexed papers, the most recently recorded first
+        The words of the query are matched by a single FTS5 expression walked newest first, so a query stops as soon as
+        `limit` papers pass the other filters instead of sorting every match.
+        :param query: the keywords (see `parse_query`), every term must match the title, the abstract or `zh_abstract`
+        :param since: the first date ('YYYY-MM-DD', inclusive)
+        :param until: the last date ('YYYY-MM-DD', inclusive)
+        :param tag: only the papers recorded with this tag
+        :param category: only the papers of this category
+        :param date_field: the date of the range, 'recorded' or 'published'
+        :param limit: the maximum number of papers returned
+        :return: a list of papers with their `tags`, `recorded` date and `categories`
+        """
+        if date_field not in DATE_FIELDS:
+            raise ValueError('Unknown date field: {}'.format(date_field))
+        included, excluded, clauses, params = [], [], [], []
+        for negate, term in parse_query(query):
+            if not CJK_PATTERN.search(term):
+                (excluded if negate else included).append(_fts_phrase(term))
+                continue
+            term = term.rstrip('*')
+            if self.trigram and len(term) >= 3:
+                clauses.append('p.pk {}IN (SELECT rowid FROM papers_zh WHERE papers_zh MATCH ?)'.format('NOT ' if negate else ''))
+                params.append(_fts_phrase(term))
+            else:
+                # Too short for a trigram (or no trigram tokenizer), checked while walking the papers
+                clauses.append("p.zh_abstract {}LIKE ? ESCAPE '\\'".format('NOT ' if negate else ''))
+                params.append('%{}%'.format(re.sub(r'([%_\\])', r'\\\1', term)))
+        if excluded and not included:
+            clauses.append('p.pk NOT IN (SELECT rowid FROM papers_fts WHERE papers_fts MATCH ?)')
+            params.append(' OR '.join(excluded))
+        if tag:
+            clauses.append('p.pk IN (SELECT paper FROM paper_tags WHERE tag = ?)')
+            params.append(tag)
+        if category:
+            clauses.append('p.pk IN (SELECT paper FROM paper_categories WHERE category = ?)')
+            params.append(category)
+        if since:
+            clauses.append('p.{} >= ?'.format(date_field))
+            params.append(str(since))
+        if until:
+            clauses.append('p.{} <= ?'.format(date_field))
+            params.append(str(until))
+
+        columns = 'p.pk, p.id, p.title, p.abstract, p.zh_abstract, p.url, p.published, p.recorded'
+        if included:
+            expression = ' AND '.join(included) + ''.join(' NOT ' + phrase for phrase in excluded)
+            sql = 'SELECT {} FROM papers_fts f JOIN papers p ON p.pk = f.rowid WHERE papers_fts MATCH ?{} ORDER BY f.rowid DESC LIMIT ?'.format(
+                columns, ''.join(' AND ' + clause for clause in clauses)
+            )
+            params.insert(0, expression)
+        else:
+            sql = 'SELECT {} FROM papers p WHERE {} ORDER BY p.pk DESC LIMIT ?'.format(columns, ' AND '.join(clauses) or '1')
+        results = []
+        with self._lock:
+            for row in self._conn.execute(sql, params + [limit]).fetchall():
+                pk = row[0]
+                paper = dict(zip(('id', 'title', 'abstract', 'zh_abstract', 'url', 'published', 'recorded'), row[1:]))
+                paper['zh_abstract'] = paper['zh_abstract'] or None
+                paper['tags'] = [tag for tag, in self._conn.execute('SELECT tag FROM paper_tags WHERE paper = ? ORDER BY tag', (pk,))]
+                paper['categories'] = [category for category, in self._conn.execute('SELECT category FROM paper_categories WHERE paper = ? ORDER BY category', (pk,))]
+                results.append(paper)
+        return results
+
+    def clear(self):
+        """
+        Drop every indexed paper, the next sync indexes the histories again
+        """
+        with self._lock, self._conn:
+            for table in ('papers', 'paper_tags', 'paper_categories', 'segments'):
+                self._conn.execute('DELETE FROM {}'.format(table))
+            self._conn.execute("INSERT INTO papers_fts (papers_fts) VALUES ('delete-all')")
+            if self.trigram:
+                self._conn.execute("INSERT INTO papers_zh (papers_zh) VALUES ('delete-all')")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM papers').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_history_index(config: dict):
+    """
+    Get the shared full-text index of the paper history described by the configuration
+    :param config: the configuration, fields include `history_index_enabled`, `history_index_file`, `history_dir`
+    :return: the HistoryIndex or None if disabled
+    """
+    if not config.get('history_index_enabled', True):
+        return None
+    file_path = get_history_index_file(config)
+    with _indexes_lock:
+        if file_path not in _indexes:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            _indexes[file_path] = HistoryIndex(file_path)
+        return _indexes[file_path]
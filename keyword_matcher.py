@@ -0,0 +1,104 @@
+"""
+Keyword Matcher
+"""
+
+import re
+from functools import lru_cache
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+class KeywordMatcher:
+    """
+    Precompiled whole-word matcher for include/exclude keyword lists
+    Keywords starting with '-' are exclude keywords, the others are include keywords (case-insensitive).
+    All keywords are combined into a single regex, so each text is scanned once no matter how many keywords there are.
+    """
+
+    def __init__(self, keyword_list):
+        """
+        :param keyword_list: a list of keywords, exclude keywords start with '-'
+        """
+        self.include_keywords = []
+        self.exclude_keywords = []
+        for keyword in keyword_list:
+            keyword = keyword.lower()
+            if keyword.startswith('-'):
+                keyword = keyword[1:]
+                target = self.exclude_keywords
+            else:
+                target = self.include_keywords
+            if keyword and keyword not in target:
+                target.append(keyword)
+        self._include_set = set(self.include_keywords)
+        self._exclude_set = set(self.exclude_keywords)
+
+        keywords = sorted(self._include_set | self._exclude_set, key=len, reverse=True)
+        self._pattern = None
+        if keywords:
+            # Zero-width lookahead so that overlapping keywords are all found. The alternatives are tried longest first,
+            # so each match reports the longest keyword starting at that word boundary.
+            # The leading character class rejects most positions before trying any alternative.
+            first_chars = ''.join(sorted(set(keyword[0] for keyword in keywords)))
+            self._pattern = re.compile(
+                r'\b(?=[' + re.escape(first_chars) + r'])(?=(' + '|'.join(re.escape(keyword) for keyword in keywords) + r')\b)'
+            )
+
+        # Shorter keywords that are a whole-word prefix of a longer keyword also match wherever the longer one does,
+        # e.g. "reinforcement" within "reinforcement learning"
+        self._implied = {}
+        for keyword in keywords:
+            self._implied[keyword] = [keyword] + [
+                other for other in keywords
+                if len(other) < len(keyword) and keyword.startswith(other)
+                and _is_word_char(keyword[len(other) - 1]) != _is_word_char(keyword[len(other)])
+            ]
+
+    def find(self, text: str):
+        """
+        Find the keywords occurring in the text as whole words
+        :param text: the text to search
+        :return: (matched include keywords, matched exclude keywords), both in keyword list order
+        """
+        if self._pattern is None:
+            return [], []
+        found = set()
+        for match in self._pattern.finditer(text.lower()):
+            found.update(self._implied[match.group(1)])
+        return (
+            [keyword for keyword in self.include_keywords if keyword in found],
+            [keyword for keyword in self.exclude_keywords if keyword in found]
+        )
+
+    def find_in_paper(self, paper: dict):
+        """
+        Find the keywords occurring in the title and abstract of a paper
+        :param paper: the paper
+        :return: (matched include keywords, matched exclude keywords)
+        """
+        return self.find(paper['title'] + ' ' + paper['abstract'])
+
+    def is_match(self, paper: dict) -> bool:
+        """
+        Check if a paper contains any include keyword and no exclude keyword
+        :param paper: the paper
+        :return: True if the paper matches
+        """
+        include, exclude = self.find_in_paper(paper)
+        return bool(include) and not exclude
+
+
+@lru_cache(maxsize=32)
+def _get_keyword_matcher(keywords: tuple) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
+
+
+def get_keyword_matcher(keyword_list) -> KeywordMatcher:
+    """
+    Get a compiled KeywordMatcher, reusing the one compiled for the same keyword list
+    :param keyword_list: a list of keywords, exclude keywords start with '-'
+    :return: the KeywordMatcher
+    """
+    return _get_keyword_matcher(tuple(keyword_list))
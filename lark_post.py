@@ -2,94 +2,345 @@
 HTTP POST request to Lark Webhook API
 """
 
+import os
 import json
+import time
+import glob
+import random
+import hashlib
 import datetime
+import itertools
 import requests
+from utils import RateLimiter, parse_retry_after
+from metrics import get_run_metrics
 
+# Lark custom bots accept request bodies up to 20 KB, at most 100 requests per minute and 5 per second
+DEFAULT_MAX_PAYLOAD_BYTES = 20000
+DEFAULT_MAX_BATCH_SIZE = 20
+LARK_REQUESTS_PER_MINUTE = 100
+LARK_BURST = 5
+# Lark reports throttling in the response body with HTTP 200
+LARK_RETRYABLE_CODES = {9499, 11232}
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
-def post_to_lark_webhook(tag: str, papers: list, config: dict):
+_lark_limiter = RateLimiter(LARK_REQUESTS_PER_MINUTE, burst=LARK_BURST)
+# Orders the messages saved to the outbox within the same clock tick
+_outbox_sequence = itertools.count()
+
+
+def _serialize(data: dict) -> bytes:
+    # Non-ASCII characters are sent as UTF-8 instead of `\uXXXX` escapes, which halves the size of Chinese abstracts
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _payload_size(data: dict) -> int:
+    return len(_serialize(data))
+
+
+def _build_card(tag: str, paper_list: list, total_papers: int, config: dict, today_date: str) -> dict:
+    """
+    Build the message of a batch using the card template
+    """
+    card_data = {
+        "type": "template",
+        "data": {
+            "template_id": config['template_id'],
+            "template_version_name": config['template_version_name'],
+            "template_variable": {
+                "today_date": today_date,
+                "tag": tag,
+                "total_paper": total_papers,
+                # "table_rows": table_rows,
+                "paper_list": paper_list
+            }
+        }
+    }
+
+    return {
+        "msg_type": "interactive",
+        "card": card_data
+    }
+
+
+def _fit_item(item: dict, budget: int) -> dict:
+    """
+    Truncate the abstract of a paper so that it fits in `budget` bytes on its own
+    """
+    size = _payload_size(item)
+    if size <= budget or not item['abstract']:
+        return item
+    abstract = item['abstract']
+    # Drop characters in proportion to the excess (abstracts may be multi-byte), then refine
+    while abstract and _payload_size(dict(item, abstract=abstract + '…')) > budget:
+        excess = _payload_size(dict(item, abstract=abstract + '…')) - budget
+        abstract = abstract[:max(len(abstract) - max(excess // 3, 1), 0)]
+    return dict(item, abstract=abstract + '…')
+
+
+def pack_batches(paper_list: list, base_size: int, max_payload_bytes: int, max_batch_size: int) -> list:
+    """
+    Pack papers into batches by serialized size
+    :param paper_list: the card items of the papers
+    :param base_size: the serialized size of a message without any paper
+    :param max_payload_bytes: the maximum serialized size of a message
+    :param max_batch_size: the maximum number of papers per message
+    :return: a list of batches (lists of card items)
+    """
+    budget = max_payload_bytes - base_size
+    batches = []
+    batch, batch_size = [], 0
+    for item in paper_list:
+        item = _fit_item(item, budget)
+        item_size = _payload_size(item) + 2  # Separator between list items
+        if batch and (batch_size + item_size > budget or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(item)
+        batch_size += item_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _lark_code(response: requests.Response):
+    try:
+        data = response.json()
+    except ValueError:
+        # Not JSON, e.g. the HTML page of a proxy error
+        return 0
+    return data.get('code', 0) if isinstance(data, dict) else 0
+
+
+def _is_delivered(response: requests.Response) -> bool:
+    return response.status_code == 200 and _lark_code(response) in (0, None)
+
+
+def is_retryable_failure(result) -> bool:
+    """
+    Check whether a failed send may succeed later
+    :param result: the last response or error returned by `send_to_lark`
+    :return: True for request errors (timeouts, connection errors, ...), 429/5xx responses and throttling codes,
+        False for messages Lark rejects (e.g. 400, an invalid template or payload)
+    """
+    if isinstance(result, Exception):
+        return True
+    if result.status_code == 200:
+        return _lark_code(result) in LARK_RETRYABLE_CODES
+    return result.status_code in RETRYABLE_STATUS_CODES
+
+
+def send_to_lark(webhook_url: str, data: dict, config: dict):
+    """
+    Send a message to Lark Webhook, retrying timeouts, 429/5xx responses and throttling codes with backoff
+    :param webhook_url: the Webhook URL
+    :param data: the message
+    :param config: the configuration, fields include `lark_timeout`, `lark_max_retries`
+    :return: (whether the message was sent, the last response or error)
+    """
     headers = {
-        'Content-Type': 'application/json'
+        'Content-Type': 'application/json; charset=utf-8'
     }
+    timeout = float(config.get('lark_timeout') or 10)
+    max_retries = int(config.get('lark_max_retries', 3) or 0)
+    backoff_seconds = float(config.get('lark_backoff_seconds') or 1.0)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_after = None
+        _lark_limiter.acquire()
+        try:
+            result = requests.post(webhook_url, headers=headers, data=_serialize(data), timeout=timeout)
+            delivered = _is_delivered(result)
+        except (requests.RequestException, ValueError) as e:
+            # Any transport error (e.g. a body cut by a dropped connection), or a body which cannot be decoded
+            result = e
+        else:
+            if delivered:
+                return True, result
+            if result.status_code != 200:
+                retry_after = parse_retry_after(result.headers.get('Retry-After'))
+        retryable = is_retryable_failure(result)
+        if not retryable or attempt > max_retries:
+            return False, result
+        get_run_metrics().increment('lark_retries')
+        delay = retry_after if retry_after is not None else backoff_seconds * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+        time.sleep(delay)
+
+
+def _get_outbox_dir(config: dict) -> str:
+    directory = config.get('lark_outbox_dir') or 'outbox'
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(__file__), directory)
+    return directory
+
 
-    # Split papers into batches of maximum 20
-    batch_size = 20
+def _write_message(file_path: str, message: dict):
+    tmp_file = file_path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(message, f, ensure_ascii=False)
+    os.replace(tmp_file, file_path)
+
+
+def save_to_outbox(webhook_url: str, data: dict, config: dict):
+    """
+    Persist an undelivered message so that the next run resends it
+    """
+    directory = _get_outbox_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    file_path = os.path.join(directory, '{:%Y%m%d%H%M%S%f}-{:06d}-{}.json'.format(datetime.datetime.now(), next(_outbox_sequence) % 1000000, digest))
+    _write_message(file_path, {'webhook_url': webhook_url, 'data': data, 'attempts': 0})
+
+
+def _move_to_dead(file_path: str, config: dict):
+    directory = os.path.join(_get_outbox_dir(config), 'dead')
+    os.makedirs(directory, exist_ok=True)
+    os.replace(file_path, os.path.join(directory, os.path.basename(file_path)))
+
+
+def resend_outbox(config: dict) -> dict:
+    """
+    Resend the messages left in the outbox by previous runs, oldest first
+    A message still failing is kept for the next run (the remaining ones wait behind it to keep the order), unless
+    Lark rejects it or it has failed `lark_outbox_max_attempts` times: then it is moved to `<lark_outbox_dir>/dead`.
+    :param config: the configuration
+    :return: the number of messages sent, still failing and moved to `dead`
+    """
+    max_attempts = max(int(config.get('lark_outbox_max_attempts', 5) or 1), 1)
+    summary = {'sent': 0, 'failed': 0, 'dead': 0}
+    for file_path in sorted(glob.glob(os.path.join(_get_outbox_dir(config), '*.json'))):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            message = json.load(f)
+        sent, result = send_to_lark(message['webhook_url'], message['data'], config)
+        if sent:
+            os.remove(file_path)
+            summary['sent'] += 1
+            continue
+        message['attempts'] = message.get('attempts', 0) + 1
+        if not is_retryable_failure(result) or message['attempts'] >= max_attempts:
+            print(f"Outbox message {os.path.basename(file_path)} failed {message['attempts']} time(s), moved to dead: {result}")
+            _write_message(file_path, message)
+            _move_to_dead(file_path, config)
+            summary['dead'] += 1
+            continue
+        print(f"Outbox message {os.path.basename(file_path)} failed again: {result}")
+        _write_message(file_path, message)
+        summary['failed'] += 1
+        # Lark is unreachable or throttling, keep the order of the remaining messages for the next run
+        break
+    if any(summary.values()):
+        print(f"Outbox: {summary['sent']} message(s) resent, {summary['failed']} failed, {summary['dead']} moved to dead")
+        get_run_metrics().increment('lark_outbox_resent', summary['sent'])
+        get_run_metrics().increment('lark_outbox_failed', summary['failed'])
+        get_run_metrics().increment('lark_outbox_dead', summary['dead'])
+    return summary
+
+
+def _batch_key(tag: str, batch: list) -> str:
+    return hashlib.sha256(json.dumps([tag, [item['id'] for item in batch]]).encode('utf-8')).hexdigest()[:16]
+
+
+def post_to_lark_webhook(tag: str, papers: list, config: dict, checkpoint=None):
+    """
+    Post papers to Lark Webhook
+    Papers are packed into messages by serialized size (`lark_max_payload_bytes`, at most `lark_max_batch_size` papers),
+    sent one at a time in order (Lark shows messages in arrival order), and retried with backoff. A message which still
+    fails for a transient reason is saved to the outbox with the messages after it, which `resend_outbox` sends in
+    order on the next run. Messages Lark rejects are dropped.
+    :param tag: the tag of the card
+    :param papers: a list of papers
+    :param config: the configuration
+    :param checkpoint: the RunCheckpoint, messages delivered by an interrupted run are not sent again
+    :return: the number of messages sent and failed
+    """
     total_papers = len(papers)
-    
+
     if total_papers == 0:
         print("No papers to send")
-        return
-    
-    # Calculate number of batches needed
-    num_batches = (total_papers + batch_size - 1) // batch_size
-    
+        return {'sent': 0, 'failed': 0}
+
+    # Card Template Data
+    today_date = datetime.date.today().strftime('%Y-%m-%d')
+    paper_list = [
+        {
+            "counter": i + 1,
+            "title": paper['title'],
+            "id": paper['id'],
+            "abstract": paper['zh_abstract'] if paper.get('zh_abstract', None) else paper.get('abstract', None),
+            # "zh_abstract": paper.get('zh_abstract', None),
+            "url": paper['url'],
+            "published": paper['published'],
+            "comment": paper.get('comment') or ""
+        }
+        for i, paper in enumerate(papers)
+    ]
+
+    # Reserve room for the batch indicator added to the tag
+    base_size = _payload_size(_build_card(f"{tag} (第 {total_papers}/{total_papers} 批)", [], total_papers, config, today_date))
+    batches = pack_batches(
+        paper_list, base_size,
+        int(config.get('lark_max_payload_bytes') or DEFAULT_MAX_PAYLOAD_BYTES),
+        int(config.get('lark_max_batch_size') or DEFAULT_MAX_BATCH_SIZE)
+    )
+    num_batches = len(batches)
+
     print(f"Total papers: {total_papers}, splitting into {num_batches} batch(es)")
-    
-    for batch_num in range(num_batches):
-        start_idx = batch_num * batch_size
-        end_idx = min(start_idx + batch_size, total_papers)
-        batch_papers = papers[start_idx:end_idx]
-        
-        print(f"Sending batch {batch_num + 1}/{num_batches} with {len(batch_papers)} papers (papers {start_idx + 1}-{end_idx})")
-        
-        # Card Template Data
-        today_date = datetime.date.today().strftime('%Y-%m-%d')
-        table_rows = [
-            {
-                "index": start_idx + i + 1,
-                "title": paper['title'],
-                "id": paper['id'],
-                "published": paper['published'],
-                "url": f"[{paper['url']}]({paper['url']})"
-            }
-            for i, paper in enumerate(batch_papers)
-        ]
-        paper_list = [
-            {
-                "counter": start_idx + i + 1,
-                "title": paper['title'],
-                "id": paper['id'],
-                "abstract": paper['zh_abstract'] if paper.get('zh_abstract', None) else paper.get('abstract', None),
-                # "zh_abstract": paper.get('zh_abstract', None),
-                "url": paper['url'],
-                "published": paper['published'],
-                "comment": paper['comment'] if paper['comment'] else ""
-            }
-            for i, paper in enumerate(batch_papers)
-        ]
-        
+
+    def send_batch(batch_num, queued):
+        batch_papers = batches[batch_num]
+        if checkpoint is not None and _batch_key(tag, batch_papers) in checkpoint.batches:
+            print(f"Batch {batch_num + 1}/{num_batches} already delivered, skipping")
+            return None, None, None
         # Add batch info to tag if there are multiple batches
         batch_tag = tag if num_batches == 1 else f"{tag} (第 {batch_num + 1}/{num_batches} 批)"
+        data = _build_card(batch_tag, batch_papers, total_papers, config, today_date)
+        if queued:
+            # Behind a message waiting in the outbox, sending it now would deliver it first
+            save_to_outbox(config['webhook_url'], data, config)
+            sent, result = False, None
+        else:
+            print(f"Sending batch {batch_num + 1}/{num_batches} with {len(batch_papers)} papers (papers {batch_papers[0]['counter']}-{batch_papers[-1]['counter']})")
+            sent, result = send_to_lark(config['webhook_url'], data, config)
+            if not sent and is_retryable_failure(result):
+                save_to_outbox(config['webhook_url'], data, config)
+        if checkpoint is not None:
+            # Saved to the outbox counts as delivered, the outbox resends it. A rejected message would be rejected again.
+            checkpoint.add_batch(_batch_key(tag, batch_papers))
+        return data, sent, result
 
-        card_data = {
-            "type": "template",
-            "data": {
-                "template_id": config['template_id'],
-                "template_version_name": config['template_version_name'],
-                "template_variable": {
-                    "today_date": today_date,
-                    "tag": batch_tag,
-                    "total_paper": total_papers,
-                    # "table_rows": table_rows,
-                    "paper_list": paper_list
-                }
-            }
-        }
-
-        data = {
-            "msg_type": "interactive",
-            "card": card_data
-        }
-       
-        # Send HTTP POST request
-        response = requests.post(config['webhook_url'], headers=headers, data=json.dumps(data))
+    outcomes = []
+    queued = False
+    for batch_num in range(num_batches):
+        data, sent, result = send_batch(batch_num, queued)
+        outcomes.append((data, sent, result))
+        queued = queued or (data is not None and not sent and is_retryable_failure(result))
 
-        if response.status_code == 200:
+    summary = {'sent': 0, 'failed': 0}
+    for batch_num, (data, sent, result) in enumerate(outcomes):
+        if data is None:
+            continue
+        if sent:
+            summary['sent'] += 1
             print(f"Batch {batch_num + 1}/{num_batches} sent successfully")
-            print(f"Response:\n{response.json()}")
+            print(f"Response:\n{result.text}")
+        elif result is None:
+            summary['failed'] += 1
+            print(f"Batch {batch_num + 1}/{num_batches} saved to the outbox behind the failed batch")
         else:
-            print(f"Batch {batch_num + 1}/{num_batches} failed, status code: {response.status_code}")
-            print(f"Response:\n{response.text}")
+            summary['failed'] += 1
+            if isinstance(result, requests.Response):
+                print(f"Batch {batch_num + 1}/{num_batches} failed, status code: {result.status_code}")
+                print(f"Response:\n{result.text}")
+            else:
+                print(f"Batch {batch_num + 1}/{num_batches} failed: {result}")
+            if is_retryable_failure(result):
+                print(f"Batch {batch_num + 1}/{num_batches} saved to the outbox")
+            else:
+                print(f"Batch {batch_num + 1}/{num_batches} rejected by Lark, not saved to the outbox")
+    get_run_metrics().increment('lark_batches_sent', summary['sent'])
+    get_run_metrics().increment('lark_batches_failed', summary['failed'])
+    return summary
 
 
 if __name__ == '__main__':
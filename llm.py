@@ -3,28 +3,55 @@ LLM Utilities
 """
 
 import re
-from utils import get_llm_response
+import json
+from metrics import get_run_metrics
+from utils import get_llm_response, get_llm_verdict, truncate_to_tokens
 
+# Prompts are laid out as a stable system prompt (instructions and `paper_to_hunt`) followed by a short user prompt with
+# the paper(s), so that servers with prefix caching (vLLM, Ollama, OpenAI...) reuse the shared prefix across requests.
+FILTER_SYSTEM_PROMPT = '你是一个专业的学术论文筛选助手。你的任务是判断给定的论文是否符合我正在寻找的研究内容。\n\n我正在寻找的研究内容(paper_to_hunt)：\n{paper_to_hunt}\n\n---\n\n请分析论文的内容是否与我寻找的研究内容相符。在分析时，请考虑：\n1. 研究主题的相关性\n2. 论文的关键概念与我的研究描述的匹配程度\n\n基于你的分析，如果这篇论文符合我要找的研究内容，请只回答"Yes"；如果不符合，请只回答"No"。'
+BATCH_FILTER_SYSTEM_PROMPT = '你是一个专业的学术论文筛选助手。你的任务是逐篇判断给定的论文是否符合我正在寻找的研究内容。\n\n我正在寻找的研究内容(paper_to_hunt)：\n{paper_to_hunt}\n\n---\n\n每篇论文以方括号中的编号开头。请逐篇分析论文的内容是否与我寻找的研究内容相符。在分析时，请考虑：\n1. 研究主题的相关性\n2. 论文的关键概念与我的研究描述的匹配程度\n\n请只输出一个 JSON 数组，为每篇论文给出一个元素，格式为 {{"id": 编号, "match": true 或 false}}，例如：[{{"id": 1, "match": true}}, {{"id": 2, "match": false}}]。不要输出任何其他内容。'
+SCORE_SYSTEM_PROMPT = '你是一个专业的学术论文筛选助手。你的任务是逐篇评估给定的论文与我正在寻找的研究内容的相关程度。\n\n我正在寻找的研究内容(paper_to_hunt)：\n{paper_to_hunt}\n\n---\n\n每篇论文以方括号中的编号开头。请为每篇论文给出 0 到 10 的整数相关度评分：0 表示完全无关，10 表示完全符合。只有明显无关或明显符合时才给出接近 0 或 10 的评分，拿不准时给出中间的评分。\n\n请只输出一个 JSON 数组，为每篇论文给出一个元素，格式为 {{"id": 编号, "score": 评分}}，例如：[{{"id": 1, "score": 9}}, {{"id": 2, "score": 0}}]。不要输出任何其他内容。'
+TRANSLATION_SYSTEM_PROMPT = '请将用户给出的学术论文摘要翻译为中文。\n\n**注意**：\n- 中文语境中常用的英文学术术语可以保留英文原文，如：自然语言处理中的 Transformer 可以保留英文。\n- 其他关键的学术术语可以中英文对照，如：后门攻击(Backdoor Attack)。\n- 直接给出翻译结果，不需要进行解释，不需要任何其他内容。'
+BATCH_TRANSLATION_SYSTEM_PROMPT = '请将用户给出的多篇学术论文摘要分别翻译为中文，每篇摘要以单独一行的编号 <<<编号>>> 开头。\n\n**注意**：\n- 中文语境中常用的英文学术术语可以保留英文原文，如：自然语言处理中的 Transformer 可以保留英文。\n- 其他关键的学术术语可以中英文对照，如：后门攻击(Backdoor Attack)。\n- 按编号顺序逐篇翻译，每篇翻译之前单独一行写上对应的 <<<编号>>>，不要合并或遗漏任何一篇。\n- 直接给出翻译结果，不需要进行解释，不需要任何其他内容。'
 
-def is_paper_match(paper: dict, paper_to_hunt: str, config: dict) -> bool:
+
+def _budget_abstract(paper: dict, config: dict) -> str:
+    """
+    Get the abstract of the paper cut to `llm_max_abstract_tokens` for the filtering prompts
+    """
+    abstract, truncated = truncate_to_tokens(paper['abstract'], int(config.get('llm_max_abstract_tokens') or 0))
+    if truncated:
+        get_run_metrics().increment('llm_abstracts_truncated')
+    return abstract
+
+
+def _paper_list(papers: list, config: dict) -> str:
+    return '\n\n'.join(
+        '[{}]\n标题：{}\n摘要：{}'.format(i + 1, paper['title'], _budget_abstract(paper, config))
+        for i, paper in enumerate(papers)
+    )
+
+
+def is_paper_match(paper: dict, paper_to_hunt: str, config: dict, on_error=True) -> bool:
     """
     Check if the paper matches `paper_to_hunt` description using LLM
     :param paper: the paper to check
     :param paper_to_hunt: the prompt describing the paper to hunt for
     :param config: the configuration of LLM Server
-    :return: True if the paper matches or LLM Service fails, False otherwise
+    :param on_error: the result if LLM Service fails (default: True, assuming the paper matches)
+    :return: True if the paper matches, False otherwise, `on_error` if LLM Service fails
     """
     paper_title = paper['title']
-    paper_abstract = paper['abstract']
-    prompt = f'你是一个专业的学术论文筛选助手。你的任务是判断给定的论文是否符合我正在寻找的研究内容。\n\n请仔细阅读以下论文的标题和摘要：\n标题：{paper_title}\n摘要：{paper_abstract}\n\n我正在寻找的研究内容(paper_to_hunt)：\n{paper_to_hunt}\n\n---\n\n请分析这篇论文的内容是否与我寻找的研究内容相符。在分析时，请考虑：\n1. 研究主题的相关性\n2. 论文的关键概念与我的研究描述的匹配程度\n\n基于你的分析，如果这篇论文符合我要找的研究内容，请只回答"Yes"；如果不符合，请只回答"No"。'
-    response = get_llm_response(prompt, config)
+    paper_abstract = _budget_abstract(paper, config)
+    prompt = f'请仔细阅读以下论文的标题和摘要：\n标题：{paper_title}\n摘要：{paper_abstract}'
+    # The response is streamed and closed as soon as a Yes/No appears after the thinking process (if any)
+    response = get_llm_verdict(prompt, config, system=FILTER_SYSTEM_PROMPT.format(paper_to_hunt=paper_to_hunt))
     if not response:
-        # LLM Service Error, assuming the paper matches
-        print('LLM Service Error for paper: {}. Assuming it matches.'.format(paper_title))
-        return True
+        # LLM Service Error, assuming the paper matches (unless undecided, see `cascade_papers_match`)
+        print('LLM Service Error for paper: {}. {}'.format(paper_title, 'Assuming it matches.' if on_error else 'Leaving it undecided.'))
+        return on_error
 
-    # Filter out the thinking process wrapped between <think> and </think> (if any)
-    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL).strip()
     print('LLM response for paper "{}": {}'.format(paper_title, response))
 
     # if 'yes' in response.lower() and 'no' in response.lower():
@@ -43,6 +70,206 @@ def is_paper_match(paper: dict, paper_to_hunt: str, config: dict) -> bool:
     return 'yes' in response.lower()
 
 
+def _parse_batch_verdicts(response: str, num_papers: int) -> dict:
+    """
+    Parse the verdicts of a batch classification response
+    :param response: the LLM response, expected to contain a JSON array of `{"id": int, "match": bool}`
+    :param num_papers: the number of papers in the batch
+    :return: a dict mapping the paper id (1-based index in the batch) to its verdict, invalid items are skipped
+    """
+    # Filter out the thinking process wrapped between <think> and </think> (if any)
+    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+    start, end = response.find('['), response.rfind(']')
+    if start == -1 or end < start:
+        return {}
+    try:
+        items = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    verdicts = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        paper_id, match = item.get('id'), item.get('match')
+        if isinstance(paper_id, str) and paper_id.strip().isdigit():
+            paper_id = int(paper_id)
+        if isinstance(match, str) and match.strip().lower() in ('true', 'false', 'yes', 'no'):
+            match = match.strip().lower() in ('true', 'yes')
+        if isinstance(paper_id, int) and not isinstance(paper_id, bool) and isinstance(match, bool) and 1 <= paper_id <= num_papers:
+            verdicts[paper_id] = match
+    return verdicts
+
+
+def are_papers_match(papers: list, paper_to_hunt: str, config: dict, on_error=True) -> list:
+    """
+    Check if a batch of papers matches `paper_to_hunt` description using a single LLM request
+    The LLM is asked for a JSON array of `{"id", "match"}` verdicts. If some ids are missing or the response
+    cannot be parsed, the unresolved papers are split in halves and retried, down to the single-paper prompt.
+    :param papers: the papers to check
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :param config: the configuration of LLM Server
+    :param on_error: the result for the papers LLM Service fails on (default: True, assuming they match)
+    :return: a list of booleans in the same order as `papers` (True if the paper matches, `on_error` if LLM Service fails)
+    """
+    if not papers:
+        return []
+    if config.get('use_llm_cascade') and config.get('llm_cascade'):
+        return cascade_papers_match(papers, paper_to_hunt, config)
+    if len(papers) == 1:
+        return [is_paper_match(papers[0], paper_to_hunt, config, on_error=on_error)]
+
+    prompt = f'请仔细阅读以下 {len(papers)} 篇论文的标题和摘要，并逐篇给出判断：\n\n{_paper_list(papers, config)}'
+    response = get_llm_response(prompt, config, system=BATCH_FILTER_SYSTEM_PROMPT.format(paper_to_hunt=paper_to_hunt))
+    if not response:
+        # LLM Service Error, assuming the papers match (unless undecided, see `cascade_papers_match`)
+        print('LLM Service Error for a batch of {} papers. {}'.format(len(papers), 'Assuming they match.' if on_error else 'Leaving them undecided.'))
+        return [on_error] * len(papers)
+
+    verdicts = _parse_batch_verdicts(response, len(papers))
+    results = [verdicts.get(i + 1) for i in range(len(papers))]
+    missing = [i for i, match in enumerate(results) if match is None]
+    for i, match in enumerate(results):
+        if match is not None:
+            print('LLM verdict for paper "{}": {}'.format(papers[i]['title'], 'Yes' if match else 'No'))
+    if missing:
+        # Re-split the unresolved part of the batch and retry
+        print('LLM returned {} of {} verdicts, retrying the rest in smaller batches.'.format(len(papers) - len(missing), len(papers)))
+        missing_papers = [papers[i] for i in missing]
+        half = (len(missing_papers) + 1) // 2
+        retried = are_papers_match(missing_papers[:half], paper_to_hunt, config, on_error) + \
+            are_papers_match(missing_papers[half:], paper_to_hunt, config, on_error)
+        for i, match in zip(missing, retried):
+            results[i] = match
+    return results
+
+
+def _parse_batch_scores(response: str, num_papers: int) -> dict:
+    """
+    Parse the scores of a batch scoring response
+    :param response: the LLM response, expected to contain a JSON array of `{"id": int, "score": int}`
+    :param num_papers: the number of papers in the batch
+    :return: a dict mapping the paper id (1-based index in the batch) to its score (0 to 10), invalid items are skipped
+    """
+    # Filter out the thinking process wrapped between <think> and </think> (if any)
+    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+    start, end = response.find('['), response.rfind(']')
+    if start == -1 or end < start:
+        return {}
+    try:
+        items = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    scores = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        paper_id, score = item.get('id'), item.get('score')
+        if isinstance(paper_id, str) and paper_id.strip().isdigit():
+            paper_id = int(paper_id)
+        if isinstance(score, str):
+            try:
+                score = float(score.strip())
+            except ValueError:
+                continue
+        if isinstance(paper_id, int) and not isinstance(paper_id, bool) and isinstance(score, (int, float)) \
+                and not isinstance(score, bool) and 1 <= paper_id <= num_papers and 0 <= score <= 10:
+            scores[paper_id] = score
+    return scores
+
+
+def score_papers(papers: list, paper_to_hunt: str, config: dict) -> list:
+    """
+    Rate how well each paper of a batch matches `paper_to_hunt` description from 0 to 10, using a single LLM request
+    :param papers: the papers to rate
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :param config: the configuration of LLM Server
+    :return: a list of scores in the same order as `papers` (None if missing or LLM Service fails)
+    """
+    prompt = f'请仔细阅读以下 {len(papers)} 篇论文的标题和摘要，并逐篇给出评分：\n\n{_paper_list(papers, config)}'
+    response = get_llm_response(prompt, config, system=SCORE_SYSTEM_PROMPT.format(paper_to_hunt=paper_to_hunt))
+    if not response:
+        print('LLM Service Error for a batch of {} papers.'.format(len(papers)))
+        return [None] * len(papers)
+    scores = _parse_batch_scores(response, len(papers))
+    return [scores.get(i + 1) for i in range(len(papers))]
+
+
+def get_cascade_stages(config: dict) -> list:
+    """
+    Get the configuration of each stage listed under `llm_cascade`
+    A stage overrides the LLM Server configuration (`model`, `base_url`, `api_key`, `llm_backends`, ...) and sets its
+    confidence rule:
+    - `rule: 'score'`: the paper is rated from 0 to 10, a score at most `reject_at_most` is a No, at least
+      `accept_at_least` a Yes, anything in between (or missing) is uncertain
+    - `rule: 'verdict'`: the Yes/No verdict of the usual prompt, only the verdicts listed in `decide` (default: both)
+      are final, the others are uncertain
+    :param config: the configuration
+    :return: a list of (name, rule, stage configuration)
+    """
+    stages = []
+    for i, stage in enumerate(config['llm_cascade']):
+        stage_config = {key: value for key, value in config.items() if key not in ('use_llm_cascade', 'llm_cascade')}
+        if 'base_url' in stage and 'llm_backends' not in stage:
+            # A stage with its own endpoint does not use the top-level backend pool
+            stage_config['llm_backends'] = []
+        stage_config.update(stage)
+        rule = stage.get('rule', 'verdict')
+        if rule not in ('score', 'verdict'):
+            raise ValueError('Unknown rule `{}` of LLM cascade stage {}'.format(rule, i + 1))
+        stages.append((str(stage.get('name') or 'stage-{}'.format(i + 1)), rule, stage_config))
+    return stages
+
+
+def cascade_papers_match(papers: list, paper_to_hunt: str, config: dict) -> list:
+    """
+    Check if a batch of papers matches `paper_to_hunt` description with a cascade of LLMs (see `llm_cascade`)
+    Each stage decides the papers it is confident about and escalates the uncertain ones to the next stage, so a small
+    fast model can screen out the obviously off-topic papers and leave the rest to a larger one. A paper a stage fails on
+    (LLM Service Error) is uncertain as well. The last stage decides every paper left, an uncertain paper counts as a
+    match (as when LLM Service fails without a cascade). The number of papers decided
+    by each stage is counted in the run report (`llm_cascade_decided_<name>`).
+    :return: a list of booleans in the same order as `papers`
+    """
+    stages = get_cascade_stages(config)
+    results = [None] * len(papers)
+    pending = list(range(len(papers)))
+    for position, (name, rule, stage_config) in enumerate(stages):
+        last = position == len(stages) - 1
+        stage_papers = [papers[i] for i in pending]
+        if rule == 'score':
+            reject_at_most = float(stage_config.get('reject_at_most', 2))
+            accept_at_least = float(stage_config.get('accept_at_least', 8))
+            decisions = [
+                None if score is None else False if score <= reject_at_most else True if score >= accept_at_least else None
+                for score in score_papers(stage_papers, paper_to_hunt, stage_config)
+            ]
+        else:
+            decide = set(str(verdict).lower() for verdict in stage_config.get('decide', ('Yes', 'No')))
+            decisions = [
+                match if match is None or last or ('yes' if match else 'no') in decide else None
+                for match in are_papers_match(stage_papers, paper_to_hunt, stage_config, on_error=None)
+            ]
+        if last:
+            decisions = [True if match is None else match for match in decisions]
+        still_pending = []
+        for i, match in zip(pending, decisions):
+            if match is None:
+                still_pending.append(i)
+            else:
+                results[i] = match
+        get_run_metrics().increment('llm_cascade_decided_{}'.format(name), len(pending) - len(still_pending))
+        pending = still_pending
+        if not pending:
+            break
+    return results
+
+
 def translate_abstract(abstract: str, config: dict):
     """
     Translate the abstract using LLM
@@ -50,10 +277,89 @@ def translate_abstract(abstract: str, config: dict):
     :param config: the configuration of LLM Server
     :return: the translated abstract or None if failed
     """
-    prompt = f'请将下面的学术论文摘要翻译为中文：\n{abstract}\n\n**注意**：\n- 中文语境中常用的英文学术术语可以保留英文原文，如：自然语言处理中的 Transformer 可以保留英文。\n- 其他关键的学术术语可以中英文对照，如：后门攻击(Backdoor Attack)。\n- 直接给出翻译结果，不需要进行解释，不需要任何其他内容。'
-    translated_text = get_llm_response(prompt, config)
+    # The abstract is translated in full, the token budget only applies to the filtering prompts
+    prompt = f'请将下面的学术论文摘要翻译为中文：\n{abstract}'
+    translated_text = get_llm_response(prompt, config, system=TRANSLATION_SYSTEM_PROMPT)
     if not translated_text:
         return None
     # Filter out the thinking process wrapped between <think> and </think> (if any)
     translated_text = re.sub(r'<think>.*?</think>', '', translated_text, flags=re.DOTALL)
     return translated_text.strip()
+
+
+TRANSLATION_MARKER_PATTERN = re.compile(r'^[ \t]*<<<\s*(\d+)\s*>>>[ \t]*$', re.MULTILINE)
+
+
+def _parse_batch_translations(response: str, num_abstracts: int) -> dict:
+    """
+    Parse the translations of a batch translation response
+    :param response: the LLM response, expected to contain each translation after a `<<<id>>>` line
+    :param num_abstracts: the number of abstracts in the batch
+    :return: a dict mapping the abstract id (1-based index in the batch) to its translation, invalid or repeated ids are skipped
+    """
+    # Filter out the thinking process wrapped between <think> and </think> (if any)
+    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+    markers = list(TRANSLATION_MARKER_PATTERN.finditer(response))
+    translations, seen, repeated = {}, set(), set()
+    for marker, next_marker in zip(markers, markers[1:] + [None]):
+        abstract_id = int(marker.group(1))
+        text = response[marker.end():next_marker.start() if next_marker else len(response)].strip()
+        if abstract_id in seen:
+            repeated.add(abstract_id)
+        seen.add(abstract_id)
+        if 1 <= abstract_id <= num_abstracts and text:
+            translations[abstract_id] = text
+    for abstract_id in repeated:
+        translations.pop(abstract_id, None)
+    return translations
+
+
+def _misaligned_translations(abstracts: list, translations: dict) -> set:
+    """
+    Find the translations whose length is out of line with the rest of the batch
+    Two abstracts merged under one id (or one split over two ids) show up as a translation much longer (or shorter)
+    than its abstract, compared with the length ratio of the other translations of the same reply.
+    :return: the ids of the suspicious translations
+    """
+    ratios = {i: len(text) / max(len(abstracts[i - 1]), 1) for i, text in translations.items()}
+    if len(ratios) < 3:
+        return set()
+    median = sorted(ratios.values())[len(ratios) // 2]
+    return set(i for i, ratio in ratios.items() if ratio > median * 1.8 or ratio < median / 1.8)
+
+
+def translate_abstracts_batch(abstracts: list, config: dict) -> list:
+    """
+    Translate a batch of abstracts using a single LLM request
+    Each abstract is numbered with a `<<<id>>>` line and the LLM is asked to put the same line before each translation.
+    If some ids are missing, repeated or their translation is misaligned, the unresolved abstracts are split in halves
+    and retried, down to the single-abstract prompt.
+    :param abstracts: the abstracts to translate
+    :param config: the configuration of LLM Server
+    :return: a list of translated abstracts (None if failed) in the same order as `abstracts`
+    """
+    if not abstracts:
+        return []
+    if len(abstracts) == 1:
+        return [translate_abstract(abstracts[0], config)]
+
+    abstract_list = '\n\n'.join('<<<{}>>>\n{}'.format(i + 1, abstract) for i, abstract in enumerate(abstracts))
+    prompt = f'请将下面 {len(abstracts)} 篇学术论文摘要分别翻译为中文：\n\n{abstract_list}'
+    response = get_llm_response(prompt, config, system=BATCH_TRANSLATION_SYSTEM_PROMPT)
+    if not response:
+        return [None] * len(abstracts)
+
+    translations = _parse_batch_translations(response, len(abstracts))
+    for i in _misaligned_translations(abstracts, translations):
+        del translations[i]
+    results = [translations.get(i + 1) for i in range(len(abstracts))]
+    missing = [i for i, text in enumerate(results) if text is None]
+    if missing:
+        # Re-split the unresolved part of the batch and retry
+        print('LLM returned {} of {} translations, retrying the rest in smaller batches.'.format(len(abstracts) - len(missing), len(abstracts)))
+        missing_abstracts = [abstracts[i] for i in missing]
+        half = (len(missing_abstracts) + 1) // 2
+        retried = translate_abstracts_batch(missing_abstracts[:half], config) + translate_abstracts_batch(missing_abstracts[half:], config)
+        for i, text in zip(missing, retried):
+            results[i] = text
+    return results
@@ -0,0 +1,170 @@
+"""
+Persistent cache of LLM responses
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM responses stored in SQLite
+    Entries are keyed by a hash of (model, base_url, prompt), so changing the model, the server or any part of
+    the prompt (e.g. `paper_to_hunt.md`) misses the cache automatically.
+    Hits only update the access times in memory, written in a single transaction every `FLUSH_EVERY` hits (and by
+    `flush`), and expired or least recently used entries are evicted on open and every `EVICT_EVERY` inserts, so a
+    warm run does not commit once per request.
+    """
+
+    FLUSH_EVERY = 256
+    EVICT_EVERY = 256
+
+    def __init__(self, file_path: str, ttl_days: float = 30, max_entries: int = 100000):
+        """
+        :param file_path: the file path of the SQLite database
+        :param ttl_days: the number of days an entry stays valid (0 or None to never expire)
+        :param max_entries: the maximum number of entries, the least recently used ones are evicted (0 or None for
+            unlimited), exceeded by at most `EVICT_EVERY` entries between evictions
+        """
+        self.file_path = file_path
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self.max_entries = max_entries or None
+        self.hits = 0
+        self.misses = 0
+        self._accessed = {}  # Access times of the hits not written yet
+        self._inserts = 0  # Inserts since the last eviction
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)')
+        with self._lock:
+            self._evict()
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, base_url: str, prompt: str) -> str:
+        """
+        Make the cache key of a request
+        :param model: the model name
+        :param base_url: the URL of LLM Server
+        :param prompt: the prompt
+        :return: the hex digest of the request
+        """
+        digest = hashlib.sha256()
+        for part in (model, base_url, prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Get a cached response
+        :param key: the cache key
+        :return: the cached response or None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if not row or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                # Expired entries are deleted by the next eviction
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= self.FLUSH_EVERY:
+                self._flush()
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        """
+        Store a response, evicting expired or least recently used entries every `EVICT_EVERY` inserts
+        :param key: the cache key
+        :param response: the response to store
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, response, now, now)
+            )
+            self._accessed.pop(key, None)
+            self._inserts += 1
+            if self._inserts >= self.EVICT_EVERY:
+                self._evict()
+            self._conn.commit()
+
+    def flush(self):
+        """
+        Write the access times of the hits, e.g. at the end of a run
+        """
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+
+    def _flush(self):
+        if self._accessed:
+            self._conn.executemany('UPDATE llm_cache SET accessed_at = ? WHERE key = ?',
+                                   [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+            self._accessed = {}
+
+    def _evict(self):
+        # The access times decide which entries are the least recently used
+        self._flush()
+        if self.ttl_seconds:
+            self._conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+        if self.max_entries:
+            self._conn.execute(
+                'DELETE FROM llm_cache WHERE key IN '
+                '(SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+        self._inserts = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+            self._conn.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_llm_cache(config: dict):
+    """
+    Get the shared LLM cache described by the configuration
+    :param config: the configuration, fields include `llm_cache_enabled`, `llm_cache_file`, `llm_cache_ttl_days`, `llm_cache_max_entries`
+    :return: the LLMCache or None if caching is disabled
+    """
+    if not config.get('llm_cache_enabled', False):
+        return None
+    file_path = config.get('llm_cache_file') or 'llm_cache.sqlite3'
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.path.dirname(__file__), file_path)
+    with _caches_lock:
+        if file_path not in _caches:
+            _caches[file_path] = LLMCache(
+                file_path,
+                ttl_days=config.get('llm_cache_ttl_days', 30),
+                max_entries=config.get('llm_cache_max_entries', 100000)
+            )
+        return _caches[file_path]
@@ -4,66 +4,337 @@ Main Script
 
 import os
 import datetime
-from arxiv_paper import get_latest_papers, deduplicate_papers_across_categories, filter_papers_by_keyword, filter_papers_using_llm, deduplicate_papers, prepend_to_json_file, translate_abstracts
-from lark_post import post_to_lark_webhook
-from utils import load_config
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from arxiv_paper import FetchWatermarks, iter_latest_papers
+from history import get_history_dir, get_paper_history
+from history_index import get_history_index
+from lark_post import post_to_lark_webhook, resend_outbox
+from pipeline import PageFanOut, run_pipeline, translate_papers
+from settings import get_profiles, load_config, load_paper_to_hunt
+from llm_cache import get_llm_cache
+from metrics import get_run_metrics, reset_run_metrics, write_run_report
+from checkpoint import get_run_lock, open_run_checkpoint
 
 
-# Load Configuration
-config = load_config()
-tag = config['tag']
-category_list = config['category_list']
-keyword_list = config['keyword_list']
-use_llm_for_filtering = config['use_llm_for_filtering']
-use_llm_for_translation = config['use_llm_for_translation']
-
 paper_file = os.path.join(os.path.dirname(__file__), 'papers.json')
-if use_llm_for_filtering:
-    with open(os.path.join(os.path.dirname(__file__), 'paper_to_hunt.md'), 'r', encoding='utf-8') as f:
-        paper_to_hunt = f.read()
 
 
-def task():
+def iter_pages(config: dict, category_list: list, watermarks=None):
     """
-    Main task: Fetch Papers & Post to Lark Webhook
+    Fetch the latest papers of the categories page by page
+    :param config: the configuration
+    :param category_list: the categories to fetch
+    :param watermarks: the FetchWatermarks (if incremental fetching is enabled)
+    :return: an iterator of lists of papers
     """
-    today_date = datetime.date.today().strftime('%Y-%m-%d')
-    print('Task: {}'.format(today_date))
+    max_results = config.get('max_results', 90)
+    if config.get('merged_category_query', False):
+        # A single `cat:A OR cat:B ...` query, cross-listed papers are fetched once
+        return iter_latest_papers(category_list, max_results=max_results, watermarks=watermarks, max_results_since_watermark=config.get('incremental_max_results', 2000))
+    return chain.from_iterable(
+        iter_latest_papers(category, max_results=max_results, watermarks=watermarks, max_results_since_watermark=config.get('incremental_max_results', 2000))
+        for category in category_list
+    )
 
-    papers = []
-    for category in category_list:
-        papers.extend(get_latest_papers(category, max_results=90))
-    print('Total papers: {}'.format(len(papers)))
 
-    # Deduplicate papers across categories
-    papers = deduplicate_papers_across_categories(papers)
-    print('Deduplicated papers across categories: {}'.format(len(papers)))
+def get_pages(config: dict, category_list: list, watermarks=None, checkpoint=None):
+    """
+    Get the pages of the run: replayed from the checkpoint if an interrupted run completed the fetch, fetched otherwise
+    """
+    if checkpoint is not None and checkpoint.fetch_complete:
+        if watermarks is not None and checkpoint.watermarks is not None:
+            watermarks.watermarks = checkpoint.watermarks
+        return iter(checkpoint.pages)
+    pages = iter_pages(config, category_list, watermarks)
+    if checkpoint is not None:
+        pages = checkpoint.record_pages(pages, watermarks)
+    return pages
 
-    if keyword_list:
-        papers = filter_papers_by_keyword(papers, keyword_list)
-    print('Filtered papers by Keyword: {}'.format(len(papers)))
 
-    if use_llm_for_filtering:
-        papers = filter_papers_using_llm(papers, paper_to_hunt, config)
-        print('Filtered papers by LLM: {}'.format(len(papers)))
-
-    papers = deduplicate_papers(papers, paper_file)
-    print('Deduplicated papers: {}'.format(len(papers)))
+def filter_pages(pages, config: dict, paper_to_hunt, history, use_llm_for_translation=None, checkpoint=None) -> list:
+    """
+    Run the pages through the filter (and translation) pipeline
+    :param pages: an iterator of lists of papers
+    :param config: the configuration
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :param history: the PaperHistory to deduplicate against
+    :param use_llm_for_translation: whether to translate the abstracts (default: `use_llm_for_translation`)
+    :param checkpoint: the RunCheckpoint (if any)
+    :return: the papers kept
+    """
+    use_llm_for_filtering = config['use_llm_for_filtering']
+    if use_llm_for_translation is None:
+        use_llm_for_translation = config['use_llm_for_translation']
 
+    # Papers flow through deduplication, keyword filter, LLM filter and translation as soon as each arXiv page lands
+    papers, stats = run_pipeline(
+        pages, config,
+        seen_ids=history.seen_ids,
+        paper_to_hunt=paper_to_hunt,
+        keyword_list=config['keyword_list'],
+        use_llm_for_filtering=use_llm_for_filtering,
+        use_llm_for_translation=use_llm_for_translation,
+        checkpoint=checkpoint
+    )
+    print('Total papers: {}'.format(stats['fetched']))
+    print('Deduplicated papers: {}'.format(stats['deduplicated']))
+    print('Filtered papers by Keyword: {}'.format(stats['keyword_filtered']))
+    if use_llm_for_filtering:
+        if config.get('use_relevance_prefilter', False):
+            print('Relevance pre-filter: {} accepted, {} uncertain, {} rejected'.format(
+                stats['prefilter_accepted'], stats['prefilter_uncertain'], stats['prefilter_rejected']))
+        print('Filtered papers by LLM: {}'.format(stats['llm_filtered']))
     if use_llm_for_translation:
-        papers = translate_abstracts(papers, config)
         print('Translated Abstracts into Chinese')
+    return papers
+
+
+def record_papers(config: dict, papers: list, history, checkpoint=None, export_file=None):
+    """
+    Append the papers of the run to the history (once, even if the run is resumed)
+    :param export_file: the file path of the legacy `papers.json` exported if `export_papers_json`
+    """
+    if checkpoint is not None and checkpoint.recorded:
+        return
+    index = get_history_index(config)
+    with get_run_metrics().stage('history'):
+        if index is not None:
+            # Papers recorded before the index existed (or by a run without it) are indexed untagged
+            index.sync(history)
+        if checkpoint is not None and checkpoint.resumed:
+            # The interrupted run may have stopped right after the append
+            history.append([paper for paper in papers if paper['id'] not in history.seen_ids])
+        else:
+            history.append(papers)
+        if index is not None:
+            index.sync(history, tag=config.get('tag'), recorded=datetime.date.today().isoformat())
+        if config.get('export_papers_json', False) and export_file:
+            history.export_json(export_file)
+    if checkpoint is not None:
+        checkpoint.mark_recorded()
+
+
+def save_watermarks(watermarks, checkpoint=None):
+    """
+    Move the watermarks forward, only once the papers are recorded
+    """
+    if watermarks is None:
+        return
+    if checkpoint is not None and checkpoint.watermarks is not None:
+        watermarks.watermarks = checkpoint.watermarks
+    watermarks.save()
+
+
+def finish_run(config: dict, metrics):
+    """
+    Print the cache and timing summary and write the run report
+    """
+    cache = get_llm_cache(config)
+    if cache is not None:
+        cache.flush()
+        print('LLM cache: {hits} hits, {misses} misses, {entries} entries'.format(**cache.stats()))
+    report = metrics.report()
+    print('Run time: {:.1f}s ({})'.format(
+        report['duration_seconds'], ', '.join('{} {:.1f}s'.format(stage, seconds) for stage, seconds in report['stages'].items())
+    ))
+    report_file = write_run_report(config, metrics)
+    if report_file:
+        print('Run report: {}'.format(report_file))
+
+
+def run_task(config: dict, paper_to_hunt=None, history=None):
+    """
+    Fetch Papers & Post to Lark Webhook with the given configuration
+    The finished work is checkpointed (see `checkpoint_enabled` in config.yaml), an interrupted run is resumed by the
+    next one without repeating the fetch, the LLM requests or the Lark messages already done.
+    :param config: the configuration
+    :param paper_to_hunt: the prompt describing the paper to hunt for (required if `use_llm_for_filtering`)
+    :param history: the PaperHistory (default: the one described by the configuration)
+    :return: the papers posted
+    """
+    history = history if history is not None else get_paper_history(config)
+    metrics = reset_run_metrics()
+    checkpoint = open_run_checkpoint(config, history.directory)
+
+    # With incremental fetching, only the papers newer than the watermark of each category are fetched
+    watermarks = None
+    if config.get('incremental_fetch', False):
+        watermarks = FetchWatermarks(os.path.join(history.directory, 'watermarks.json'), overlap_hours=config.get('incremental_overlap_hours', 24))
+
+    if checkpoint is not None and checkpoint.result is not None:
+        papers = checkpoint.result
+        print('Resumed {} papers kept by the interrupted run'.format(len(papers)))
+    else:
+        pages = get_pages(config, config['category_list'], watermarks, checkpoint)
+        papers = filter_pages(pages, config, paper_to_hunt, history, checkpoint=checkpoint)
+        if checkpoint is not None:
+            checkpoint.set_result(papers)
+
     # print(papers)
-    prepend_to_json_file(paper_file, papers)
+    record_papers(config, papers, history, checkpoint, export_file=paper_file)
+    save_watermarks(watermarks, checkpoint)
+
+    # Post to Lark Webhook, resending the messages left undelivered by previous runs first
+    with metrics.stage('lark_post'):
+        resend_outbox(config)
+        post_to_lark_webhook(config['tag'], papers, config, checkpoint=checkpoint)
+    if checkpoint is not None:
+        checkpoint.finish()
+
+    finish_run(config, metrics)
+    return papers
+
+
+def run_profiles(config: dict, profiles: list, histories=None) -> dict:
+    """
+    Run several profiles on a single fetch
+    The union of the categories of all profiles is fetched once. Each profile filters the shared pages as they arrive
+    (in its own thread) with its own categories, keywords and `paper_to_hunt`, against its own history, so only a few
+    pages are held in memory however long the fetch. The papers selected by any profile are translated
+    once (with the top-level LLM configuration), then each profile records and posts its papers with its own `tag`,
+    `webhook_url` and history.
+    :param config: the top-level configuration (fetch, LLM Server and translation)
+    :param profiles: the profile configurations (see `get_profiles`)
+    :param histories: a dict of the PaperHistory by directory, filled and reused across runs (e.g. by the daemon)
+    :return: the papers posted by profile name
+    """
+    metrics = reset_run_metrics()
+    histories = histories if histories is not None else {}
+    shared_dir = get_history_dir(config)
+    os.makedirs(shared_dir, exist_ok=True)
+    checkpoint = open_run_checkpoint(config, shared_dir)
+
+    watermarks = None
+    if config.get('incremental_fetch', False):
+        watermarks = FetchWatermarks(os.path.join(shared_dir, 'watermarks.json'), overlap_hours=config.get('incremental_overlap_hours', 24))
+
+    runs = []
+    for profile in profiles:
+        profile_dir = get_history_dir(profile)
+        if profile_dir not in histories:
+            histories[profile_dir] = get_paper_history(profile, migrate_legacy=False)
+        profile_history = histories[profile_dir]
+        profile_checkpoint = open_run_checkpoint(profile, profile_history.directory)
+        papers = None
+        if profile_checkpoint is not None and profile_checkpoint.result is not None:
+            papers = profile_checkpoint.result
+            print('Profile {}: resumed {} papers kept by the interrupted run'.format(profile['name'], len(papers)))
+        runs.append([profile, profile_history, profile_checkpoint, papers])
+    # Fail on a missing `paper_to_hunt_file` before fetching anything
+    paper_to_hunts = [load_paper_to_hunt(profile) if profile['use_llm_for_filtering'] and papers is None else None
+                      for profile, _, _, papers in runs]
+
+    def filter_profile(run, paper_to_hunt, fan_out, consumer, pages):
+        profile, profile_history, profile_checkpoint, _ = run
+        try:
+            categories = set(profile['category_list'])
+            profile_pages = ([paper for paper in page if categories.intersection(paper['categories'])] for page in pages)
+            papers = filter_pages(profile_pages, profile, paper_to_hunt, profile_history,
+                                  use_llm_for_translation=False, checkpoint=profile_checkpoint)
+        finally:
+            # A failed profile must not hold the fetch of the others
+            fan_out.close(consumer)
+        print('Profile {}: {} papers kept'.format(profile['name'], len(papers)))
+        if not profile['use_llm_for_translation']:
+            # Papers are shared between profiles, keep this profile's copies untranslated
+            papers = [paper.copy() for paper in papers]
+        run[3] = papers
 
-    # Post to Lark Webhook
-    post_to_lark_webhook(tag, papers, config)
+    # Fetch the union of the categories once, every profile filters the pages as they arrive (in its own thread)
+    to_filter = [(run, paper_to_hunt) for run, paper_to_hunt in zip(runs, paper_to_hunts) if run[3] is None]
+    failed = {}
+    if to_filter:
+        category_list = list(dict.fromkeys(category for profile in profiles for category in profile['category_list']))
+        fetched = [0]
+
+        def count_pages(pages):
+            for page in pages:
+                fetched[0] += len(page)
+                yield page
+
+        pages = count_pages(get_pages(config, category_list, watermarks, checkpoint))
+        fan_out = PageFanOut(pages, len(to_filter))
+        with ThreadPoolExecutor(max_workers=len(to_filter)) as executor:
+            futures = [executor.submit(filter_profile, run, paper_to_hunt, fan_out, consumer, branch)
+                       for consumer, ((run, paper_to_hunt), branch) in enumerate(zip(to_filter, fan_out.branches()))]
+            for (run, _), future in zip(to_filter, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print('Profile {} failed: {}'.format(run[0]['name'], e))
+                    failed[run[0]['name']] = e
+        print('Fetched {} papers of {} categories for {} profiles'.format(fetched[0], len(category_list), len(to_filter)))
+        # The other profiles are recorded and posted, the failed ones run again from the checkpoint
+        runs = [run for run in runs if run[0]['name'] not in failed]
+
+    # Translate every selected paper once, whichever profiles selected it
+    to_translate = {}
+    for profile, _, profile_checkpoint, papers in runs:
+        if profile['use_llm_for_translation'] and (profile_checkpoint is None or profile_checkpoint.result is None):
+            for paper in papers:
+                to_translate.setdefault(paper['id'], paper)
+    if to_translate:
+        translate_papers(list(to_translate.values()), config, checkpoint)
+        print('Translated {} unique abstracts into Chinese'.format(len(to_translate)))
+
+    for profile, profile_history, profile_checkpoint, papers in runs:
+        if profile_checkpoint is not None and profile_checkpoint.result is None:
+            profile_checkpoint.set_result(papers)
+        record_papers(profile, papers, profile_history, profile_checkpoint,
+                      export_file=os.path.join(profile_history.directory, 'papers.json'))
+    if not failed:
+        save_watermarks(watermarks, checkpoint)
+
+    # Post to the Lark Webhook of each profile, resending the messages left undelivered by previous runs first
+    results = {}
+    with metrics.stage('lark_post'):
+        resend_outbox(config)
+        for profile, _, profile_checkpoint, papers in runs:
+            print('Posting {} papers of profile {}'.format(len(papers), profile['name']))
+            post_to_lark_webhook(profile['tag'], papers, profile, checkpoint=profile_checkpoint)
+            if profile_checkpoint is not None:
+                profile_checkpoint.finish()
+            results[profile['name']] = papers
+    if failed:
+        # The fetch is kept in the checkpoint for the next run of the failed profiles
+        finish_run(config, metrics)
+        raise RuntimeError('Profiles failed: {}'.format(', '.join(failed))) from next(iter(failed.values()))
+    if checkpoint is not None:
+        checkpoint.finish()
+
+    finish_run(config, metrics)
+    return results
+
+
+def task(config=None):
+    """
+    Main task: Fetch Papers & Post to Lark Webhook
+    :param config: the configuration (default: loaded from `config.yaml`)
+    """
+    config = config if config is not None else load_config()
+    today_date = datetime.date.today().strftime('%Y-%m-%d')
+    print('Task: {}'.format(today_date))
+    # A run started by the scheduler while another one (e.g. the daemon's) is in progress is skipped
+    lock = get_run_lock(config)
+    if not lock.acquire():
+        print('Another run is in progress, skipping')
+        return
+    try:
+        profiles = get_profiles(config)
+        if profiles:
+            run_profiles(config, profiles)
+        else:
+            run_task(config, load_paper_to_hunt(config) if config['use_llm_for_filtering'] else None)
+    finally:
+        lock.release()
 
 
 if __name__ == '__main__':
     # Run the task immediately
     task()
 
+    # Run `python daemon.py` instead to keep running and fetch after each arXiv announcement (see README)
     ### Uncomment the following code to use `schedule` to run the task periodically ###
     # import time
     # import schedule
@@ -0,0 +1,256 @@
+"""
+Run Metrics: Stage Timings, Counters & LLM Usage
+"""
+
+import os
+import re
+import json
+import math
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+
+def percentile(values: list, q: float):
+    """
+    Get the q-th percentile (nearest rank) of the values
+    :param values: a sorted list of numbers
+    :param q: the percentile in [0, 100]
+    :return: the percentile or None if there is no value
+    """
+    if not values:
+        return None
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def cached_prompt_tokens(usage: dict):
+    """
+    Get the number of prompt tokens served from the prefix cache of the server
+    :param usage: the `usage` field of the response, `prompt_tokens_details.cached_tokens` (OpenAI, vLLM) or
+        `prompt_cache_hit_tokens` (DeepSeek)
+    :return: the number of tokens or None if the server does not report it
+    """
+    details = usage.get('prompt_tokens_details') or {}
+    if isinstance(details, dict) and details.get('cached_tokens') is not None:
+        return int(details['cached_tokens'])
+    if usage.get('prompt_cache_hit_tokens') is not None:
+        return int(usage['prompt_cache_hit_tokens'])
+    return None
+
+
+class RunMetrics:
+    """
+    Thread-safe collector of the metrics of a run
+    - stages: seconds spent in each stage. Stages running in worker threads (LLM filter, translation) add up the time
+      of every worker, so they can exceed the wall time of the run.
+    - counters: numbers such as arXiv pages fetched, seconds slept for the arXiv politeness delay, Lark batches sent
+    - llm: calls, failures, retries, cache hits, latencies and tokens (from the response `usage`) per backend, including
+      the prompt tokens served from the prefix cache of the server (if it reports them)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = datetime.datetime.now().astimezone()
+        self._start = time.monotonic()
+        self.stages = {}
+        self.counters = {}
+        self.llm = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a block of code as (part of) a stage
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def increment(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_llm_call(self, backend: str, latency: float, ok: bool, attempts=1, usage=None, cached=False):
+        """
+        Record an LLM call
+        :param backend: the name of the LLM backend (model @ base_url)
+        :param latency: the latency of the call in seconds, including retries
+        :param ok: whether the call returned a response
+        :param attempts: the number of HTTP requests made (0 for a cache hit)
+        :param usage: the `usage` field of the response (if any)
+        :param cached: whether the response came from the LLM cache
+        """
+        with self._lock:
+            stats = self.llm.get(backend)
+            if stats is None:
+                stats = self.llm[backend] = {
+                    'calls': 0, 'failures': 0, 'requests': 0, 'retries': 0, 'cache_hits': 0,
+                    'prompt_tokens': 0, 'completion_tokens': 0, 'cached_prompt_tokens': 0, 'prefix_cache_hits': 0,
+                    'prefix_cache_reported': 0, 'latencies': []
+                }
+            stats['calls'] += 1
+            stats['failures'] += 0 if ok else 1
+            stats['requests'] += attempts
+            stats['retries'] += max(attempts - 1, 0)
+            stats['cache_hits'] += 1 if cached else 0
+            if usage:
+                stats['prompt_tokens'] += int(usage.get('prompt_tokens') or 0)
+                stats['completion_tokens'] += int(usage.get('completion_tokens') or 0)
+                cached_tokens = cached_prompt_tokens(usage)
+                if cached_tokens is not None:
+                    stats['cached_prompt_tokens'] += cached_tokens
+                    stats['prefix_cache_hits'] += 1 if cached_tokens else 0
+                    stats['prefix_cache_reported'] += 1
+            if not cached:
+                stats['latencies'].append(latency)
+
+    def report(self) -> dict:
+        """
+        Get the run report
+        :return: a JSON-serializable dict
+        """
+        with self._lock:
+            llm = {}
+            for backend, stats in self.llm.items():
+                latencies = sorted(stats['latencies'])
+                llm[backend] = {key: value for key, value in stats.items() if key != 'latencies'}
+                llm[backend]['latency_seconds'] = {
+                    'mean': sum(latencies) / len(latencies) if latencies else None,
+                    'p50': percentile(latencies, 50),
+                    'p90': percentile(latencies, 90),
+                    'p99': percentile(latencies, 99),
+                    'max': latencies[-1] if latencies else None,
+                }
+                # Share of the prompt tokens served from the prefix cache, over the calls which report it
+                llm[backend]['prefix_cache_hit_ratio'] = (
+                    stats['cached_prompt_tokens'] / stats['prompt_tokens']
+                    if stats['prefix_cache_reported'] and stats['prompt_tokens'] else None
+                )
+            return {
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'duration_seconds': time.monotonic() - self._start,
+                'stages': dict(self.stages),
+                'counters': dict(self.counters),
+                'llm': llm,
+            }
+
+    def write_report(self, file_path: str) -> dict:
+        """
+        Write the run report as JSON
+        :param file_path: the file path of the report
+        :return: the report
+        """
+        report = self.report()
+        _write_atomic(file_path, json.dumps(report, indent=4, ensure_ascii=False))
+        return report
+
+    def write_prometheus(self, file_path: str, prefix='arxiv_today'):
+        """
+        Write the run report in the Prometheus text format, for the node_exporter textfile collector
+        :param file_path: the file path of the `.prom` file
+        :param prefix: the prefix of the metric names
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, help_text, metric_type, samples):
+            name = prefix + '_' + name
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ','.join('{}="{}"'.format(key, _escape_label(str(label))) for key, label in labels.items())
+                lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', _format_value(value)))
+
+        metric('run_start_timestamp_seconds', 'Start time of the last run.', 'gauge', [({}, self.started_at.timestamp())])
+        metric('run_duration_seconds', 'Wall time of the last run.', 'gauge', [({}, report['duration_seconds'])])
+        metric('stage_seconds', 'Seconds spent in each stage of the last run (summed over workers).', 'gauge',
+               [({'stage': stage}, seconds) for stage, seconds in report['stages'].items()])
+        for name, value in report['counters'].items():
+            metric(_sanitize_name(name), 'Counter `{}` of the last run.'.format(name), 'gauge', [({}, value)])
+        backends = report['llm']
+        for key, help_text in (('calls', 'LLM calls'), ('failures', 'LLM calls which returned no response'),
+                               ('requests', 'HTTP requests to the LLM server'), ('retries', 'Retried LLM requests'),
+                               ('cache_hits', 'LLM calls answered by the cache'),
+                               ('prompt_tokens', 'Prompt tokens reported by the LLM server'),
+                               ('completion_tokens', 'Completion tokens reported by the LLM server'),
+                               ('cached_prompt_tokens', 'Prompt tokens served from the prefix cache of the LLM server'),
+                               ('prefix_cache_hits', 'LLM requests which hit the prefix cache of the LLM server')):
+            metric('llm_' + key, help_text + ' in the last run.', 'gauge',
+                   [({'backend': backend}, stats[key]) for backend, stats in backends.items()])
+        metric('llm_latency_seconds', 'Latency percentiles of the LLM calls in the last run.', 'gauge', [
+            ({'backend': backend, 'quantile': quantile}, stats['latency_seconds'][key])
+            for backend, stats in backends.items()
+            for quantile, key in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'), ('1', 'max'))
+        ])
+        _write_atomic(file_path, '\n'.join(lines) + '\n')
+
+
+def _sanitize_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _write_atomic(file_path: str, text: str):
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = file_path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    # The textfile collector may read at any time, never expose a partial file
+    os.replace(tmp_file, file_path)
+
+
+_run_metrics = RunMetrics()
+
+
+def get_run_metrics() -> RunMetrics:
+    """
+    Get the metrics of the current run
+    """
+    return _run_metrics
+
+
+def reset_run_metrics() -> RunMetrics:
+    """
+    Start collecting the metrics of a new run
+    """
+    global _run_metrics
+    _run_metrics = RunMetrics()
+    return _run_metrics
+
+
+def write_run_report(config: dict, metrics=None):
+    """
+    Write the run report and the Prometheus textfile described by the configuration
+    :param config: the configuration, fields include `run_report_dir` and `prometheus_textfile`
+    :param metrics: the RunMetrics (default: the current run)
+    :return: the file path of the report or None if disabled
+    """
+    metrics = metrics or get_run_metrics()
+    file_path = None
+    directory = config.get('run_report_dir')
+    if directory:
+        if not os.path.isabs(directory):
+            directory = os.path.join(os.path.dirname(__file__), directory)
+        file_path = os.path.join(directory, '{:%Y-%m-%d_%H%M%S}.json'.format(metrics.started_at))
+        metrics.write_report(file_path)
+    if config.get('prometheus_textfile'):
+        metrics.write_prometheus(config['prometheus_textfile'])
+    return file_path
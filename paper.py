@@ -0,0 +1,205 @@
+"""
+Paper Record & Fast JSON (De)Serialization
+"""
+
+import json
+from collections.abc import Mapping, MutableMapping
+
+try:
+    import orjson
+except ImportError:  # Optional, 5-10x faster than the standard library
+    orjson = None
+try:
+    import msgspec
+except ImportError:  # Optional, used if orjson is not installed
+    msgspec = None
+
+
+# Bump when a field is added, renamed or changes meaning, and convert the older records in `Paper.from_dict`.
+# The version is written in the header line of each history segment (see `schema_header`).
+SCHEMA_VERSION = 1
+FIELDS = ('title', 'id', 'abstract', 'url', 'published', 'comment', 'categories', 'zh_abstract')
+_FIELD_SET = frozenset(FIELDS)
+_MISSING = object()
+
+
+class Paper(MutableMapping):
+    """
+    Compact record of a paper, with the interface of the dict it replaces (`paper['title']`, `get`, `in`, `items`...)
+    The fields of the schema are kept in slots, without a hash table per record; other keys (if any) go into `extra`.
+    A field is missing until it is set (e.g. `zh_abstract` until the abstract is translated), so a Paper serializes to
+    the same JSON object as the dict did, and compares equal to it.
+    """
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data: Mapping, version=SCHEMA_VERSION) -> 'Paper':
+        """
+        Make a Paper from a dict (e.g. a parsed JSON line of the history), a Paper is returned as is
+        :param data: the record
+        :param version: the schema version the record was written with
+        :raise ValueError: if the schema version is unknown
+        """
+        check_schema_version(version)
+        if isinstance(data, Paper):
+            return data
+        paper = cls.__new__(cls)
+        paper.extra = None
+        for key, value in data.items():
+            if key in _FIELD_SET:
+                setattr(paper, key, value)
+            else:
+                if paper.extra is None:
+                    paper.extra = {}
+                paper.extra[key] = value
+        return paper
+
+    def to_dict(self) -> dict:
+        data = {}
+        for key in FIELDS:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                data[key] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def copy(self) -> 'Paper':
+        """
+        Shallow copy, like `dict.copy`
+        """
+        return Paper.from_dict(self.to_dict())
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for key in FIELDS if hasattr(self, key)) + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self):
+        return 'Paper({!r})'.format(self.to_dict())
+
+    # Pickling (slots without __dict__), e.g. for process pools
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.extra = None
+        for key, value in state.items():
+            self[key] = value
+
+
+def check_schema_version(version):
+    """
+    Check that records written with a schema version can be read
+    :raise ValueError: if the version is unknown (e.g. written by a newer release)
+    """
+    if version != SCHEMA_VERSION:
+        raise ValueError('Unknown paper schema version {!r} (supported: {})'.format(version, SCHEMA_VERSION))
+
+
+def schema_header() -> dict:
+    """
+    The header record of a file of papers, giving the schema version of the records after it
+    """
+    return {'schema_version': SCHEMA_VERSION}
+
+
+def read_schema_header(record):
+    """
+    Get the schema version of a header record
+    :return: the schema version or None if the record is not a header
+    """
+    if isinstance(record, dict) and 'schema_version' in record and 'id' not in record:
+        return record['schema_version']
+    return None
+
+
+def _default(obj):
+    if isinstance(obj, Paper):
+        return obj.to_dict()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def dumps(obj, indent=False) -> str:
+    """
+    Serialize JSON data (which may contain Papers), keeping non-ASCII characters as is
+    Uses orjson or msgspec if installed, the standard library otherwise.
+    :param obj: the data
+    :param indent: whether to indent the output (2 spaces with orjson, 4 otherwise)
+    :return: the JSON text
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+    if msgspec is not None and not indent:
+        return msgspec.json.encode(obj, enc_hook=_default).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, indent=4 if indent else None, default=_default)
+
+
+def loads(text):
+    """
+    Parse JSON text (str or bytes) into plain Python data
+    :raise ValueError: if the text is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    if msgspec is not None:
+        try:
+            return msgspec.json.decode(text)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+    return json.loads(text)
+
+
+def loads_papers(text, version=SCHEMA_VERSION) -> list:
+    """
+    Parse a JSON list of papers into Papers
+    :param version: the schema version the papers were written with
+    :raise ValueError: if the text is not valid JSON or the schema version is unknown
+    """
+    check_schema_version(version)
+    return [Paper.from_dict(paper, version) for paper in loads(text)]
@@ -0,0 +1,258 @@
+"""
+Streaming Pipeline: Fetch, Filter & Translate
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from arxiv_paper import filter_papers_by_keyword, translate_abstracts
+from llm import are_papers_match
+from metrics import get_run_metrics
+from relevance import prefilter_papers
+from utils import get_llm_concurrency, map_concurrently
+
+
+def _process_chunk(chunk: list, paper_to_hunt: str, config: dict, use_llm_for_filtering: bool, use_llm_for_translation: bool,
+                   checkpoint=None):
+    """
+    Filter (by LLM) and translate a chunk of papers
+    :param chunk: a list of (paper, whether the paper needs the LLM filter)
+    :param checkpoint: the RunCheckpoint, verdicts and translations recorded by an interrupted run are reused
+    :return: the papers kept, in the same order as `chunk`
+    """
+    metrics = get_run_metrics()
+    verdicts = checkpoint.verdicts if checkpoint is not None else {}
+    to_check = [paper for paper, needs_llm in chunk if needs_llm and paper['id'] not in verdicts]
+    if use_llm_for_filtering and to_check:
+        with metrics.stage('llm_filter'):
+            new_verdicts = dict(zip((paper['id'] for paper in to_check), are_papers_match(to_check, paper_to_hunt, config)))
+        if checkpoint is not None:
+            checkpoint.add_verdicts(new_verdicts)
+        verdicts = dict(verdicts, **new_verdicts)
+    papers = [paper for paper, needs_llm in chunk if not (needs_llm and use_llm_for_filtering) or verdicts[paper['id']]]
+    if use_llm_for_translation and papers:
+        _translate_chunk(papers, config, checkpoint)
+    return papers
+
+
+def _translate_chunk(papers: list, config: dict, checkpoint=None):
+    """
+    Translate the abstracts of a chunk of papers, reusing the translations recorded in the checkpoint (if any)
+    The requests of a chunk are sent one by one, as the chunks themselves are translated concurrently.
+    """
+    with get_run_metrics().stage('translate'):
+        if checkpoint is None:
+            translate_abstracts(papers, config, progress=False, max_concurrency=1)
+            return
+        to_translate = []
+        for paper in papers:
+            if paper['id'] in checkpoint.translations:
+                paper['zh_abstract'] = checkpoint.translations[paper['id']]
+            else:
+                to_translate.append(paper)
+        translate_abstracts(to_translate, config, progress=False, max_concurrency=1)
+        for paper in to_translate:
+            checkpoint.add_translation(paper['id'], paper['zh_abstract'])
+
+
+def translate_papers(papers: list, config: dict, checkpoint=None) -> list:
+    """
+    Translate the abstracts of papers with up to `llm_max_concurrency` requests in flight
+    Each request translates `llm_translate_batch_size` papers, recorded in the checkpoint as soon as it is done.
+    :param papers: a list of papers, `zh_abstract` is set in place
+    :param config: the configuration
+    :param checkpoint: the RunCheckpoint recording the translations (if any)
+    :return: the papers
+    """
+    max_concurrency, _ = get_llm_concurrency(config)
+    batch_size = max(int(config.get('llm_translate_batch_size') or 1), 1)
+    batches = [papers[start:start + batch_size] for start in range(0, len(papers), batch_size)]
+    map_concurrently(lambda batch: _translate_chunk(batch, config, checkpoint), batches, max_concurrency=max_concurrency)
+    return papers
+
+
+def run_pipeline(pages, config: dict, seen_ids=(), paper_to_hunt=None, keyword_list=None,
+                 use_llm_for_filtering=False, use_llm_for_translation=False, checkpoint=None):
+    """
+    Run the fetch, filter and translation stages as a streaming pipeline
+    Each page of papers is deduplicated and filtered by keyword as soon as it arrives, then handed to a pool of
+    workers which filter it by LLM and translate it, while the next page is being fetched. With the relevance pre-filter,
+    the papers passing the keyword filter are scored together once the last page is fetched (as the scores depend on
+    the papers scored together), then handed to the workers. The result is only materialized at the end, for the
+    history and the Lark post.
+    :param pages: an iterator of lists of papers (see `arxiv_paper.iter_latest_papers`)
+    :param config: the configuration
+    :param seen_ids: the ids of the papers sent before (e.g. `PaperHistory.seen_ids`)
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :param keyword_list: a list of keywords (or a compiled KeywordMatcher), no keyword filtering if empty
+    :param use_llm_for_filtering: whether to filter papers using LLM
+    :param use_llm_for_translation: whether to translate the abstracts using LLM
+    :param checkpoint: the RunCheckpoint recording the verdicts and translations (if any)
+    :return: (the papers kept in fetch order, the counters of each stage)
+    """
+    stats = {'fetched': 0, 'deduplicated': 0, 'keyword_filtered': 0, 'prefilter_accepted': 0,
+             'prefilter_uncertain': 0, 'prefilter_rejected': 0, 'llm_filtered': 0}
+    max_concurrency, _ = get_llm_concurrency(config)
+    chunk_size = max(int(config.get('llm_filter_batch_size') or 1), 1)
+    use_prefilter = use_llm_for_filtering and config.get('use_relevance_prefilter', False)
+
+    metrics = get_run_metrics()
+    fetched_ids = set()
+    prefilter_buffer = []
+    futures = []
+    pages = iter(pages)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        def submit(papers, needs_llm):
+            chunk = list(zip(papers, needs_llm))
+            for start in range(0, len(chunk), chunk_size):
+                futures.append(executor.submit(
+                    _process_chunk, chunk[start:start + chunk_size], paper_to_hunt, config,
+                    use_llm_for_filtering, use_llm_for_translation, checkpoint
+                ))
+
+        while True:
+            # Time spent waiting for arXiv (download and politeness delay), the other stages overlap with it
+            start = time.monotonic()
+            page = next(pages, None)
+            metrics.add_time('fetch', time.monotonic() - start)
+            if page is None:
+                break
+            stats['fetched'] += len(page)
+            # Deduplicate across categories and against the history before spending any LLM request
+            new_papers = []
+            for paper in page:
+                if paper['id'] not in fetched_ids and paper['id'] not in seen_ids:
+                    fetched_ids.add(paper['id'])
+                    new_papers.append(paper)
+            page = new_papers
+            stats['deduplicated'] += len(page)
+
+            if keyword_list:
+                with metrics.stage('keyword_filter'):
+                    page = filter_papers_by_keyword(page, keyword_list)
+            stats['keyword_filtered'] += len(page)
+
+            if use_prefilter:
+                # The IDF of the relevance scores is estimated on the papers scored together, so that a paper gets the
+                # same score however the papers are paged, the pre-filter waits for the last page
+                prefilter_buffer.extend(page)
+            else:
+                submit(page, [True] * len(page))
+
+        if prefilter_buffer:
+            with metrics.stage('relevance_prefilter'):
+                accepted, uncertain, rejected = prefilter_papers(prefilter_buffer, paper_to_hunt, config)
+            stats['prefilter_accepted'] += len(accepted)
+            stats['prefilter_uncertain'] += len(uncertain)
+            stats['prefilter_rejected'] += len(rejected)
+            accepted_ids = set(paper['id'] for paper in accepted)
+            rejected_ids = set(paper['id'] for paper in rejected)
+            papers = [paper for paper in prefilter_buffer if paper['id'] not in rejected_ids]
+            submit(papers, [paper['id'] not in accepted_ids for paper in papers])
+
+        papers = [paper for future in futures for paper in future.result()]
+    stats['llm_filtered'] = len(papers)
+    for key, value in stats.items():
+        metrics.increment('papers_' + key, value)
+    return papers, stats
+
+
+_END = object()
+
+
+class PageFanOut:
+    """
+    Share an iterator of pages between consumers running in their own threads (a thread-safe `itertools.tee`)
+    A page is read from the source when the first consumer asks for it, and dropped once every consumer has read it.
+    A consumer more than `max_pending` pages ahead of the slowest one waits, so at most `max_pending` pages are held
+    in memory however long the fetch. An error of the source is raised in every consumer. A consumer which stops early
+    (e.g. fails) must `close` its branch, otherwise the others wait for it.
+    """
+
+    def __init__(self, pages, count: int, max_pending=2):
+        """
+        :param pages: an iterator of lists of papers
+        :param count: the number of consumers
+        :param max_pending: the maximum number of pages between the fastest and the slowest consumer
+        """
+        self._pages = iter(pages)
+        self.max_pending = max(int(max_pending), 1)
+        self._buffer = deque()
+        self._offset = 0  # Position of the first page in the buffer
+        self._positions = [0] * count
+        self._active = [True] * count
+        self._reading = False
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def branches(self) -> list:
+        """
+        Get the iterator of each consumer
+        """
+        return [self._iter(consumer) for consumer in range(len(self._positions))]
+
+    def close(self, consumer: int):
+        """
+        Stop reading the pages for a consumer, the others no longer wait for it
+        """
+        with self._condition:
+            self._active[consumer] = False
+            self._trim()
+
+    def _iter(self, consumer: int):
+        try:
+            while True:
+                page = self._next(consumer)
+                if page is _END:
+                    return
+                yield page
+        finally:
+            self.close(consumer)
+
+    def _slowest(self) -> int:
+        return min((position for position, active in zip(self._positions, self._active) if active), default=0)
+
+    def _trim(self):
+        # Drop the pages read by every active consumer
+        while self._buffer and self._offset < self._slowest():
+            self._buffer.popleft()
+            self._offset += 1
+        self._condition.notify_all()
+
+    def _next(self, consumer: int):
+        while True:
+            with self._condition:
+                while True:
+                    position = self._positions[consumer]
+                    if position < self._offset + len(self._buffer):
+                        self._positions[consumer] += 1
+                        page = self._buffer[position - self._offset]
+                        self._trim()
+                        return page
+                    if self._error is not None:
+                        raise self._error
+                    if self._done:
+                        return _END
+                    if not self._reading and position - self._slowest() < self.max_pending:
+                        # The next page is read outside the lock, the other consumers keep reading the buffer
+                        self._reading = True
+                        break
+                    self._condition.wait()
+            try:
+                page = next(self._pages, _END)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._reading = False
+                    self._condition.notify_all()
+                raise
+            with self._condition:
+                self._reading = False
+                if page is _END:
+                    self._done = True
+                else:
+                    self._buffer.append(page)
+                self._condition.notify_all()
@@ -0,0 +1,99 @@
+"""
+Local Relevance Pre-Filter
+"""
+
+import re
+from itertools import chain
+from collections import defaultdict
+import numpy as np
+
+STOPWORDS = set((
+    'a an the of and or in on for to with by from as at is are was were be been being this that these those we our '
+    'it its their they which who whom can could may might will would should also than then there here such into '
+    'over under via using use used based new show shows propose proposed paper approach method methods results '
+    'model models however while both each more most other some not no only two one first'
+).split())
+
+WORD_PATTERN = re.compile(r'[a-z][a-z0-9\-]+')
+CJK_PATTERN = re.compile(r'[一-鿿]+')
+
+
+def tokenize(text: str) -> list:
+    """
+    Split text into features: English words, English word bigrams and Chinese character bigrams
+    :param text: the text
+    :return: a list of features
+    """
+    text = text.lower()
+    words = [word for word in WORD_PATTERN.findall(text) if word not in STOPWORDS]
+    features = words + list(map(' '.join, zip(words, words[1:])))
+    for run in CJK_PATTERN.findall(text):
+        features.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return features
+
+
+def score_papers(papers: list, paper_to_hunt: str) -> np.ndarray:
+    """
+    Score the similarity between each paper (title + abstract) and `paper_to_hunt`
+    Features are mapped into a sparse TF-IDF space (IDF estimated on the batch itself), and the cosine similarity of
+    all papers is computed at once with vectorized NumPy operations.
+    :param papers: a list of papers
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :return: an array of cosine similarities in [0, 1], in the same order as `papers`
+    """
+    num_papers = len(papers)
+    if num_papers == 0:
+        return np.zeros(0)
+
+    # Flatten the features of all papers into (paper index, feature id) pairs
+    vocabulary = defaultdict()
+    vocabulary.default_factory = vocabulary.__len__  # Unseen features get the next id
+    feature_ids = [list(map(vocabulary.__getitem__, tokenize(paper['title'] + ' ' + paper['abstract']))) for paper in papers]
+    query_id = np.unique(np.fromiter(map(vocabulary.__getitem__, tokenize(paper_to_hunt)), dtype=np.int64))
+    vocabulary_size = max(len(vocabulary), 1)
+    lengths = np.fromiter(map(len, feature_ids), dtype=np.int64, count=num_papers)
+    doc_index = np.repeat(np.arange(num_papers, dtype=np.int64), lengths)
+    feature_id = np.fromiter(chain.from_iterable(feature_ids), dtype=np.int64, count=int(lengths.sum()))
+
+    # Term frequencies per (paper, feature)
+    keys, tf = np.unique(doc_index * vocabulary_size + feature_id, return_counts=True)
+    pair_doc, pair_feature = keys // vocabulary_size, keys % vocabulary_size
+
+    # Smoothed IDF over the batch, with `paper_to_hunt` (binary term frequency) counted as one more document
+    df = np.bincount(pair_feature, minlength=vocabulary_size)
+    df[query_id] += 1
+    idf = np.log((num_papers + 2) / (df + 1)) + 1
+
+    doc_weight = (1 + np.log(tf)) * idf[pair_feature]
+    query_weight = np.zeros(vocabulary_size)
+    query_weight[query_id] = idf[query_id]
+
+    # Cosine similarity between every paper and `paper_to_hunt`
+    dot = np.bincount(pair_doc, weights=doc_weight * query_weight[pair_feature], minlength=num_papers)
+    doc_norm = np.sqrt(np.bincount(pair_doc, weights=doc_weight ** 2, minlength=num_papers))
+    query_norm = np.sqrt(np.sum(query_weight ** 2))
+    denominator = doc_norm * query_norm
+    scores = np.divide(dot, denominator, out=np.zeros(num_papers), where=denominator > 0)
+    return scores
+
+
+def prefilter_papers(papers: list, paper_to_hunt: str, config: dict):
+    """
+    Split papers into clear accepts, uncertain papers and clear rejects by their local relevance score
+    :param papers: a list of papers
+    :param paper_to_hunt: the prompt describing the paper to hunt for
+    :param config: the configuration, fields include `prefilter_reject_below` and `prefilter_accept_above`
+    :return: (accepted papers, uncertain papers, rejected papers), each keeping the input order
+    """
+    reject_below = float(config.get('prefilter_reject_below', 0.0))
+    accept_above = float(config.get('prefilter_accept_above', 1.0))
+    scores = score_papers(papers, paper_to_hunt)
+    accepted, uncertain, rejected = [], [], []
+    for paper, score in zip(papers, scores):
+        if score >= accept_above:
+            accepted.append(paper)
+        elif score < reject_below:
+            rejected.append(paper)
+        else:
+            uncertain.append(paper)
+    return accepted, uncertain, rejected
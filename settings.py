@@ -0,0 +1,75 @@
+"""
+Configuration: config.yaml, Profiles & paper_to_hunt
+"""
+
+import os
+import re
+import yaml
+from history import get_history_dir
+
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.yaml')
+
+
+def load_config(file_path=None):
+    yaml_file = file_path or CONFIG_FILE
+    with open(yaml_file, 'r', encoding='utf-8') as file:
+        return yaml.safe_load(file)
+
+
+def get_paper_to_hunt_file(config: dict) -> str:
+    """
+    Get the absolute path of the file describing the paper to hunt for
+    :param config: the configuration, fields include `paper_to_hunt_file` (default: `paper_to_hunt.md`)
+    """
+    file_path = config.get('paper_to_hunt_file') or 'paper_to_hunt.md'
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.path.dirname(__file__), file_path)
+    return file_path
+
+
+def load_paper_to_hunt(config: dict) -> str:
+    """
+    Load the prompt describing the paper to hunt for
+    :param config: the configuration, fields include `paper_to_hunt_file` (default: `paper_to_hunt.md`)
+    """
+    with open(get_paper_to_hunt_file(config), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def get_history_index_file(config: dict) -> str:
+    """
+    Get the file path of the full-text index of the paper history, shared by the profiles
+    :param config: the configuration, fields include `history_index_file`, `history_dir`
+    """
+    return config.get('history_index_file') or os.path.join(get_history_dir(config), 'search.sqlite3')
+
+
+def get_profiles(config: dict) -> list:
+    """
+    Get the configuration of each profile listed under `profiles`
+    A profile overrides any top-level key (`tag`, `category_list`, `keyword_list`, `paper_to_hunt_file`,
+    `webhook_url`, ...). Unless it sets `history_dir`, its history is kept in `<history_dir>/profiles/<name>`.
+    :param config: the configuration
+    :return: a list of profile configurations, empty if there is no profile
+    :raise ValueError: if two profiles have the same name, or share a history directory (with the top level as well)
+    """
+    profiles = []
+    for i, profile in enumerate(config.get('profiles') or []):
+        profile_config = {key: value for key, value in config.items() if key != 'profiles'}
+        profile_config.update(profile)
+        name = str(profile.get('name') or profile.get('tag') or 'profile-{}'.format(i + 1))
+        profile_config['name'] = name
+        if 'history_dir' not in profile:
+            profile_config['history_dir'] = os.path.join(get_history_dir(config), 'profiles', re.sub(r'[^\w\-]+', '_', name))
+        # Papers of every profile are searched together, by tag
+        profile_config['history_index_file'] = get_history_index_file(config)
+        profiles.append(profile_config)
+    names = [profile['name'] for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError('Profile names must be unique: {}'.format(names))
+    # Each history directory holds the run checkpoint and lock of a single run
+    directories = [os.path.normpath(get_history_dir(config))] + [os.path.normpath(get_history_dir(profile)) for profile in profiles]
+    if len(set(directories)) != len(directories):
+        raise ValueError('Profiles must not share the history_dir of another profile or of the top level: {}'.format(directories))
+    return profiles
@@ -0,0 +1,108 @@
+"""
+Test script for verifying the historical backfill in backfill.py
+This script tests the backfill without making actual API calls
+"""
+
+import time
+import datetime
+import threading
+from unittest.mock import patch
+
+from backfill import ArxivScheduler, date_windows, get_backfill_state, run_backfill, window_query
+from history import PaperHistory
+from paper import Paper
+
+
+def test_date_windows_and_query():
+    windows = date_windows(datetime.date(2025, 1, 1), datetime.date(2025, 1, 17), window_days=7)
+    assert windows == [(datetime.date(2025, 1, 1), datetime.date(2025, 1, 7)), (datetime.date(2025, 1, 8), datetime.date(2025, 1, 14)),
+                       (datetime.date(2025, 1, 15), datetime.date(2025, 1, 17))]
+    assert window_query('cs.CL', *windows[0]) == 'cat:cs.CL AND submittedDate:[202501010000 TO 202501072359]'
+
+
+def test_scheduler_spaces_requests_across_threads():
+    """Test that requests of several threads go one at a time, `delay_seconds` apart, and retries keep the slot"""
+    scheduler = ArxivScheduler(delay_seconds=0.05)
+    spans = []
+
+    def request():
+        with scheduler.slot():
+            with scheduler.slot():  # Retry of the same request
+                start = time.monotonic()
+                time.sleep(0.01)
+                spans.append((start, time.monotonic()))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    spans.sort()
+    assert all(start - previous_end >= 0.045 for (_, previous_end), (start, _) in zip(spans, spans[1:]))
+
+
+def test_backfill_resumes_and_splits_capped_windows(tmp_path):
+    """Test that a capped window is fetched in halves and an interrupted backfill does not fetch finished windows again"""
+    config = {
+        'history_dir': str(tmp_path / 'history'), 'category_list': ['cs.CL'], 'keyword_list': ['agent'],
+        'use_llm_for_filtering': False, 'use_llm_for_translation': False, 'history_index_enabled': False,
+        'backfill_window_days': 4, 'backfill_fetch_workers': 2, 'backfill_max_results_per_window': 3,
+    }
+    fetched = []
+    arxiv_down = [True]
+
+    def fake_fetch_window(client, category, start, end, max_results=10000):
+        fetched.append((start.day, end.day))
+        if start.day == 8 and arxiv_down[0]:
+            raise ConnectionError('arXiv is down')
+        # Two papers per day, one about agents
+        papers = [Paper(id='2501.{:05d}'.format(day * 10 + i), title='Agent {}'.format(day) if i == 0 else 'Other {}'.format(day),
+                        abstract='', url='', published='2025-01-{:02d}'.format(day), comment='', categories=[category])
+                  for day in range(start.day, end.day + 1) for i in range(2)]
+        return papers[:max_results]
+
+    since, until = datetime.date(2025, 1, 1), datetime.date(2025, 1, 8)
+    # Windows of 4 and 2 days have more than 3 papers, they are split down to single days
+    with patch('backfill.fetch_window', side_effect=fake_fetch_window):
+        stats = run_backfill(config, since, until)
+    assert stats['failed'] == 1, "Expected the other windows to go on after a failed one"
+    state = get_backfill_state(config)
+    finished = set(state.windows) | state.splits
+    assert (8, 8) in fetched and 'cs.CL|2025-01-05|2025-01-08' in state.splits and len(state.windows) == 7
+
+    fetched.clear()
+    arxiv_down[0] = False
+    with patch('backfill.fetch_window', side_effect=fake_fetch_window):
+        stats = run_backfill(config, since, until)
+    keys = ['cs.CL|2025-01-{:02d}|2025-01-{:02d}'.format(start, end) for start, end in fetched]
+    assert (8, 8) in fetched and not finished.intersection(keys), "Expected the finished and split windows not to be fetched again"
+    assert stats['kept'] == 8 - len(state.windows)
+
+    history = PaperHistory(config['history_dir'])
+    assert sorted(paper['id'] for paper in history.iter_papers()) == ['2501.{:05d}'.format(day * 10) for day in range(1, 9)]
+
+
+def test_backfill_records_capped_day_as_truncated(tmp_path):
+    """Test that a single day with more papers than a query returns is recorded as truncated, not finished"""
+    config = {
+        'history_dir': str(tmp_path / 'history'), 'category_list': ['cs.CL'], 'keyword_list': [],
+        'use_llm_for_filtering': False, 'use_llm_for_translation': False, 'history_index_enabled': False,
+        'backfill_window_days': 1, 'backfill_fetch_workers': 1, 'backfill_max_results_per_window': 2,
+    }
+    papers = [Paper(id='2501.{:05d}'.format(i), title='Title {}'.format(i), abstract='', url='', published='2025-01-01',
+                    comment='', categories=['cs.CL']) for i in range(3)]
+
+    def fake_fetch_window(client, category, start, end, max_results=10000):
+        return papers[:max_results]
+
+    day = datetime.date(2025, 1, 1)
+    with patch('backfill.fetch_window', side_effect=fake_fetch_window) as mock_fetch:
+        assert run_backfill(config, day, day)['truncated'] == 1
+        state = get_backfill_state(config)
+        assert not state.windows and 'cs.CL|2025-01-01|2025-01-01' in state.truncated
+        assert run_backfill(config, day, day)['windows'] == 0 and mock_fetch.call_count == 1
+
+        # Fetched again with a higher cap, the papers recorded before are not recorded twice
+        stats = run_backfill(dict(config, backfill_max_results_per_window=10), day, day)
+    assert stats['kept'] == 1 and get_backfill_state(config).is_done('cs.CL', day, day)
+    assert len(list(PaperHistory(config['history_dir']).iter_papers())) == 3
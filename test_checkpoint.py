@@ -0,0 +1,86 @@
+"""
+Test script for verifying checkpoint and resume in checkpoint.py
+This script tests the resume without making actual API calls
+"""
+
+from unittest.mock import Mock, patch
+
+import pytest
+
+from checkpoint import RunCheckpoint
+from lark_post import post_to_lark_webhook
+from pipeline import run_pipeline
+
+from test_pipeline import create_test_papers
+
+
+def test_resume_skips_recorded_verdicts_and_translations(tmp_path):
+    """Test that a run interrupted during translation only redoes the unfinished LLM work"""
+    file_path = str(tmp_path / 'checkpoint.jsonl')
+    pages = [create_test_papers(0, 8), create_test_papers(8, 8)]
+    config = {'llm_filter_batch_size': 4, 'llm_max_concurrency': 1, 'history_dir': str(tmp_path / 'history')}
+    checked, translated = [], []
+
+    def fake_are_papers_match(papers, paper_to_hunt, config):
+        checked.extend(paper['id'] for paper in papers)
+        return [int(paper['id'][-1]) % 2 == 0 for paper in papers]
+
+    def fake_translate_abstract(abstract, config):
+        if len(translated) == 3:
+            raise KeyboardInterrupt  # The process dies during the 4th translation
+        translated.append(abstract)
+        return '中文 ' + abstract
+
+    checkpoint = RunCheckpoint(file_path)
+    with patch('pipeline.are_papers_match', side_effect=fake_are_papers_match), \
+            patch('llm.translate_abstract', side_effect=fake_translate_abstract), \
+            pytest.raises(KeyboardInterrupt):
+        run_pipeline(checkpoint.record_pages(iter(pages)), config, paper_to_hunt='agents',
+                     use_llm_for_filtering=True, use_llm_for_translation=True, checkpoint=checkpoint)
+    checkpoint.close()
+    with open(file_path, 'a', encoding='utf-8') as f:
+        f.write('{"type": "transl')  # Torn last line
+
+    checked_before = list(checked)
+    translated.clear()
+    checkpoint = RunCheckpoint(file_path)
+    assert checkpoint.resumed
+    # The translations of a chunk are recorded together, the 3rd one was kept by the translation store
+    assert len(checkpoint.translations) == 2
+    with patch('pipeline.are_papers_match', side_effect=fake_are_papers_match), \
+            patch('llm.translate_abstract', side_effect=lambda abstract, config: translated.append(abstract) or '中文 ' + abstract):
+        papers, _ = run_pipeline(checkpoint.record_pages(iter(pages)), config, paper_to_hunt='agents',
+                                 use_llm_for_filtering=True, use_llm_for_translation=True, checkpoint=checkpoint)
+
+    assert [paper['id'] for paper in papers] == ['2501.{:05d}'.format(i) for i in range(0, 16, 2)]
+    assert all(paper['zh_abstract'] == '中文 ' + paper['abstract'] for paper in papers)
+    assert checked[len(checked_before):] == [paper_id for paper_id in map('2501.{:05d}'.format, range(16)) if paper_id not in checked_before]
+    assert len(translated) == 8 - 3
+    checkpoint.finish()
+
+
+def test_resume_skips_delivered_batches(tmp_path):
+    """Test that Lark messages delivered before the interruption are not sent again"""
+    config = {
+        'webhook_url': 'https://test.example.com/webhook',
+        'template_id': 'test_template',
+        'template_version_name': '1.0.0',
+        'lark_max_batch_size': 2,
+        'lark_outbox_dir': str(tmp_path / 'outbox'),
+    }
+    papers = create_test_papers(0, 6)
+    response = Mock(status_code=200, headers={})
+    response.json.return_value = {'code': 0}
+
+    checkpoint = RunCheckpoint(str(tmp_path / 'checkpoint.jsonl'))
+    with patch('lark_post._lark_limiter.acquire'), \
+            patch('lark_post.requests.post', side_effect=[response, KeyboardInterrupt]), \
+            pytest.raises(KeyboardInterrupt):
+        post_to_lark_webhook('Test', papers, config, checkpoint=checkpoint)
+    checkpoint.close()
+
+    checkpoint = RunCheckpoint(str(tmp_path / 'checkpoint.jsonl'))
+    with patch('lark_post._lark_limiter.acquire'), patch('lark_post.requests.post', return_value=response) as mock_post:
+        summary = post_to_lark_webhook('Test', papers, config, checkpoint=checkpoint)
+    assert summary == {'sent': 2, 'failed': 0}
+    assert mock_post.call_count == 2
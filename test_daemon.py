@@ -0,0 +1,81 @@
+"""
+Test script for verifying the daemon mode in daemon.py
+This script tests the scheduler, the run lock and the status endpoint without making actual API calls
+"""
+
+import json
+import datetime
+import urllib.request
+from unittest.mock import patch
+from zoneinfo import ZoneInfo
+
+import yaml
+
+from checkpoint import RunLock
+from daemon import Daemon, next_announcement_run, next_scheduled_run, _us_eastern_offset
+
+EASTERN = ZoneInfo('America/New_York')
+
+
+def test_runs_follow_arxiv_announcements():
+    # Thursday 21:00 ET, after the announcement: the next one is on Sunday (none on Friday and Saturday)
+    after = datetime.datetime(2025, 3, 6, 21, 0, tzinfo=EASTERN)
+    assert next_announcement_run(after, 30) == datetime.datetime(2025, 3, 9, 20, 30, tzinfo=EASTERN)
+    # Monday 20:10 ET, before the delayed run of the same evening
+    after = datetime.datetime(2025, 3, 10, 20, 10, tzinfo=EASTERN)
+    assert next_announcement_run(after, 30) == datetime.datetime(2025, 3, 10, 20, 30, tzinfo=EASTERN)
+    # Daylight saving time, without the time zone database
+    for day in (datetime.date(2025, 3, 8), datetime.date(2025, 3, 9), datetime.date(2025, 11, 1), datetime.date(2025, 11, 2)):
+        evening = datetime.datetime.combine(day, datetime.time(20, 0), tzinfo=EASTERN)
+        assert _us_eastern_offset(day) == evening.utcoffset()
+
+    after = datetime.datetime(2025, 3, 10, 12, 0).astimezone()
+    assert next_scheduled_run(after, ['10:17', '18:00']) == datetime.datetime(2025, 3, 10, 18, 0).astimezone()
+    assert next_scheduled_run(after, ['10:17']) == datetime.datetime(2025, 3, 11, 10, 17).astimezone()
+
+
+def test_run_lock_is_exclusive(tmp_path):
+    first, second = RunLock(str(tmp_path / 'run.lock')), RunLock(str(tmp_path / 'run.lock'))
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    second.release()
+
+
+def test_daemon_runs_reloads_and_reports_status(tmp_path):
+    """Test a requested run with warm history, a configuration reload and the status endpoint"""
+    config_file = tmp_path / 'config.yaml'
+    config = {'tag': 'Test', 'use_llm_for_filtering': False, 'history_dir': str(tmp_path / 'history'),
+              'keyword_list': ['agent'], 'daemon_status_port': 0}
+    config_file.write_text(yaml.safe_dump(config), encoding='utf-8')
+    histories = []
+
+    def fake_run_task(config, paper_to_hunt, history):
+        histories.append(history)
+        return [{'id': '2501.00001'}] if config['tag'] == 'Test' else []
+
+    daemon = Daemon(str(config_file))
+    server = daemon.serve_status('127.0.0.1', 0)
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        with patch('daemon.main.run_task', side_effect=fake_run_task):
+            assert daemon.run_once('request')
+            config['tag'] = 'Reloaded'
+            config_file.write_text(yaml.safe_dump(config) + '# changed\n', encoding='utf-8')
+            assert daemon.reload_config()
+            assert daemon.run_once()
+        assert histories[0] is histories[1]
+
+        with urllib.request.urlopen(url + '/status') as response:
+            status = json.load(response)
+        assert status['runs'] == 2 and status['failures'] == 0
+        assert status['last_run']['ok'] and status['last_run']['papers'] == 0
+        with urllib.request.urlopen(url + '/health') as response:
+            assert response.status == 200
+
+        config_file.write_text('tag: [unclosed', encoding='utf-8')
+        assert not daemon.reload_config()
+        assert daemon.config['tag'] == 'Reloaded' and daemon.status()['config_error']
+    finally:
+        server.shutdown()
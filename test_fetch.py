@@ -0,0 +1,105 @@
+"""
+Test script for verifying the arXiv fetching in arxiv_paper.py
+This script tests the fetching without making actual API calls
+"""
+
+import datetime
+from unittest.mock import Mock, patch
+
+from arxiv_paper import FetchWatermarks, get_latest_papers
+
+
+def create_test_results(start, count, newest):
+    """Create fake arxiv results, newest first, one hour apart"""
+    results = []
+    for i in range(count):
+        number = start + count - 1 - i
+        result = Mock()
+        result.get_short_id.return_value = f'2501.{number:05d}v1'
+        result.title = f'Title {number}'
+        result.summary = f'Abstract\n{number}'
+        result.entry_id = f'http://arxiv.org/abs/2501.{number:05d}v1'
+        result.published = newest - datetime.timedelta(hours=i)
+        result.comment = None
+        result.categories = ['cs.CL', 'cs.AI'] if number % 2 else ['cs.CV']
+        results.append(result)
+    return results
+
+
+def fake_client(results, consumed):
+    """Create a fake arxiv.Client yielding the results lazily and counting how many were consumed"""
+    def generate(search):
+        for result in results:
+            consumed.append(result)
+            yield result
+    client = Mock()
+    client.page_size = 200
+    client.results.side_effect = generate
+    return client
+
+
+def test_incremental_fetch_stops_at_watermark(tmp_path):
+    """Test that the second run only returns the new papers and stops paging at the watermark"""
+    now = datetime.datetime(2025, 1, 2, 12, tzinfo=datetime.timezone.utc)
+    watermarks = FetchWatermarks(str(tmp_path / 'watermarks.json'), overlap_hours=2)
+
+    consumed = []
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(create_test_results(0, 10, now), consumed)):
+        papers = get_latest_papers('cs.CL', max_results=10, watermarks=watermarks)
+    assert [paper['id'] for paper in papers][:2] == ['2501.00009', '2501.00008']
+    assert papers[0]['abstract'] == 'Abstract 9'
+    watermarks.save()
+
+    # 5 new papers, then the 10 old ones: paging stops 2 hours (overlap) before the previous newest paper
+    consumed = []
+    watermarks = FetchWatermarks(str(tmp_path / 'watermarks.json'), overlap_hours=2)
+    results = create_test_results(10, 5, now + datetime.timedelta(hours=5)) + create_test_results(0, 10, now)
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(results, consumed)):
+        papers = get_latest_papers('cs.CL', max_results=10, watermarks=watermarks)
+    assert [paper['id'] for paper in papers] == ['2501.00014', '2501.00013', '2501.00012', '2501.00011', '2501.00010']
+    assert len(consumed) == 5 + 3 + 1, f"Expected paging to stop after the overlap window, consumed {len(consumed)}"
+    assert watermarks.get('cs.CL')[0] == now + datetime.timedelta(hours=3)
+
+
+def test_capped_fetch_records_the_gap(tmp_path):
+    """Test that paging stopped by the cap before the watermark is reported as a gap instead of silently skipped"""
+    now = datetime.datetime(2025, 1, 2, 12, tzinfo=datetime.timezone.utc)
+    watermarks = FetchWatermarks(str(tmp_path / 'watermarks.json'), overlap_hours=2)
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(create_test_results(0, 3, now), [])):
+        get_latest_papers('cs.CL', max_results=10, watermarks=watermarks)
+
+    # 20 new papers, the client stops at the cap of 8 (the fake client ignores `max_results`)
+    results = create_test_results(10, 20, now + datetime.timedelta(hours=20))[:8]
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(results, [])):
+        papers = get_latest_papers('cs.CL', max_results=10, watermarks=watermarks, max_results_since_watermark=8)
+    assert len(papers) == 8
+    assert watermarks.get('cs.CL')[0] == now + datetime.timedelta(hours=18)
+    gap = [now - datetime.timedelta(hours=2), now + datetime.timedelta(hours=13)]
+    assert watermarks.watermarks['cs.CL']['gaps'] == [[time.isoformat() for time in gap]]
+
+    # The gap is kept as the watermark moves on
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(create_test_results(30, 1, now + datetime.timedelta(hours=21)), [])):
+        get_latest_papers('cs.CL', max_results=10, watermarks=watermarks)
+    assert len(watermarks.watermarks['cs.CL']['gaps']) == 1
+
+
+def test_fetch_without_watermarks():
+    """Test that fetching without watermarks returns all results"""
+    now = datetime.datetime(2025, 1, 2, 12, tzinfo=datetime.timezone.utc)
+    with patch('arxiv_paper.get_arxiv_client', return_value=fake_client(create_test_results(0, 3, now), [])):
+        papers = get_latest_papers('cs.CL', max_results=3)
+    assert [paper['id'] for paper in papers] == ['2501.00002', '2501.00001', '2501.00000']
+    assert papers[0]['published'] == '2025-01-02'
+
+
+def test_merged_category_query():
+    """Test that a merged query records the requested categories of each paper and stops once all are filled"""
+    now = datetime.datetime(2025, 1, 2, 12, tzinfo=datetime.timezone.utc)
+    consumed = []
+    client = fake_client(create_test_results(0, 20, now), consumed)
+    with patch('arxiv_paper.get_arxiv_client', return_value=client):
+        papers = get_latest_papers(['cs.CL', 'cs.CV'], max_results=3)
+    search = client.results.call_args[0][0]
+    assert search.query == 'cat:cs.CL OR cat:cs.CV'
+    assert [paper['categories'] for paper in papers] == [['cs.CL'], ['cs.CV']] * 3
+    assert len(consumed) == 7, f"Expected paging to stop once every category has 3 papers, consumed {len(consumed)}"
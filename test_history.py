@@ -0,0 +1,119 @@
+"""
+Test script for verifying the paper history store in history.py
+"""
+
+import os
+import json
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+from history import PaperHistory, SeenIdIndex, pack_arxiv_id
+from arxiv_paper import deduplicate_papers
+
+
+def create_test_papers(start, count):
+    """Create a list of test papers"""
+    return [
+        {
+            'title': f'Title {i}',
+            'id': f'2501.{i:05d}',
+            'abstract': f'Abstract {i}',
+            'url': f'https://arxiv.org/abs/2501.{i:05d}',
+            'published': '2025-01-01',
+            'comment': None,
+            'zh_abstract': f'中文摘要 {i}'
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def test_migrate_append_export_roundtrip(tmp_path):
+    """Test that the exported JSON matches what the legacy prepend would have produced"""
+    legacy_file = tmp_path / 'papers.json'
+    legacy = create_test_papers(0, 3)
+    legacy_file.write_text(json.dumps(legacy), encoding='utf-8')
+
+    history = PaperHistory(str(tmp_path / 'history'))
+    assert history.migrate_from_json(str(legacy_file)) == 3
+    run_1 = create_test_papers(3, 2)
+    run_2 = create_test_papers(5, 2)
+    history.append(run_1, date=datetime.date(2025, 1, 31))
+    history.append(run_2, date=datetime.date(2025, 2, 1))
+    assert len(history.segment_files()) == 3
+
+    export_file = tmp_path / 'export.json'
+    assert history.export_json(str(export_file)) == 7
+    assert json.loads(export_file.read_text(encoding='utf-8')) == run_2 + run_1 + legacy
+    assert deduplicate_papers(create_test_papers(4, 4), history) == create_test_papers(7, 1)
+
+
+def test_torn_append_is_repaired(tmp_path):
+    """Test that a torn last line from a crash is skipped and truncated on the next append"""
+    history = PaperHistory(str(tmp_path))
+    history.append(create_test_papers(0, 2), date=datetime.date(2025, 1, 1))
+    segment = history.segment_files()[0]
+    with open(segment, 'a', encoding='utf-8') as f:
+        f.write('{"title": "Torn')
+    assert [paper['id'] for paper in history.iter_papers()] == ['2501.00000', '2501.00001']
+
+    history.append(create_test_papers(2, 1), date=datetime.date(2025, 1, 2))
+    assert [paper['id'] for paper in history.iter_papers()] == ['2501.00002', '2501.00000', '2501.00001']
+    with open(segment, 'r', encoding='utf-8') as f:
+        assert all(json.loads(line) for line in f)
+
+
+def test_uncommitted_block_is_rolled_back(tmp_path):
+    """Test that complete lines written by a crashed append, but not committed, are ignored and then truncated"""
+    history = PaperHistory(str(tmp_path))
+    history.append(create_test_papers(0, 2), date=datetime.date(2025, 1, 1))
+    segment = history.segment_files()[0]
+    committed = os.path.getsize(segment)
+    with open(segment, 'a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(paper) + '\n' for paper in create_test_papers(5, 2)) + '{"title": "Torn')
+
+    reopened = PaperHistory(str(tmp_path))
+    assert [paper['id'] for paper in reopened.iter_papers()] == ['2501.00000', '2501.00001']
+    assert '2501.00005' not in reopened.seen_ids and reopened.size() == committed
+
+    reopened.append(create_test_papers(2, 1), date=datetime.date(2025, 1, 2))
+    assert [paper['id'] for paper in reopened.iter_papers()] == ['2501.00002', '2501.00000', '2501.00001']
+    assert os.path.getsize(segment) == reopened.size()
+
+
+def test_seen_id_index(tmp_path):
+    """Test the seen-id index with packed and custom ids, and its rebuild when out of sync with the history"""
+    history = PaperHistory(str(tmp_path))
+    papers = create_test_papers(0, 3) + [dict(create_test_papers(3, 1)[0], id='1000000000'), dict(create_test_papers(4, 1)[0], id='0704.0001')]
+    history.append(papers, date=datetime.date(2025, 1, 1))
+    assert pack_arxiv_id('2501.00001') == 2501 * 100000 + 1 and pack_arxiv_id('hep-th/9901001') is None
+    for paper in papers:
+        assert paper['id'] in history.seen_ids
+    assert '2501.00003' not in history.seen_ids and '0704.00001' in history.seen_ids
+
+    # A fresh instance loads the persisted index
+    reopened = PaperHistory(str(tmp_path))
+    assert len(reopened.seen_ids) == 5 and '1000000000' in reopened.seen_ids
+
+    # Simulate a crash after the history append but before the index update
+    with patch.object(SeenIdIndex, 'add', side_effect=OSError('crash')), pytest.raises(OSError):
+        reopened.append(create_test_papers(9, 1), date=datetime.date(2025, 1, 2))
+    assert '2501.00009' in PaperHistory(str(tmp_path)).seen_ids
+
+
+def test_refresh_after_another_process_appends(tmp_path):
+    """Test that a long-lived history notices the papers appended by another process and keeps them on compaction"""
+    history = PaperHistory(str(tmp_path))
+    history.append(create_test_papers(0, 2), date=datetime.date(2025, 1, 1))
+    assert '2501.00000' in history.seen_ids
+    assert not history.refresh()
+
+    # E.g. a cron run or a backfill between two daemon runs
+    PaperHistory(str(tmp_path)).append(create_test_papers(2, 2), date=datetime.date(2025, 1, 2))
+    assert history.refresh()
+    assert '2501.00003' in history.seen_ids
+
+    history.append(create_test_papers(4, 1), date=datetime.date(2025, 1, 3))
+    history.seen_ids.compact()
+    assert all(paper['id'] in PaperHistory(str(tmp_path)).seen_ids for paper in create_test_papers(0, 5))
@@ -0,0 +1,99 @@
+"""
+Test script for verifying the full-text index in history_index.py and the history search of cli.py
+This script tests the search without making actual API calls
+"""
+
+import datetime
+from unittest.mock import patch
+
+import yaml
+
+import cli
+from history import PaperHistory
+from history_index import ZH_SCHEMA, HistoryIndex, parse_query
+
+
+def make_paper(i, title, abstract, zh_abstract=None, category='cs.CL', published='2025-01-15'):
+    return {'id': '2501.{:05d}'.format(i), 'title': title, 'abstract': abstract, 'zh_abstract': zh_abstract,
+            'url': 'http://arxiv.org/abs/2501.{:05d}v1'.format(i), 'published': published, 'categories': [category]}
+
+
+def test_parse_query():
+    assert parse_query('"MCP server" secur* -survey - ') == [(False, 'MCP server'), (False, 'secur*'), (True, 'survey')]
+
+
+def test_index_syncs_incrementally_and_filters(tmp_path):
+    """Test keyword, Chinese, exclusion, tag, category and date-range queries over an incrementally synced history"""
+    history = PaperHistory(str(tmp_path / 'history'))
+    index = HistoryIndex(str(tmp_path / 'search.sqlite3'))
+    history.append([
+        make_paper(1, 'Securing MCP Servers', 'We study the security of Model Context Protocol servers.', '我们研究了模型上下文协议服务器的安全性。', 'cs.CR'),
+        make_paper(2, 'A Survey of Agents', 'A survey of LLM agents and MCP tools.'),
+    ], date=datetime.date(2025, 1, 1))
+    assert index.sync(history) == 2
+    assert index.sync(history) == 0
+
+    history.append([make_paper(3, 'Video Agents', 'Agents that watch videos, securely.', category='cs.CV', published='2025-02-03')], date=datetime.date(2025, 2, 1))
+    with open(history.segment_files()[-1], 'a', encoding='utf-8') as f:
+        f.write('{"id": "2501.0')  # Torn last line of an interrupted append
+    assert index.sync(history, tag='Agent', recorded='2025-02-04') == 1
+
+    def search(query='', **kwargs):
+        return [paper['id'] for paper in index.search(query, **kwargs)]
+
+    assert search('MCP') == ['2501.00001', '2501.00002']  # Newest first, as the lists given to the history
+    assert search('MCP secure') == ['2501.00001']  # Stemmed
+    assert search('MCP -survey') == ['2501.00001']
+    assert search('"context protocol"') == ['2501.00001']
+    assert search('服务器的安全') == search('安全') == ['2501.00001']
+    assert search('agent*', tag='Agent') == ['2501.00003']
+    assert search(category='cs.CR') == ['2501.00001']
+    assert search(since='2025-02-01') == ['2501.00003']
+    assert search(until='2025-01-31', date_field='published') == ['2501.00001', '2501.00002']
+    paper = index.search('video')[0]
+    assert paper['tags'] == ['Agent'] and paper['recorded'] == '2025-02-04' and paper['categories'] == ['cs.CV']
+
+    # A paper recorded again (e.g. by another profile) is tagged again and its translation indexed
+    index.add([make_paper(2, 'A Survey of Agents', 'A survey of LLM agents and MCP tools.', '智能体综述')], tag='Survey')
+    assert search('智能体', tag='Survey') == ['2501.00002']
+    assert index.search('survey')[0]['tags'] == ['Survey']
+    assert len(index) == 3
+
+
+def test_index_without_trigram_tokenizer(tmp_path):
+    """Test that Chinese search falls back to LIKE on an SQLite without trigrams, and is indexed once it has them"""
+    file_path = str(tmp_path / 'search.sqlite3')
+    with patch('history_index.ZH_SCHEMA', ZH_SCHEMA.replace('trigram', 'missing')):
+        index = HistoryIndex(file_path)
+    assert not index.trigram
+    index.add([make_paper(1, 'Securing MCP Servers', 'MCP security.', '我们研究了模型上下文协议服务器的安全性。')])
+    index.add([make_paper(1, 'Securing MCP Servers', 'MCP security.', '模型上下文协议服务器的安全性')])
+    assert [paper['id'] for paper in index.search('服务器的安全 MCP')] == ['2501.00001']
+    assert index.search('-安全性') == []
+    index.close()
+
+    # Upgraded SQLite: the papers indexed meanwhile are added to the trigram index
+    index = HistoryIndex(file_path)
+    assert index.trigram
+    assert [paper['id'] for paper in index.search('服务器的安全')] == ['2501.00001']
+
+
+def test_cli_history_search(tmp_path, capsys):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({'history_dir': str(tmp_path / 'history'), 'tag': 'Test'}), encoding='utf-8')
+    PaperHistory(str(tmp_path / 'history')).append([make_paper(1, 'Securing MCP Servers', 'MCP security.')])
+
+    assert cli.main(['--config', str(config_file), 'history', 'search', 'mcp', '--json']) == 0
+    assert '"2501.00001"' in capsys.readouterr().out
+    cli.main(['--config', str(config_file), 'history', 'search', 'video'])
+    assert '0 paper(s)' in capsys.readouterr().err
+
+
+def test_cli_history_search_fresh_checkout(tmp_path, capsys):
+    """Test that searching before any run creates the directory of the index instead of failing"""
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({'history_dir': str(tmp_path / 'history'), 'tag': 'Test'}), encoding='utf-8')
+
+    assert cli.main(['--config', str(config_file), 'history', 'search', 'mcp']) == 0
+    assert '0 paper(s)' in capsys.readouterr().err
+    assert (tmp_path / 'history' / 'search.sqlite3').exists()
@@ -0,0 +1,45 @@
+"""
+Test script for verifying the compiled keyword matcher in keyword_matcher.py
+"""
+
+from arxiv_paper import filter_papers_by_keyword
+from keyword_matcher import KeywordMatcher, get_keyword_matcher
+from benchmarks.bench_keyword_filter import KEYWORD_LIST, filter_papers_by_keyword_reference, make_synthetic_papers
+
+
+def make_paper(title, abstract):
+    return {'title': title, 'id': '2501.00001', 'abstract': abstract}
+
+
+def test_matches_reference_implementation():
+    """Test that the compiled matcher keeps exactly the papers the per-keyword regex kept"""
+    papers = make_synthetic_papers(2000, seed=1)
+    assert filter_papers_by_keyword(papers, KEYWORD_LIST) == filter_papers_by_keyword_reference(papers, KEYWORD_LIST)
+
+
+def test_whole_words_and_case():
+    """Test whole-word and case-insensitive matching"""
+    matcher = KeywordMatcher(['agent', 'RL', '-Video'])
+    assert matcher.find('Agents are not an agent') == (['agent'], [])
+    assert matcher.find('CURL and RLHF') == ([], [])
+    assert matcher.find('RL for video agents') == (['rl'], ['video'])
+    assert not matcher.is_match(make_paper('An Agent', 'for VIDEO understanding'))
+    assert matcher.is_match(make_paper('An Agent', 'for text'))
+
+
+def test_overlapping_keywords():
+    """Test that keywords sharing a prefix or overlapping are all reported"""
+    matcher = KeywordMatcher(['reinforcement learning', 'agent', 'agentic', '-learning', '-reinforcement'])
+    assert matcher.find('agentic reinforcement learning') == (['reinforcement learning', 'agentic'], ['learning', 'reinforcement'])
+    matcher = KeywordMatcher(['c++', 'c', 'large language', '-language model'])
+    # Same as r'\b' + keyword + r'\b', "c++" cannot match before a space since there is no word boundary after '+'
+    assert matcher.find('a large language model in c++') == (['c', 'large language'], ['language model'])
+
+
+def test_return_matches_and_reuse():
+    """Test that the matched keywords are returned and the compiled matcher is reused"""
+    papers = [make_paper('Agentic RL', 'An agent trained with reinforcement learning'), make_paper('Other', 'Nothing')]
+    results = filter_papers_by_keyword(papers, ['agent', 'reinforcement learning', 'agentic'], return_matches=True)
+    assert results == [(papers[0], ['agent', 'reinforcement learning', 'agentic'])]
+    assert get_keyword_matcher(['agent']) is get_keyword_matcher(['agent'])
+    assert filter_papers_by_keyword(papers, []) == []
@@ -0,0 +1,149 @@
+"""
+Test script for verifying the size-aware batching, retries and outbox in lark_post.py
+This script tests the delivery without making actual API calls
+"""
+
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from lark_post import post_to_lark_webhook, resend_outbox
+
+from test_lark_post_batching import create_test_papers
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit():
+    """Skip the Lark rate limiter"""
+    with patch('lark_post._lark_limiter.acquire'):
+        yield
+
+
+def make_config(tmp_path, **kwargs):
+    config = {
+        'webhook_url': 'https://test.example.com/webhook',
+        'template_id': 'test_template',
+        'template_version_name': '1.0.0',
+        'lark_outbox_dir': str(tmp_path / 'outbox'),
+        'lark_backoff_seconds': 0.01
+    }
+    config.update(kwargs)
+    return config
+
+
+def make_response(status_code=200, code=0, headers=None):
+    response = Mock(status_code=status_code, headers=headers or {}, text='')
+    response.json.return_value = {'code': code}
+    return response
+
+
+def test_batches_packed_by_payload_size(tmp_path):
+    """Test that long abstracts are split into messages under the payload limit, keeping the counters in order"""
+    papers = create_test_papers(12)
+    for paper in papers:
+        paper['zh_abstract'] = '这是一段很长的中文摘要。' * 80  # ~2.9 KB of UTF-8 per paper
+    config = make_config(tmp_path, lark_max_payload_bytes=10000)
+    with patch('lark_post.requests.post', return_value=make_response()) as mock_post:
+        summary = post_to_lark_webhook('Test Tag', papers, config)
+
+    payloads = [call[1]['data'] for call in mock_post.call_args_list]
+    assert summary == {'sent': len(payloads), 'failed': 0}
+    assert len(payloads) == 4, f"Expected 4 messages of 3 papers, got {len(payloads)}"
+    assert all(len(payload) <= 10000 for payload in payloads)
+    counters = [item['counter'] for payload in payloads for item in json.loads(payload)['card']['data']['template_variable']['paper_list']]
+    assert counters == list(range(1, 13))
+
+
+def test_oversized_paper_is_truncated(tmp_path):
+    """Test that a single paper larger than the limit is truncated instead of dropped"""
+    papers = create_test_papers(1)
+    papers[0]['zh_abstract'] = '超长摘要' * 2000
+    with patch('lark_post.requests.post', return_value=make_response()) as mock_post:
+        post_to_lark_webhook('Test Tag', papers, make_config(tmp_path, lark_max_payload_bytes=4000))
+    payload = mock_post.call_args[1]['data']
+    assert len(payload) <= 4000
+    assert json.loads(payload)['card']['data']['template_variable']['paper_list'][0]['abstract'].endswith('…')
+
+
+def test_retry_then_outbox_then_resend(tmp_path):
+    """Test that throttled messages are retried, failures saved to the outbox and resent by the next run"""
+    config = make_config(tmp_path, lark_max_retries=2)
+    papers = create_test_papers(25)
+
+    responses = [make_response(429, headers={'Retry-After': '0'}), make_response(200, code=11232), make_response()]  # Batch 1
+    responses += [make_response(500)] * 3  # Batch 2 fails 3 times
+    with patch('lark_post.requests.post', side_effect=responses) as mock_post, patch('lark_post.time.sleep'):
+        summary = post_to_lark_webhook('Test Tag', papers, config)
+    assert summary == {'sent': 1, 'failed': 1}
+    assert mock_post.call_count == 6
+    outbox = list((tmp_path / 'outbox').glob('*.json'))
+    assert len(outbox) == 1
+
+    with patch('lark_post.requests.post', return_value=make_response()) as mock_post:
+        assert resend_outbox(config) == {'sent': 1, 'failed': 0, 'dead': 0}
+    data = json.loads(mock_post.call_args[1]['data'])
+    assert '第 2/2 批' in data['card']['data']['template_variable']['tag']
+    assert not list((tmp_path / 'outbox').glob('*.json'))
+
+
+def test_bad_request_is_not_retried(tmp_path):
+    """Test that a non-retryable error code fails immediately"""
+    with patch('lark_post.requests.post', return_value=make_response(200, code=19001)) as mock_post:
+        summary = post_to_lark_webhook('Test Tag', create_test_papers(3), make_config(tmp_path))
+    assert summary == {'sent': 0, 'failed': 1} and mock_post.call_count == 1
+
+
+def test_rejected_outbox_message_does_not_block_the_queue(tmp_path):
+    """Test that a rejected message is not saved, and an outbox message Lark rejects is moved to dead"""
+    config = make_config(tmp_path, lark_max_retries=0)
+    with patch('lark_post.requests.post', return_value=make_response(400)):
+        assert post_to_lark_webhook('Test Tag', create_test_papers(3), config) == {'sent': 0, 'failed': 1}
+    assert not list((tmp_path / 'outbox').glob('*.json'))
+
+    with patch('lark_post.requests.post', return_value=make_response(503)):
+        post_to_lark_webhook('First', create_test_papers(3), config)
+        post_to_lark_webhook('Second', create_test_papers(3), config)
+    assert len(list((tmp_path / 'outbox').glob('*.json'))) == 2
+
+    # The first message is now rejected, the second is sent behind it
+    with patch('lark_post.requests.post', side_effect=[make_response(200, code=19001), make_response()]) as mock_post:
+        assert resend_outbox(config) == {'sent': 1, 'failed': 0, 'dead': 1}
+    assert 'Second' in json.loads(mock_post.call_args[1]['data'])['card']['data']['template_variable']['tag']
+    assert not list((tmp_path / 'outbox').glob('*.json'))
+    assert len(list((tmp_path / 'outbox' / 'dead').glob('*.json'))) == 1
+
+
+def test_outbox_message_moved_to_dead_after_max_attempts(tmp_path):
+    """Test that a message failing on every run stops being resent after lark_outbox_max_attempts"""
+    config = make_config(tmp_path, lark_max_retries=0, lark_outbox_max_attempts=2)
+    with patch('lark_post.requests.post', return_value=make_response(503)):
+        post_to_lark_webhook('Test Tag', create_test_papers(3), config)
+        assert resend_outbox(config) == {'sent': 0, 'failed': 1, 'dead': 0}
+        assert resend_outbox(config) == {'sent': 0, 'failed': 0, 'dead': 1}
+    assert len(list((tmp_path / 'outbox' / 'dead').glob('*.json'))) == 1
+
+
+def test_batches_after_a_failure_wait_in_the_outbox(tmp_path):
+    """Test that the batches after a failed one are saved behind it instead of being delivered first"""
+    config = make_config(tmp_path, lark_max_retries=0, lark_max_batch_size=1)
+    with patch('lark_post.requests.post', side_effect=[make_response(), make_response(503)]) as mock_post:
+        assert post_to_lark_webhook('Test Tag', create_test_papers(4), config) == {'sent': 1, 'failed': 3}
+    assert mock_post.call_count == 2
+
+    with patch('lark_post.requests.post', return_value=make_response()) as mock_post:
+        assert resend_outbox(config) == {'sent': 3, 'failed': 0, 'dead': 0}
+    tags = [json.loads(call[1]['data'])['card']['data']['template_variable']['tag'] for call in mock_post.call_args_list]
+    assert tags == ['Test Tag (第 {}/4 批)'.format(i) for i in (2, 3, 4)]
+
+
+def test_request_errors_and_non_json_bodies_are_retried(tmp_path):
+    """Test that any request error, or a 5xx with an HTML body, is retried instead of failing the run"""
+    html_error = make_response(502)
+    html_error.json.side_effect = ValueError('Expecting value')
+    html_error.text = '<html>Bad Gateway</html>'
+    responses = [requests.exceptions.ChunkedEncodingError('Connection broken'), html_error, make_response()]
+    with patch('lark_post.requests.post', side_effect=responses) as mock_post, patch('lark_post.time.sleep'):
+        assert post_to_lark_webhook('Test Tag', create_test_papers(3), make_config(tmp_path)) == {'sent': 1, 'failed': 0}
+    assert mock_post.call_count == 3
@@ -0,0 +1,419 @@
+"""
+Test script for verifying the LLM-based filtering in arxiv_paper.py
+This script tests the filtering without making actual API calls
+"""
+
+import io
+import json
+import time
+import threading
+from unittest.mock import Mock, patch
+import requests
+
+from metrics import get_run_metrics, reset_run_metrics
+
+from arxiv_paper import filter_papers_using_llm
+from llm import are_papers_match, _parse_batch_verdicts, _parse_batch_scores
+from utils import RateLimiter, LLMClient, LLMPool, scan_verdict
+
+
+def create_test_papers(count):
+    """Create a list of test papers"""
+    return [
+        {
+            'title': f'Title {i+1}',
+            'id': f'{1000000000 + i}',
+            'abstract': f'Abstract {i+1}',
+            'url': f'https://arxiv.org/abs/{1000000000 + i}',
+            'published': '2021-01-01',
+            'comment': ''
+        }
+        for i in range(count)
+    ]
+
+
+def test_concurrent_filtering_keeps_order():
+    """Test that concurrent filtering keeps the input order and runs requests in parallel"""
+    config = {'llm_max_concurrency': 8}
+    papers = create_test_papers(32)
+    in_flight = []
+    lock = threading.Lock()
+    max_in_flight = [0]
+
+    def fake_is_paper_match(paper, paper_to_hunt, config, on_error=True):
+        with lock:
+            in_flight.append(paper['id'])
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(paper['id'])
+        return int(paper['id']) % 2 == 0
+
+    with patch('llm.is_paper_match', side_effect=fake_is_paper_match):
+        results = filter_papers_using_llm(papers, 'paper to hunt', config)
+
+    assert [paper['id'] for paper in results] == [paper['id'] for paper in papers if int(paper['id']) % 2 == 0]
+    assert 1 < max_in_flight[0] <= 8, f"Expected bounded concurrency, got {max_in_flight[0]}"
+
+
+def test_sequential_filtering_by_default():
+    """Test that filtering falls back to one request at a time without concurrency settings"""
+    papers = create_test_papers(5)
+    with patch('llm.is_paper_match', return_value=True) as mock_match:
+        results = filter_papers_using_llm(papers, 'paper to hunt', {})
+    assert mock_match.call_count == 5
+    assert results == papers
+
+
+def test_rate_limiter_spacing():
+    """Test that the rate limiter spaces calls evenly"""
+    limiter = RateLimiter(requests_per_minute=1200)  # One call every 50ms
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.acquire()
+    elapsed = time.monotonic() - start
+    assert elapsed >= 0.14, f"Expected calls to be spaced out, took {elapsed:.3f}s"
+
+
+def test_parse_batch_verdicts():
+    """Test parsing of batch verdicts, skipping invalid items"""
+    response = '<think>[{"id": 9}]</think>Here: [{"id": 1, "match": true}, {"id": "2", "match": "no"}, {"id": 7, "match": true}, {"id": 3}]'
+    assert _parse_batch_verdicts(response, 3) == {1: True, 2: False}
+    assert _parse_batch_verdicts('not json [', 3) == {}
+
+
+def test_batch_classification_resplits_missing_ids():
+    """Test that papers missing from a batch reply are retried in smaller batches"""
+    papers = create_test_papers(4)
+    prompts = []
+
+    def fake_get_llm_response(prompt, config, system=None):
+        prompts.append(prompt)
+        if len(prompts) == 1:
+            # Only two verdicts come back, one of them is malformed
+            return '[{"id": 1, "match": true}, {"id": 2, "match": false}, {"id": 3, "match": null}]'
+        if len(prompts) == 2:
+            return 'garbled'
+        return 'Yes' if 'Title 3' in prompt else 'No'
+
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response), \
+            patch('llm.get_llm_verdict', side_effect=fake_get_llm_response):
+        results = are_papers_match(papers + create_test_papers(6)[4:], 'paper to hunt', {})
+
+    assert results == [True, False, True, False, False, False]
+    # 1 batch of 6, then the 4 missing papers as 2 batches of 2 which fail to parse and are split into single-paper requests
+    assert 'Title 3' in prompts[1] and 'Title 4' in prompts[1]
+    assert len(prompts) == 7, f"Expected 7 requests, got {len(prompts)}"
+
+
+def test_batched_filtering_request_count():
+    """Test that batched filtering sends one request per batch"""
+    papers = create_test_papers(20)
+    config = {'llm_filter_batch_size': 8, 'llm_max_concurrency': 4}
+
+    def fake_get_llm_response(prompt, config, system=None):
+        count = prompt.count('标题：')
+        return '[' + ', '.join('{{"id": {}, "match": {}}}'.format(i + 1, 'true' if i % 2 == 0 else 'false') for i in range(count)) + ']'
+
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response) as mock_response:
+        results = filter_papers_using_llm(papers, 'paper to hunt', config)
+
+    assert mock_response.call_count == 3, f"Expected 3 requests, got {mock_response.call_count}"
+    expected = [paper for i, paper in enumerate(papers) if (i % 8) % 2 == 0]
+    assert results == expected
+
+
+def test_llm_cache_hits_on_rerun(tmp_path):
+    """Test that a rerun with the same prompts is served from the cache, and a new model misses it"""
+    from utils import get_llm_response
+    config = {
+        'model': 'test-model', 'base_url': 'http://localhost:11434/v1', 'api_key': 'ollama',
+        'llm_cache_enabled': True, 'llm_cache_file': str(tmp_path / 'cache.sqlite3')
+    }
+    with patch('utils.requests.Session.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'choices': [{'message': {'content': 'Yes'}}]}
+        assert get_llm_response('prompt', config) == 'Yes'
+        assert get_llm_response('prompt', config) == 'Yes'
+        assert mock_post.call_count == 1, f"Expected 1 request, got {mock_post.call_count}"
+        get_llm_response('prompt', dict(config, model='other-model'))
+        assert mock_post.call_count == 2, f"Expected 2 requests, got {mock_post.call_count}"
+
+
+def test_llm_cache_batches_access_updates_and_evictions(tmp_path):
+    """Test that hits are written in batches, and least recently used entries are evicted every few inserts"""
+    from llm_cache import LLMCache
+    cache = LLMCache(str(tmp_path / 'cache.sqlite3'), max_entries=2)
+    cache.EVICT_EVERY = 3
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    changes = cache._conn.total_changes
+    assert cache.get('a') == 'A' and cache.get('a') == 'A'
+    assert cache._conn.total_changes == changes, "Expected no write per hit"
+    assert len(cache) == 2
+
+    cache.set('c', 'C')  # Third insert: evicts b, the least recently used
+    assert cache.get('b') is None and cache.get('a') == 'A' and len(cache) == 2
+    cache.close()
+    assert LLMCache(str(tmp_path / 'cache.sqlite3')).stats()['entries'] == 2
+
+
+def test_llm_client_retries_transient_errors():
+    """Test that 429/503 responses are retried honoring Retry-After, and other errors are not"""
+    config = {'model': 'test-model', 'base_url': 'http://localhost:11434/v1', 'api_key': '', 'llm_backoff_seconds': 0.01}
+    client = LLMClient(config)
+
+    throttled = Mock(status_code=429, reason='Too Many Requests', headers={'Retry-After': '0.05'})
+    unavailable = Mock(status_code=503, reason='Service Unavailable', headers={})
+    ok = Mock(status_code=200, headers={})
+    ok.json.return_value = {'choices': [{'message': {'content': ' Yes '}}], 'usage': {'prompt_tokens': 10, 'completion_tokens': 1}}
+    with patch.object(client.session, 'post', side_effect=[throttled, unavailable, ok]) as mock_post, patch('utils.time.sleep') as mock_sleep:
+        result = client.complete('prompt')
+    assert result.content == 'Yes'
+    assert result.attempts == 3 and mock_post.call_count == 3
+    assert result.usage == {'prompt_tokens': 10, 'completion_tokens': 1}
+    assert mock_sleep.call_args_list[0][0][0] == 0.05, "Expected Retry-After to be honored"
+
+    bad_request = Mock(status_code=400, reason='Bad Request', headers={})
+    bad_request.raise_for_status.side_effect = requests.HTTPError('400 Bad Request', response=bad_request)
+    with patch.object(client.session, 'post', return_value=bad_request) as mock_post:
+        result = client.complete('prompt')
+    assert result.content is None and mock_post.call_count == 1
+
+
+def test_streaming_classification_stops_at_verdict():
+    """Test that the stream is closed once a Yes/No appears after the thinking process"""
+    config = {'model': 'test-model', 'base_url': 'http://localhost:11434/v1', 'api_key': '', 'llm_classify_max_tokens': 64}
+    client = LLMClient(config)
+    tokens = ['<think>', 'No', ' doubt', ' it', ' fits', '</think>', '\n\n', 'Yes', '.', ' Because', ' it', ' does']
+    lines = ['data: ' + json.dumps({'choices': [{'delta': {'content': token}}]}) for token in tokens] + ['data: [DONE]']
+    consumed = []
+
+    def iter_lines():
+        for line in lines:
+            consumed.append(line)
+            yield line.encode('utf-8')
+            yield b''
+
+    streamed = Mock(status_code=200, headers={})
+    streamed.iter_lines.side_effect = iter_lines
+    with patch.object(client.session, 'post', return_value=streamed) as mock_post:
+        result = client.classify('prompt')
+    assert result.content == 'Yes'
+    body = json.loads(mock_post.call_args[1]['data'])
+    assert body['stream'] is True and body['max_tokens'] == 64
+    assert len(consumed) == tokens.index('.') + 1, "Expected to stop reading right after the verdict"
+    assert streamed.close.called
+
+
+def test_truncated_classification_is_asked_again_without_cap():
+    """Test that a response cut off in the thinking process is not taken as a verdict, and is asked again without the cap"""
+    config = {'model': 'test-model', 'base_url': 'http://localhost:11434/v1', 'api_key': '', 'llm_classify_max_tokens': 8}
+    client = LLMClient(config)
+
+    def stream(tokens, finish_reason):
+        chunks = [{'choices': [{'delta': {'content': token}}]} for token in tokens]
+        chunks[-1]['choices'][0]['finish_reason'] = finish_reason
+        response = Mock(status_code=200, headers={})
+        response.iter_lines.return_value = [('data: ' + json.dumps(chunk)).encode('utf-8') for chunk in chunks] + [b'data: [DONE]']
+        return response
+
+    truncated = stream(['<think>', 'Is', ' it', ' yes', '?', ' Maybe', ' yes'], 'length')
+    answered = stream(['<think>', 'Not', ' about', ' agents', '</think>', '\n\n', 'No', '.'], 'stop')
+    reset_run_metrics()
+    with patch.object(client.session, 'post', side_effect=[truncated, answered]) as mock_post:
+        result = client.classify('prompt')
+    assert result.content == 'No' and result.attempts == 2
+    bodies = [json.loads(call[1]['data']) for call in mock_post.call_args_list]
+    assert bodies[0]['max_tokens'] == 8 and 'max_tokens' not in bodies[1]
+    assert get_run_metrics().counters['llm_classify_truncated'] == 1
+
+    # Cut off without the cap as well: no verdict rather than a Yes
+    client.classify_max_tokens = 0
+    with patch.object(client.session, 'post', return_value=stream(['<think>', 'yes', ' yes'], 'length')) as mock_post:
+        result = client.classify('prompt')
+    assert result.content is None and mock_post.call_count == 1
+
+
+def test_streamed_classification_decodes_utf8():
+    """Test that a non-ASCII event stream without a charset is read as UTF-8, not ISO-8859-1"""
+    client = LLMClient({'model': 'test-model', 'base_url': 'http://localhost:11434/v1', 'api_key': ''})
+    tokens = ['<think>', '这篇论文', '关于智能体', '</think>', '\n\n', 'Yes']
+    body = ''.join('data: {}\n\n'.format(json.dumps({'choices': [{'delta': {'content': token}}]}, ensure_ascii=False)) for token in tokens)
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'text/event-stream'
+    response.raw = io.BytesIO((body + 'data: [DONE]\n\n').encode('utf-8'))
+    with patch.object(client.session, 'post', return_value=response), patch('utils.scan_verdict', wraps=scan_verdict) as mock_scan:
+        assert client.classify('prompt').content == 'Yes'
+    assert '这篇论文关于智能体' in mock_scan.call_args[0][0]
+
+
+def test_prompt_layout_and_abstract_budget():
+    """Test that paper_to_hunt is in the stable system prompt and long abstracts are cut to the token budget"""
+    papers = create_test_papers(2)
+    papers[1]['abstract'] = 'word ' * 1000
+    calls = []
+
+    def fake_get_llm_response(prompt, config, system=None):
+        calls.append((prompt, system))
+        return '[{"id": 1, "match": true}, {"id": 2, "match": false}]'
+
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response):
+        are_papers_match(papers, 'paper to hunt', {'llm_max_abstract_tokens': 50})
+        are_papers_match(create_test_papers(4)[2:], 'paper to hunt', {'llm_max_abstract_tokens': 50})
+    assert calls[0][1] == calls[1][1] and 'paper to hunt' in calls[0][1]
+    assert 'paper to hunt' not in calls[0][0] and 'Title 1' in calls[0][0]
+    assert calls[0][0].count('word') == 50 and calls[0][0].endswith('...')
+
+
+def test_cascade_escalates_uncertain_papers():
+    """Test that the small model decides the confident scores and only the uncertain papers reach the large model"""
+    config = {
+        'model': 'large', 'use_llm_cascade': True,
+        'llm_cascade': [
+            {'name': 'screen', 'model': 'small', 'rule': 'score', 'reject_at_most': 2, 'accept_at_least': 9},
+            {'name': 'escalate', 'rule': 'verdict'},
+        ],
+    }
+    papers = create_test_papers(5)
+    prompts = {'small': [], 'large': []}
+
+    def fake_get_llm_response(prompt, config, system=None):
+        prompts[config['model']].append(prompt)
+        if config['model'] == 'small':
+            # Paper 4 is missing from the reply, paper 5 is in between
+            return '[{"id": 1, "score": 0}, {"id": 2, "score": 10}, {"id": 3, "score": "1"}, {"id": 5, "score": 5}]'
+        return '[{"id": 1, "match": true}, {"id": 2, "match": false}]'
+
+    metrics = reset_run_metrics()
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response):
+        results = are_papers_match(papers, 'paper to hunt', config)
+    assert results == [False, True, False, True, False]
+    assert len(prompts['small']) == 1 and len(prompts['large']) == 1
+    assert 'Title 4' in prompts['large'][0] and 'Title 5' in prompts['large'][0] and 'Title 1' not in prompts['large'][0]
+    assert metrics.counters['llm_cascade_decided_screen'] == 3
+    assert metrics.counters['llm_cascade_decided_escalate'] == 2
+    assert _parse_batch_scores('<think>[{"id": 1, "score": 3}]</think>[{"id": 1, "score": 11}, {"id": 2, "score": 7}]', 2) == {2: 7}
+
+
+def test_cascade_escalates_stage_failures():
+    """Test that the papers a stage fails on are decided by the next stage instead of being assumed to match"""
+    config = {
+        'model': 'large', 'use_llm_cascade': True,
+        'llm_cascade': [{'name': 'screen', 'model': 'small', 'rule': 'verdict'}, {'name': 'escalate', 'rule': 'verdict'}],
+    }
+    calls = []
+
+    def fake_get_llm_response(prompt, config, system=None):
+        calls.append(config['model'])
+        if config['model'] == 'small':
+            return None  # The small model is down
+        return '[{"id": 1, "match": false}, {"id": 2, "match": true}, {"id": 3, "match": false}]'
+
+    metrics = reset_run_metrics()
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response):
+        results = are_papers_match(create_test_papers(3), 'paper to hunt', config)
+    assert results == [False, True, False]
+    assert calls == ['small', 'large']
+    assert metrics.counters['llm_cascade_decided_screen'] == 0
+    assert metrics.counters['llm_cascade_decided_escalate'] == 3
+
+
+def pool_config(**kwargs):
+    config = {
+        'model': 'test-model', 'api_key': '', 'llm_cache_enabled': False, 'llm_backoff_seconds': 0.01,
+        'llm_backends': [
+            {'base_url': 'http://gpu-1/v1/chat/completions', 'weight': 2, 'max_concurrency': 4},
+            {'base_url': 'http://gpu-2/v1/chat/completions', 'weight': 1, 'max_concurrency': 2},
+        ],
+    }
+    config.update(kwargs)
+    return config
+
+
+def test_llm_pool_sends_to_least_loaded_backend():
+    """Test that requests are spread by weight and never exceed the concurrency cap of a backend"""
+    pool = LLMPool(pool_config())
+    gate = threading.Event()
+    lock = threading.Lock()
+    in_flight = {backend.client.base_url: [0, 0] for backend in pool.backends}  # [current, max]
+
+    def fake_complete(backend):
+        def complete(prompt, system=None):
+            counts = in_flight[backend.client.base_url]
+            with lock:
+                counts[0] += 1
+                counts[1] = max(counts[1], counts[0])
+            gate.wait(1)
+            with lock:
+                counts[0] -= 1
+            return Mock(content='Yes', attempts=1, usage=None)
+        return complete
+
+    for backend in pool.backends:
+        backend.client.complete = fake_complete(backend)
+    threads = [threading.Thread(target=pool.complete, args=('prompt {}'.format(i),)) for i in range(12)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    assert [counts[0] for counts in in_flight.values()] == [4, 2], "Expected both backends filled up to their caps"
+    gate.set()
+    for thread in threads:
+        thread.join()
+    assert [counts[1] for counts in in_flight.values()] == [4, 2]
+
+
+def test_llm_pool_fails_over_and_probes_backend_back():
+    """Test that a failing backend is taken out after the threshold and brought back by a successful probe"""
+    pool = LLMPool(pool_config(llm_circuit_failure_threshold=2, llm_circuit_open_seconds=0.1, llm_max_retries=1))
+    first, second = pool.backends
+    first.client.complete = Mock(return_value=Mock(content=None, attempts=1, usage=None))
+    second.client.complete = Mock(return_value=Mock(content='Yes', attempts=1, usage=None))
+    first.client.probe = Mock(return_value=True)
+
+    # The first backend (more weight) is tried first, the request fails over to the second one
+    assert pool.complete('prompt').content == 'Yes'
+    assert pool.complete('prompt').content == 'Yes'
+    assert first.client.complete.call_count == 2 and not first.breaker.available
+    assert pool.complete('prompt').content == 'Yes'
+    assert first.client.complete.call_count == 2, "Expected the backend out of service to be skipped"
+
+    time.sleep(0.15)
+    first.client.complete.return_value = Mock(content='No', attempts=1, usage=None)
+    pool.complete('prompt')  # Starts the probe
+    for _ in range(50):
+        if first.breaker.available:
+            break
+        time.sleep(0.01)
+    assert first.client.probe.called and first.breaker.available
+    assert pool.complete('prompt').content == 'No'
+
+
+def test_llm_pool_fails_over_on_backend_exception():
+    """Test that an exception of a backend counts as a failed attempt, and that the top-level rate limit is shared by the backends"""
+    pool = LLMPool(pool_config(llm_requests_per_minute=120, llm_backends=[
+        {'base_url': 'http://gpu-1/v1/chat/completions', 'weight': 2},
+        {'base_url': 'http://gpu-2/v1/chat/completions', 'requests_per_minute': 30},
+    ]))
+    first, second = pool.backends
+    assert pool.limiter.interval == 0.5
+    assert first.client.limiter.interval == 0 and second.client.limiter.interval == 2.0
+
+    first.client.classify = Mock(side_effect=ValueError('malformed response'))
+    second.client.classify = Mock(return_value=Mock(content='No', attempts=1, usage=None))
+    result = pool.classify('prompt')
+    assert result.content == 'No' and result.attempts == 2
+    assert first.client.classify.called and first.breaker.failures == 1 and first.in_flight == 0
+
+
+def test_scan_verdict():
+    """Test the verdict of partial and complete responses, with and without log-probabilities"""
+    assert scan_verdict('No') is None  # May still become "Novel"
+    assert scan_verdict('No', final=True) == 'No'
+    assert scan_verdict('**Yes**') == 'Yes'
+    assert scan_verdict('<think>yes, but') is None
+    assert scan_verdict('<think>hmm</think>', final=True) is None
+    assert scan_verdict('The paper matches: yes', final=True) == 'Yes'
+    logprobs = [{'token': 'Yes', 'logprob': -0.9, 'top_logprobs': [{'token': 'Yes', 'logprob': -0.9}, {'token': 'No', 'logprob': -0.5}]}]
+    assert scan_verdict('Yes', logprobs=logprobs) == 'No'
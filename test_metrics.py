@@ -0,0 +1,92 @@
+"""
+Test script for verifying the run metrics in metrics.py
+This script tests the instrumentation without making actual API calls
+"""
+
+import json
+from unittest.mock import Mock, patch
+
+from metrics import RunMetrics, percentile, reset_run_metrics
+from utils import LLMClient
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3.0], 90) == 3.0
+    assert percentile([], 50) is None
+
+
+def test_llm_client_records_usage_and_failures():
+    metrics = reset_run_metrics()
+    config = {'model': 'test-model', 'base_url': 'http://llm.test/v1/chat/completions', 'api_key': 'test',
+              'llm_cache_enabled': False, 'llm_max_retries': 1, 'llm_backoff_seconds': 0.01}
+    client = LLMClient(config)
+    ok = Mock(status_code=200)
+    ok.json.return_value = {'choices': [{'message': {'content': 'Yes'}}], 'usage': {'prompt_tokens': 120, 'completion_tokens': 1}}
+    throttled = Mock(status_code=429, reason='Too Many Requests', headers={'Retry-After': '0'})
+    failed = Mock(status_code=400, reason='Bad Request', headers={})
+    failed.raise_for_status.side_effect = Exception('400 Bad Request')
+    with patch.object(client.session, 'post', side_effect=[throttled, ok, failed]):
+        assert client.complete('first').content == 'Yes'
+        assert client.complete('second').content is None
+
+    stats = metrics.report()['llm'][client.backend]
+    assert stats['calls'] == 2
+    assert stats['failures'] == 1
+    assert stats['requests'] == 3
+    assert stats['retries'] == 1
+    assert stats['prompt_tokens'] == 120
+    assert stats['completion_tokens'] == 1
+    assert stats['latency_seconds']['max'] is not None
+
+
+def test_system_prompt_and_prefix_cache_hits():
+    metrics = reset_run_metrics()
+    config = {'model': 'test-model', 'base_url': 'http://llm.test/v1/chat/completions', 'api_key': 'test', 'llm_cache_enabled': False}
+    client = LLMClient(config)
+    responses = []
+    for cached_tokens in (0, 90):
+        response = Mock(status_code=200)
+        response.json.return_value = {'choices': [{'message': {'content': 'Yes'}}],
+                                      'usage': {'prompt_tokens': 100, 'completion_tokens': 1, 'prompt_tokens_details': {'cached_tokens': cached_tokens}}}
+        responses.append(response)
+    with patch.object(client.session, 'post', side_effect=responses) as mock_post:
+        client.complete('paper 1', system='instructions')
+        client.complete('paper 2', system='instructions')
+
+    messages = json.loads(mock_post.call_args[1]['data'])['messages']
+    assert messages == [{'role': 'system', 'content': 'instructions'}, {'role': 'user', 'content': 'paper 2'}]
+    stats = metrics.report()['llm'][client.backend]
+    assert stats['cached_prompt_tokens'] == 90
+    assert stats['prefix_cache_hits'] == 1
+    assert stats['prefix_cache_hit_ratio'] == 0.45
+
+
+def test_report_and_prometheus_textfile(tmp_path):
+    metrics = RunMetrics()
+    with metrics.stage('fetch'):
+        pass
+    metrics.add_time('translate', 1.5)
+    metrics.add_time('translate', 0.5)
+    metrics.increment('arxiv_pages', 3)
+    metrics.increment('lark_batches_sent')
+    metrics.observe_llm_call('model @ "url"', 0.2, True, usage={'prompt_tokens': 10, 'completion_tokens': 2})
+    metrics.observe_llm_call('model @ "url"', 0.0, True, attempts=0, cached=True)
+
+    report = metrics.write_report(str(tmp_path / 'report.json'))
+    with open(tmp_path / 'report.json', 'r', encoding='utf-8') as f:
+        assert json.load(f)['counters'] == {'arxiv_pages': 3, 'lark_batches_sent': 1}
+    assert report['stages']['translate'] == 2.0
+    assert report['llm']['model @ "url"']['cache_hits'] == 1
+    assert report['llm']['model @ "url"']['latency_seconds']['p50'] == 0.2  # Cache hits are not latency samples
+
+    metrics.write_prometheus(str(tmp_path / 'arxiv_today.prom'))
+    text = (tmp_path / 'arxiv_today.prom').read_text(encoding='utf-8')
+    assert '# TYPE arxiv_today_stage_seconds gauge' in text
+    assert 'arxiv_today_stage_seconds{stage="translate"} 2.0' in text
+    assert 'arxiv_today_arxiv_pages 3' in text
+    assert 'arxiv_today_llm_prompt_tokens{backend="model @ \\"url\\""} 10' in text
+    assert 'arxiv_today_llm_latency_seconds{backend="model @ \\"url\\"",quantile="0.5"} 0.2' in text
@@ -0,0 +1,70 @@
+"""
+Test script for verifying the paper record and JSON (de)serialization in paper.py
+"""
+
+import json
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+import paper as paper_json
+from history import PaperHistory
+from paper import Paper, SCHEMA_VERSION
+
+from test_history import create_test_papers
+
+
+def test_paper_record_behaves_like_dict():
+    """Test that Paper has the dict interface and serializes to the same JSON object"""
+    paper = Paper(title='Title', id='2501.00001', abstract='摘要', comment='', categories=['cs.CL'])
+    assert paper == {'title': 'Title', 'id': '2501.00001', 'abstract': '摘要', 'comment': '', 'categories': ['cs.CL']}
+    assert 'zh_abstract' not in paper and paper.get('zh_abstract') is None and len(paper) == 5
+    paper['zh_abstract'] = '中文'
+    paper['score'] = 1  # Key outside the schema
+    assert list(paper) == ['title', 'id', 'abstract', 'comment', 'categories', 'zh_abstract', 'score']
+    assert json.loads(paper_json.dumps([paper])) == [paper.to_dict()]
+    assert not hasattr(paper, '__dict__')
+    copy = paper.copy()
+    copy['score'] = 2
+    assert paper['score'] == 1
+
+    # Standard library fallback when orjson and msgspec are not installed
+    with patch.object(paper_json, 'orjson', None), patch.object(paper_json, 'msgspec', None):
+        text = paper_json.dumps(paper, indent=True)
+        assert paper_json.loads(text) == paper and '    "title"' in text
+        with pytest.raises(ValueError):
+            paper_json.loads('{"id": "2501.0')
+
+
+def test_history_yields_papers(tmp_path):
+    """Test that the history reads the records back as Papers"""
+    history = PaperHistory(str(tmp_path / 'history'))
+    papers = [Paper.from_dict(paper) for paper in create_test_papers(1, 3)]
+    history.append(papers, date=datetime.date(2025, 1, 1))
+    stored = list(history.iter_papers())
+    assert all(isinstance(paper, Paper) for paper in stored)
+    assert stored == papers
+    assert history.export_json(str(tmp_path / 'papers.json')) == 3
+    with open(tmp_path / 'papers.json', 'r', encoding='utf-8') as f:
+        assert json.load(f) == create_test_papers(1, 3)
+
+
+def test_schema_version_is_persisted_and_checked(tmp_path):
+    """Test that each history segment starts with the schema version, and an unknown version fails loudly"""
+    history = PaperHistory(str(tmp_path / 'history'))
+    history.append(create_test_papers(1, 2), date=datetime.date(2025, 1, 1))
+    history.append(create_test_papers(3, 1), date=datetime.date(2025, 1, 2))
+    segment = history.segment_files()[0]
+    with open(segment, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[0]) == {'schema_version': SCHEMA_VERSION} and len(lines) == 4
+    assert [paper['id'] for paper in history.iter_papers()] == ['2501.00003', '2501.00001', '2501.00002']
+
+    # Segment written by a newer release
+    with open(segment, 'w', encoding='utf-8') as f:
+        f.write('\n'.join([json.dumps({'schema_version': SCHEMA_VERSION + 1})] + lines[1:]) + '\n')
+    with pytest.raises(ValueError):
+        list(PaperHistory(str(tmp_path / 'history')).iter_papers())
+    with pytest.raises(ValueError):
+        paper_json.loads_papers('[]', version=SCHEMA_VERSION + 1)
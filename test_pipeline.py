@@ -0,0 +1,77 @@
+"""
+Test script for verifying the streaming pipeline in pipeline.py
+This script tests the pipeline without making actual API calls
+"""
+
+import time
+import threading
+from unittest.mock import patch
+
+from pipeline import run_pipeline
+
+
+def create_test_papers(start, count):
+    """Create a list of test papers"""
+    return [
+        {
+            'title': f'Title {i}',
+            'id': f'2501.{i:05d}',
+            'abstract': f'Abstract {i} about agent' if i % 3 else f'Abstract {i} about video agent',
+            'url': f'https://arxiv.org/abs/2501.{i:05d}',
+            'published': '2025-01-01',
+            'comment': None
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def test_pipeline_streams_pages_and_keeps_order():
+    """Test that LLM work starts before the last page arrives, and the result keeps the fetch order"""
+    events = []
+    lock = threading.Lock()
+
+    def pages():
+        for start in (0, 10, 20):
+            with lock:
+                events.append('page')
+            yield create_test_papers(start, 10) + create_test_papers(0, 2)  # Overlapping papers from another category
+            time.sleep(0.05)  # Politeness delay of the arXiv client
+
+    def fake_are_papers_match(papers, paper_to_hunt, config):
+        with lock:
+            events.append('llm')
+        return [int(paper['id'][-1]) % 2 == 0 for paper in papers]
+
+    def fake_translate_abstract(abstract, config):
+        return '中文 ' + abstract
+
+    config = {'llm_filter_batch_size': 4, 'llm_max_concurrency': 4, 'translation_reuse_enabled': False}
+    with patch('pipeline.are_papers_match', side_effect=fake_are_papers_match), \
+            patch('llm.translate_abstract', side_effect=fake_translate_abstract):
+        papers, stats = run_pipeline(
+            pages(), config, seen_ids={'2501.00002'}, paper_to_hunt='agents', keyword_list=['agent', '-video'],
+            use_llm_for_filtering=True, use_llm_for_translation=True
+        )
+
+    expected = [paper for paper in create_test_papers(0, 30) if int(paper['id'][-1]) % 2 == 0 and int(paper['id'][-2:]) % 3 and paper['id'] != '2501.00002']
+    assert [paper['id'] for paper in papers] == [paper['id'] for paper in expected]
+    assert all(paper['zh_abstract'] == '中文 ' + paper['abstract'] for paper in papers)
+    assert stats['fetched'] == 36 and stats['deduplicated'] == 29
+    assert events.index('llm') < len(events) - 1 - events[::-1].index('page'), "Expected LLM work before the last page"
+
+
+def test_prefilter_does_not_depend_on_paging():
+    """Test that the relevance pre-filter decides the same however the papers are paged"""
+    papers = create_test_papers(0, 12)
+    for i, paper in enumerate(papers):
+        paper['abstract'] = 'LLM agent benchmark for tool use' if i % 4 == 0 else 'Video agent for {} scene understanding'.format(i)
+    config = {'use_relevance_prefilter': True, 'prefilter_reject_below': 0.07, 'prefilter_accept_above': 0.65, 'llm_max_concurrency': 2}
+
+    def run(pages):
+        with patch('pipeline.are_papers_match', side_effect=lambda chunk, paper_to_hunt, config: [False] * len(chunk)):
+            kept, stats = run_pipeline(iter(pages), config, paper_to_hunt='LLM agent benchmark', use_llm_for_filtering=True)
+        return [paper['id'] for paper in kept], stats
+
+    kept, stats = run([papers])
+    assert stats['prefilter_accepted'] and stats['prefilter_uncertain'] + stats['prefilter_rejected']
+    assert run([papers[:1], papers[1:2], papers[2:]]) == (kept, stats)
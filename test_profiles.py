@@ -0,0 +1,164 @@
+"""
+Test script for verifying the multi-profile fan-out in main.py
+This script tests the fan-out without making actual API calls
+"""
+
+import time
+import threading
+from unittest.mock import patch
+
+import pytest
+
+import main
+from pipeline import PageFanOut
+
+from test_pipeline import create_test_papers
+
+
+def make_config(tmp_path):
+    return {
+        'tag': 'Default',
+        'category_list': ['cs.CL'],
+        'keyword_list': [],
+        'use_llm_for_filtering': False,
+        'use_llm_for_translation': True,
+        'history_dir': str(tmp_path / 'history'),
+        'merged_category_query': True,
+        'llm_max_concurrency': 2,
+        'llm_cache_enabled': False,
+        'run_report_dir': '',
+        'profiles': [
+            {'name': 'agent', 'tag': 'Agent', 'category_list': ['cs.CL', 'cs.AI'], 'keyword_list': ['agent', '-video'], 'webhook_url': 'https://agent.test'},
+            {'name': 'video', 'tag': 'Video', 'category_list': ['cs.CV', 'cs.AI'], 'keyword_list': ['video'], 'webhook_url': 'https://video.test'},
+            {'name': 'raw', 'tag': 'Raw', 'category_list': ['cs.CL'], 'keyword_list': [], 'use_llm_for_translation': False},
+        ]
+    }
+
+
+def test_profiles_share_fetch_and_translation(tmp_path):
+    """Test that categories are fetched once, and each paper is translated once across profiles"""
+    config = make_config(tmp_path)
+    papers = create_test_papers(0, 12)
+    for i, paper in enumerate(papers):
+        paper['categories'] = [['cs.CL'], ['cs.AI'], ['cs.CV'], ['cs.AI']][i % 4]
+    fetches, translations, posts = [], [], {}
+
+    def fake_iter_latest_papers(category, **kwargs):
+        fetches.append(category)
+        yield [dict(paper) for paper in papers]
+
+    def fake_translate_abstract(abstract, config):
+        translations.append(abstract)
+        return '中文 ' + abstract
+
+    profiles = main.get_profiles(config)
+    with patch('main.iter_latest_papers', side_effect=fake_iter_latest_papers), \
+            patch('llm.translate_abstract', side_effect=fake_translate_abstract), \
+            patch('main.resend_outbox'), \
+            patch('main.post_to_lark_webhook', side_effect=lambda tag, papers, config, checkpoint: posts.setdefault(config['name'], papers)):
+        results = main.run_profiles(config, profiles)
+
+    assert fetches == [['cs.CL', 'cs.AI', 'cs.CV']]
+    ids = {name: [paper['id'] for paper in papers] for name, papers in results.items()}
+    # cs.CL/cs.AI papers about agents, not video (every 3rd abstract mentions video)
+    assert ids['agent'] == ['2501.{:05d}'.format(i) for i in (1, 4, 5, 7, 8, 11)]
+    # cs.CV/cs.AI papers about video
+    assert ids['video'] == ['2501.{:05d}'.format(i) for i in (3, 6, 9)]
+    # All cs.CL papers, untranslated even if another profile translated them
+    assert ids['raw'] == ['2501.{:05d}'.format(i) for i in (0, 4, 8)]
+    translated_ids = set(ids['agent']) | set(ids['video'])
+    assert len(translations) == len(translated_ids)
+    assert all(paper['zh_abstract'] for paper in results['agent'])
+    assert all('zh_abstract' not in paper for paper in results['raw'])
+    assert [paper['id'] for paper in posts['agent']] == ids['agent']
+
+    # Each profile keeps its own history
+    for profile in profiles:
+        assert len(main.get_paper_history(profile, migrate_legacy=False).seen_ids) == len(ids[profile['name']])
+
+
+def test_profiles_must_not_share_history_dir(tmp_path):
+    """Test that a profile reusing the top-level (or another profile's) history directory is rejected"""
+    config = make_config(tmp_path)
+    config['profiles'][1]['history_dir'] = config['history_dir']
+    with pytest.raises(ValueError):
+        main.get_profiles(config)
+
+
+def test_page_fan_out_holds_a_few_pages():
+    """Test that every consumer gets every page in order, and a fast consumer does not run far ahead of a slow one"""
+    fetched = []
+
+    def pages():
+        for i in range(20):
+            fetched.append(i)
+            yield [i]
+
+    fan_out = PageFanOut(pages(), 2, max_pending=2)
+    results, leads = [[], []], []
+
+    def consume(consumer, branch, delay):
+        for page in branch:
+            results[consumer].append(page[0])
+            leads.append(len(fetched) - len(results[1]))
+            time.sleep(delay)
+
+    threads = [threading.Thread(target=consume, args=(i, branch, delay)) for i, (branch, delay) in enumerate(zip(fan_out.branches(), (0, 0.005)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [list(range(20))] * 2
+    assert max(leads) <= 3, "Expected the fetch to wait for the slow consumer"
+
+
+def test_failed_profile_does_not_hold_the_others(tmp_path):
+    """Test that a profile failing mid-fetch releases its branch, so the other profiles still finish and are posted"""
+    config = make_config(tmp_path)
+    papers = create_test_papers(0, 12)
+    for paper in papers:
+        paper['categories'] = ['cs.CL', 'cs.AI', 'cs.CV']
+    posts = {}
+    filter_pages = main.filter_pages
+
+    def fake_iter_latest_papers(category, **kwargs):
+        # More pages than the fan-out holds, a consumer which never reads them would block the fetch
+        for paper in papers:
+            yield [dict(paper)]
+
+    def fake_filter_pages(pages, config, *args, **kwargs):
+        if config['name'] == 'video':
+            next(iter(pages))
+            raise RuntimeError('Filter failed')
+        return filter_pages(pages, config, *args, **kwargs)
+
+    profiles = main.get_profiles(config)
+    errors = []
+
+    def run():
+        try:
+            main.run_profiles(config, profiles)
+        except RuntimeError as e:
+            errors.append(e)
+
+    with patch('main.iter_latest_papers', side_effect=fake_iter_latest_papers), \
+            patch('main.filter_pages', side_effect=fake_filter_pages), \
+            patch('llm.translate_abstract', side_effect=lambda abstract, config: '中文 ' + abstract), \
+            patch('main.resend_outbox'), \
+            patch('main.post_to_lark_webhook', side_effect=lambda tag, papers, config, checkpoint: posts.setdefault(config['name'], papers)):
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+    assert not thread.is_alive(), "Expected the healthy profiles not to wait for the failed one"
+    assert sorted(posts) == ['agent', 'raw']
+    assert len(errors) == 1 and 'video' in str(errors[0])
+
+
+def test_missing_paper_to_hunt_fails_before_fetch(tmp_path):
+    """Test that a missing `paper_to_hunt_file` is reported before anything is fetched"""
+    config = make_config(tmp_path)
+    config['profiles'][1].update(use_llm_for_filtering=True, paper_to_hunt_file=str(tmp_path / 'missing.md'))
+    profiles = main.get_profiles(config)
+    with patch('main.iter_latest_papers') as iter_latest_papers, pytest.raises(OSError):
+        main.run_profiles(config, profiles)
+    iter_latest_papers.assert_not_called()
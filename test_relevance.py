@@ -0,0 +1,39 @@
+"""
+Test script for verifying the local relevance pre-filter in relevance.py
+"""
+
+from relevance import score_papers, prefilter_papers
+
+PAPER_TO_HUNT = '我正在寻找关于大语言模型安全的论文，包括越狱攻击（Jailbreak Attack）、后门（Backdoor）以及检索增强生成（Retrieval-Augmented Generation, RAG）的安全。'
+
+
+def make_paper(paper_id, title, abstract):
+    return {'id': paper_id, 'title': title, 'abstract': abstract}
+
+
+PAPERS = [
+    make_paper('1', 'Jailbreak attacks on aligned language models', 'We study jailbreak attack prompts and backdoor triggers against retrieval-augmented generation.'),
+    make_paper('2', 'Protein structure prediction', 'A diffusion network predicts protein folding from sequences.'),
+    make_paper('3', 'Scaling vision transformers', 'We train vision transformers and measure backdoor risks in data pipelines.'),
+    make_paper('4', '', ''),
+]
+
+
+def test_scores_rank_relevant_papers_first():
+    """Test that on-topic papers score higher than off-topic ones"""
+    scores = score_papers(PAPERS, PAPER_TO_HUNT)
+    assert len(scores) == 4
+    assert scores[0] > scores[2] > scores[1] == 0
+    assert scores[3] == 0
+    assert all(0 <= score <= 1 for score in scores)
+    assert len(score_papers([], PAPER_TO_HUNT)) == 0
+
+
+def test_prefilter_bands():
+    """Test that papers are split into accepted, uncertain and rejected bands keeping the order"""
+    scores = score_papers(PAPERS, PAPER_TO_HUNT)
+    config = {'prefilter_reject_below': scores[2] / 2, 'prefilter_accept_above': scores[0]}
+    accepted, uncertain, rejected = prefilter_papers(PAPERS, PAPER_TO_HUNT, config)
+    assert [paper['id'] for paper in accepted] == ['1']
+    assert [paper['id'] for paper in uncertain] == ['3']
+    assert [paper['id'] for paper in rejected] == ['2', '4']
@@ -0,0 +1,80 @@
+"""
+Test script for verifying the batched translation in llm.py and the translation store in translation_store.py
+This script tests the translation without making actual API calls
+"""
+
+import json
+import re
+from unittest.mock import patch
+
+from arxiv_paper import translate_abstracts
+from llm import translate_abstracts_batch, _parse_batch_translations
+from translation_store import TranslationStore
+
+from test_pipeline import create_test_papers
+
+
+def test_parse_batch_translations():
+    response = '<think>\n<<<1>>>\n...</think>\n<<<1>>>\n第一篇\n\n<<< 2 >>>\n第二篇\n<<<3>>>\n<<<4>>>\n第四篇\n<<<4>>>\n重复\n<<<9>>>\n越界'
+    assert _parse_batch_translations(response, 5) == {1: '第一篇', 2: '第二篇'}
+    assert _parse_batch_translations('没有编号的翻译', 2) == {}
+
+
+def test_batch_translation_resplits_misaligned_replies():
+    """Test that missing or merged translations are retried in smaller batches, down to the single prompt"""
+    abstracts = ['Abstract number {}. '.format(i) * 10 for i in range(6)]
+    prompts = []
+
+    def fake_get_llm_response(prompt, config, system=None):
+        prompts.append(prompt)
+        numbers = re.findall(r'^<<<(\d+)>>>$', prompt, flags=re.MULTILINE)
+        if len(numbers) == 6:
+            # The 2nd translation is missing and the 4th one swallows the 5th abstract
+            return '\n'.join('<<<{}>>>\n{}'.format(number, '译' * (60 if number == '4' else 30))
+                             for number in numbers if number not in ('2', '5'))
+        return '\n'.join('<<<{}>>>\n{}'.format(number, '译' * 30) for number in numbers)
+
+    with patch('llm.get_llm_response', side_effect=fake_get_llm_response), \
+            patch('llm.translate_abstract', side_effect=lambda abstract, config: '单独 ' + abstract) as mock_single:
+        results = translate_abstracts_batch(abstracts, {})
+
+    assert results[0] == results[2] == results[5] == '译' * 30
+    # 2nd, 4th and 5th retried as [2nd, 4th] then [5th]
+    assert results[1] == results[3] == '译' * 30
+    assert results[4] == '单独 ' + abstracts[4]
+    assert len(prompts) == 2 and mock_single.call_count == 1
+
+
+def test_translations_are_reused_by_id_and_abstract(tmp_path):
+    """Test that stored translations (including the history ones) are reused unless the abstract changed"""
+    directory = tmp_path / 'history'
+    directory.mkdir()
+    old_papers = create_test_papers(0, 2)
+    old_papers[0]['zh_abstract'] = '历史翻译'
+    with open(directory / '2025-01.jsonl', 'w', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(paper, ensure_ascii=False) + '\n' for paper in old_papers))
+    config = {'history_dir': str(directory), 'llm_translate_batch_size': 4, 'llm_max_concurrency': 2}
+    requested = []
+
+    def fake_translate_abstracts_batch(abstracts, config):
+        requested.append(len(abstracts))
+        return ['中文 ' + abstract for abstract in abstracts]
+
+    papers = create_test_papers(0, 6)
+    papers[1]['abstract'] += ' (v2)'
+    with patch('arxiv_paper.translate_abstracts_batch', side_effect=fake_translate_abstracts_batch):
+        translate_abstracts(papers, config, progress=False)
+        assert papers[0]['zh_abstract'] == '历史翻译'
+        assert all(paper['zh_abstract'] == '中文 ' + paper['abstract'] for paper in papers[1:])
+        assert sorted(requested) == [1, 4]
+
+        requested.clear()
+        again = create_test_papers(0, 6)
+        again[1]['abstract'] += '\n(v2)'  # Same abstract, wrapped differently
+        translate_abstracts(again, config, progress=False)
+        assert requested == []
+        assert [paper['zh_abstract'] for paper in again] == [paper['zh_abstract'] for paper in papers]
+
+    store = TranslationStore(str(directory / 'translations.sqlite3'))
+    assert len(store) == 6
+    assert store.seed_from_history(str(directory)) == 0  # Seeded once
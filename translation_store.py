@@ -0,0 +1,134 @@
+"""
+Store of translated abstracts
+"""
+
+import os
+import glob
+import time
+import sqlite3
+import hashlib
+import threading
+
+from history import get_history_dir
+from paper import loads
+
+
+class TranslationStore:
+    """
+    Translated abstracts keyed by (paper id, abstract hash) in SQLite
+    A translation is only reused for the same abstract, so a revised abstract (new arXiv version) is translated again.
+    The store is seeded once from the paper history (`zh_abstract` of the stored papers).
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: the file path of the SQLite database
+        """
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS translations ('
+            'paper_id TEXT NOT NULL, abstract_hash TEXT NOT NULL, zh_abstract TEXT NOT NULL, created_at REAL NOT NULL, '
+            'PRIMARY KEY (paper_id, abstract_hash))'
+        )
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+    @staticmethod
+    def hash_abstract(abstract: str) -> str:
+        # Whitespace differences (line breaks of the arXiv feed) do not change the translation
+        return hashlib.sha256(' '.join(abstract.split()).encode('utf-8')).hexdigest()
+
+    def lookup(self, papers: list) -> dict:
+        """
+        Look up the stored translations of papers
+        :param papers: a list of papers
+        :return: a dict mapping the paper id to its translated abstract, for the papers found
+        """
+        found = {}
+        with self._lock:
+            for paper in papers:
+                row = self._conn.execute(
+                    'SELECT zh_abstract FROM translations WHERE paper_id = ? AND abstract_hash = ?',
+                    (paper['id'], self.hash_abstract(paper['abstract']))
+                ).fetchone()
+                if row:
+                    found[paper['id']] = row[0]
+        return found
+
+    def save(self, papers) -> int:
+        """
+        Store the translations of papers
+        :param papers: an iterable of papers, those without `zh_abstract` are skipped
+        :return: the number of translations stored
+        """
+        now = time.time()
+        rows = [
+            (paper['id'], self.hash_abstract(paper['abstract']), paper['zh_abstract'], now)
+            for paper in papers if paper.get('zh_abstract') and paper.get('abstract')
+        ]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO translations (paper_id, abstract_hash, zh_abstract, created_at) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def seed_from_history(self, directory: str) -> int:
+        """
+        Import the translations of every history under `directory` (including profile histories), once
+        :param directory: the history directory
+        :return: the number of translations imported
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+                return 0
+        count = 0
+        for file_path in sorted(glob.glob(os.path.join(directory, '**', '*.jsonl'), recursive=True)):
+            papers = []
+            with open(file_path, 'rb') as f:
+                for line in f:
+                    try:
+                        papers.append(loads(line))
+                    except ValueError:
+                        continue
+            count += self.save(paper for paper in papers if isinstance(paper, dict) and 'id' in paper)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)", (str(time.time()),))
+            self._conn.commit()
+        return count
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_translation_store(config: dict):
+    """
+    Get the shared translation store of the history directory described by the configuration
+    :param config: the configuration, fields include `translation_reuse_enabled`, `history_dir`
+    :return: the TranslationStore or None if reuse is disabled
+    """
+    if not config.get('translation_reuse_enabled', True):
+        return None
+    directory = get_history_dir(config)
+    file_path = os.path.join(directory, 'translations.sqlite3')
+    with _stores_lock:
+        if file_path not in _stores:
+            os.makedirs(directory, exist_ok=True)
+            store = TranslationStore(file_path)
+            count = store.seed_from_history(directory)
+            if count:
+                print('Imported {} translations from the paper history'.format(count))
+            _stores[file_path] = store
+        return _stores[file_path]
@@ -3,14 +3,20 @@ Utility Functions
 """
 
 import os
-import yaml
-import requests
+import re
+import math
+import time
 import json
-
-def load_config():
-    yaml_file = os.path.join(os.path.dirname(__file__), 'config.yaml')
-    with open(yaml_file, 'r', encoding='utf-8') as file:
-        return yaml.safe_load(file)
+import random
+import datetime
+import threading
+import email.utils
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from llm_cache import LLMCache, get_llm_cache
+from metrics import get_run_metrics
+from settings import CONFIG_FILE, load_config
 
 
 def validate_llm_server_config(config: dict) -> dict:
@@ -31,48 +37,712 @@ def validate_llm_server_config(config: dict) -> dict:
     return llm_server_config
 
 
-def get_llm_response(prompt: str, config: dict):
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces calls evenly to at most `requests_per_minute`, allowing bursts of `burst` calls
+    """
+
+    def __init__(self, requests_per_minute=0, burst=1):
+        """
+        :param requests_per_minute: the maximum number of calls per minute (0 or None for unlimited)
+        :param burst: the number of calls allowed back to back before spacing applies
+        """
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.burst = max(int(burst), 1)
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def acquire(self):
+        """
+        Block until the next call is allowed
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            next_time = max(self._next_time, now)
+            wait = next_time - (self.burst - 1) * self.interval - now
+            self._next_time = next_time + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+THINK_PATTERN = re.compile(r'<think>.*?(</think>|$)', re.DOTALL)
+LEADING_VERDICT_PATTERN = re.compile(r'^[\W_]*(yes|no)\b', re.IGNORECASE)
+
+
+def _is_thinking(text: str) -> bool:
+    start = text.rfind('<think>')
+    return start != -1 and text.find('</think>', start) == -1
+
+
+def _logprob_verdict(logprobs):
+    """
+    Get the verdict of the first answer token from its top log-probabilities
+    """
+    received = ''
+    for entry in logprobs:
+        token = entry.get('token', '')
+        thinking = _is_thinking(received)
+        received += token
+        if thinking or '<think>' in token or '</think>' in token:
+            continue
+        word = token.strip(' \n\t*"\'.:').lower()
+        if word in ('yes', 'no'):
+            top = entry.get('top_logprobs') or [entry]
+            p_yes = sum(math.exp(item['logprob']) for item in top if item.get('token', '').strip(' \n\t*"\'.:').lower() == 'yes')
+            p_no = sum(math.exp(item['logprob']) for item in top if item.get('token', '').strip(' \n\t*"\'.:').lower() == 'no')
+            return 'Yes' if p_yes >= p_no else 'No'
+        if word:
+            return None  # The answer does not start with Yes/No
+    return None
+
+
+def scan_verdict(text: str, final=False, logprobs=()):
+    """
+    Find the Yes/No verdict in a (partial) response
+    The verdict is the leading Yes/No outside the `<think>...</think>` block. Until the response is complete, a
+    verdict at the very end of the text is not trusted yet (`No` may become `Novel`).
+    :param text: the response received so far
+    :param final: whether the response is complete, then any `yes` in the answer counts as Yes (as `is_paper_match` did)
+    :param logprobs: the `logprobs.content` entries received so far, if the first answer token is Yes/No its top
+        log-probabilities decide the verdict
+    :return: 'Yes', 'No' or None if not known (yet)
+    """
+    verdict = _logprob_verdict(logprobs) if logprobs else None
+    if verdict is not None:
+        return verdict
+    if not final and _is_thinking(text):
+        return None
+    answer = THINK_PATTERN.sub('', text)
+    match = LEADING_VERDICT_PATTERN.match(answer)
+    if match and (final or match.end() < len(answer)):
+        return match.group(1).capitalize()
+    if final and answer.strip():
+        return 'Yes' if 'yes' in answer.lower() else 'No'
+    return None
+
+
+# Verdict of a response cut off (by the output token cap) before the answer, e.g. inside the `<think>` block
+TRUNCATED = 'truncated'
+
+
+def _truncated_verdict(text: str, finish_reason=None, logprobs=()):
+    """
+    Get the verdict of a complete response, or TRUNCATED if it was cut off before the answer
+    """
+    verdict = scan_verdict(text, final=True, logprobs=logprobs)
+    if verdict is None and (finish_reason == 'length' or _is_thinking(text)):
+        return TRUNCATED
+    return verdict
+
+
+LLMResult = namedtuple('LLMResult', ['content', 'latency', 'attempts', 'usage', 'cached'])
+LLMResult.__doc__ = """
+Result of an LLM request
+- content: the response content or None if failed
+- latency: the wall time of the request in seconds, including retries
+- attempts: the number of HTTP requests sent
+- usage: the `usage` field of the response (if any)
+- cached: whether the response is served from the cache
+"""
+
+def _cache_prompt(prompt: str, system=None) -> str:
+    """
+    The text identifying a request in the LLM cache (the prompt alone without system prompt, as before)
+    """
+    return prompt if not system else system + '\x00' + prompt
+
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """
+    Parse the `Retry-After` header
+    :param value: the header value, either seconds or an HTTP date
+    :return: the number of seconds to wait or None if missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+class LLMClient:
+    """
+    Reusable client of an OpenAI-compatible LLM Server
+    The configuration is validated once, HTTP connections are kept alive in a pooled `requests.Session`,
+    and transient errors (timeouts, connection errors, 429 and 5xx) are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: LLM Server configuration, fields include `model`, `base_url`, `api_key` etc.
+        """
+        llm_server_config = validate_llm_server_config(config)
+        self.model = llm_server_config['model']
+        self.base_url = llm_server_config['base_url']
+        self.api_key = llm_server_config['api_key']
+        self.timeout = float(config.get('llm_timeout') or 30)
+        self.max_retries = int(config.get('llm_max_retries', 3) or 0)
+        self.backoff_seconds = float(config.get('llm_backoff_seconds') or 1.0)
+        self.max_backoff_seconds = float(config.get('llm_max_backoff_seconds') or 60.0)
+        max_concurrency, requests_per_minute = get_llm_concurrency(config)
+        self.limiter = RateLimiter(requests_per_minute)
+        self.cache = get_llm_cache(config)
+        self.classify_streaming = bool(config.get('llm_classify_streaming', True))
+        self.classify_max_tokens = int(config.get('llm_classify_max_tokens', 0) or 0)
+        self.classify_logprobs = bool(config.get('llm_classify_logprobs', False))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(max_concurrency, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}'
+        })
+
+    def _backoff(self, attempt: int, retry_after=None) -> float:
+        """
+        Get the delay before the next attempt
+        :param attempt: the number of failed attempts so far (starting from 1)
+        :param retry_after: the delay requested by the server (if any)
+        :return: the delay in seconds
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff_seconds)
+        delay = min(self.backoff_seconds * 2 ** (attempt - 1), self.max_backoff_seconds)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @property
+    def backend(self) -> str:
+        """
+        The name of the backend in the run metrics
+        """
+        return '{} @ {}'.format(self.model, self.base_url)
+
+    def complete(self, prompt: str, system=None) -> LLMResult:
+        """
+        Send a single-turn chat completion request
+        :param prompt: user prompt
+        :param system: system prompt (if any), put the content shared by many requests here so that servers with
+            prefix caching reuse it
+        :return: the LLMResult, whose content is None if failed
+        """
+        return self._observe(self._complete(prompt, system))
+
+    def classify(self, prompt: str, system=None) -> LLMResult:
+        """
+        Ask a Yes/No question, reading no more of the response than needed
+        The response is streamed (with at most `llm_classify_max_tokens` output tokens, if set), and the stream is
+        closed as soon as a leading Yes/No appears outside the `<think>...</think>` block. A response cut off by the cap
+        before the answer is asked again without the cap. With `llm_classify_logprobs`, the verdict of the first answer
+        token is taken from its top log-probabilities (if the backend returns them).
+        :param prompt: user prompt, asking for a Yes/No answer
+        :param system: system prompt (if any)
+        :return: the LLMResult, whose content is 'Yes', 'No' or None if failed
+        """
+        return self._observe(self._classify(prompt, system))
+
+    def _observe(self, result: LLMResult) -> LLMResult:
+        get_run_metrics().observe_llm_call(
+            self.backend, result.latency, result.content is not None,
+            attempts=result.attempts, usage=result.usage, cached=result.cached
+        )
+        return result
+
+    def _request_data(self, prompt: str, system=None, **kwargs) -> dict:
+        data = {
+            'model': self.model,
+            'messages': [
+                {
+                    'role': 'user',
+                    'content': prompt
+                }
+            ],
+            'stream': False
+        }
+        if system:
+            data['messages'].insert(0, {'role': 'system', 'content': system})
+        data.update(kwargs)
+        return data
+
+    def _send(self, data: dict, parse):
+        """
+        Send a request, retrying transient errors with backoff
+        :param data: the request body
+        :param parse: the function turning the response into (content, usage)
+        :return: (content, usage, attempts), content is None if failed
+        """
+        body = json.dumps(data)
+        stream = data.get('stream', False)
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            self.limiter.acquire()
+            try:
+                response = self.session.post(self.base_url, data=body, timeout=self.timeout, stream=stream)
+                try:
+                    if response.status_code in RETRYABLE_STATUS_CODES and attempt <= self.max_retries:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        raise requests.HTTPError('{} {}'.format(response.status_code, response.reason), response=response)
+                    response.raise_for_status()
+                    content, usage = parse(response)
+                finally:
+                    if stream:
+                        # Closing the connection early stops the generation on the server
+                        response.close()
+                return content, usage, attempt
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                status_code = e.response.status_code if e.response is not None else None
+                retryable = status_code is None or status_code in RETRYABLE_STATUS_CODES
+                if not retryable or attempt > self.max_retries:
+                    print('LLM Server Error: {}'.format(e))
+                    return None, None, attempt
+                delay = self._backoff(attempt, retry_after)
+                print('LLM Server Error: {}. Retrying in {:.1f}s ({}/{})'.format(e, delay, attempt, self.max_retries))
+                time.sleep(delay)
+            except Exception as e:
+                print('LLM Server Error: {}'.format(e))
+                return None, None, attempt
+
+    def _complete(self, prompt: str, system=None) -> LLMResult:
+        start = time.monotonic()
+        # Responses are cached by (model, base_url, prompt), see `llm_cache_enabled` in config.yaml
+        cache_key = LLMCache.make_key(self.model, self.base_url, _cache_prompt(prompt, system)) if self.cache is not None else None
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return LLMResult(cached, time.monotonic() - start, 0, None, True)
+
+        def parse(response):
+            result = response.json()
+            return result['choices'][0]['message']['content'].strip(), result.get('usage')
+
+        content, usage, attempts = self._send(self._request_data(prompt, system), parse)
+        if self.cache is not None and content:
+            self.cache.set(cache_key, content)
+        return LLMResult(content, time.monotonic() - start, attempts, usage, False)
+
+    def _classify(self, prompt: str, system=None) -> LLMResult:
+        start = time.monotonic()
+        # Verdicts are cached apart from full responses to the same prompt
+        cache_key = LLMCache.make_key(self.model, self.base_url + '#classify', _cache_prompt(prompt, system)) if self.cache is not None else None
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return LLMResult(cached, time.monotonic() - start, 0, None, True)
+
+        content, usage, attempts = self._send_classify(prompt, system, self.classify_max_tokens)
+        if content == TRUNCATED:
+            get_run_metrics().increment('llm_classify_truncated')
+            if self.classify_max_tokens:
+                # Cut off by the cap (e.g. in the thinking process), ask again without it
+                print('LLM response cut off after {} tokens, retrying without the cap'.format(self.classify_max_tokens))
+                content, usage, retry_attempts = self._send_classify(prompt, system, 0)
+                attempts += retry_attempts
+            if content == TRUNCATED:
+                print('LLM response cut off before the answer')
+                content = None
+
+        if self.cache is not None and content:
+            self.cache.set(cache_key, content)
+        return LLMResult(content, time.monotonic() - start, attempts, usage, False)
+
+    def _send_classify(self, prompt: str, system=None, max_tokens=0):
+        """
+        Send a Yes/No question
+        :return: (verdict, usage, attempts), the verdict is 'Yes', 'No', TRUNCATED or None if failed
+        """
+        options = {'max_tokens': max_tokens} if max_tokens else {}
+        if self.classify_logprobs:
+            options.update({'logprobs': True, 'top_logprobs': 5})
+        if self.classify_streaming:
+            options.update({'stream': True, 'stream_options': {'include_usage': True}})
+            return self._send(self._request_data(prompt, system, **options), self._parse_verdict_stream)
+
+        def parse(response):
+            result = response.json()
+            choice = result['choices'][0]
+            logprobs = ((choice.get('logprobs') or {}).get('content') or []) if self.classify_logprobs else []
+            verdict = _truncated_verdict(choice['message']['content'] or '', choice.get('finish_reason'), logprobs)
+            return verdict, result.get('usage')
+        return self._send(self._request_data(prompt, system, **options), parse)
+
+    def _parse_verdict_stream(self, response):
+        """
+        Read a streamed (Server-Sent Events) response until the verdict is known
+        :return: ('Yes' / 'No', TRUNCATED if cut off before the answer or None if the response has no verdict,
+            the `usage` field if already received)
+        """
+        text = ''
+        usage = None
+        finish_reason = None
+        logprobs = []
+        # Decoded by line: `decode_unicode` falls back to ISO-8859-1 for an event stream without a charset
+        for line in response.iter_lines():
+            line = line.decode('utf-8')
+            if not line or not line.startswith('data:'):
+                continue
+            payload = line[len('data:'):].strip()
+            if payload == '[DONE]':
+                break
+            chunk = json.loads(payload)
+            usage = chunk.get('usage') or usage
+            for choice in chunk.get('choices') or []:
+                text += (choice.get('delta') or {}).get('content') or ''
+                finish_reason = choice.get('finish_reason') or finish_reason
+                if self.classify_logprobs:
+                    logprobs.extend((choice.get('logprobs') or {}).get('content') or [])
+            verdict = scan_verdict(text, logprobs=logprobs)
+            if verdict is not None:
+                return verdict, usage
+        return _truncated_verdict(text, finish_reason, logprobs), usage
+
+    def probe(self) -> bool:
+        """
+        Check whether the server is up, with a lightweight `GET .../models` request
+        :return: True if the server answered (any status below 500)
+        """
+        url = self.base_url
+        if url.rstrip('/').endswith('/chat/completions'):
+            url = url.rstrip('/')[:-len('/chat/completions')] + '/models'
+        try:
+            response = self.session.get(url, timeout=min(self.timeout, 10))
+            response.close()
+            return response.status_code < 500
+        except requests.RequestException:
+            return False
+
+    def close(self):
+        self.session.close()
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an LLM backend
+    The circuit opens (the backend is taken out) after `failure_threshold` failed requests in a row. Once it has been
+    open for `open_seconds`, a health probe is due: the circuit closes if the probe succeeds, and opens again otherwise.
+    Not thread-safe, guarded by the lock of the LLMPool.
+    """
+
+    def __init__(self, failure_threshold=3, open_seconds=30):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.open_seconds = float(open_seconds)
+        self.state = 'closed'  # 'closed', 'open' or 'probing'
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def available(self) -> bool:
+        return self.state == 'closed'
+
+    def probe_due(self) -> bool:
+        return self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds
+
+    def record(self, ok: bool) -> bool:
+        """
+        Record the outcome of a request (or a probe)
+        :return: True if the circuit has just opened
+        """
+        if ok:
+            self.state = 'closed'
+            self.failures = 0
+            return False
+        self.failures += 1
+        if self.state == 'probing' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+class LLMBackend:
+    """
+    A backend of the LLMPool: its client, weight, concurrency cap, requests in flight and circuit breaker
+    """
+
+    def __init__(self, client: LLMClient, weight=1.0, max_concurrency=1, breaker=None):
+        self.client = client
+        self.weight = max(float(weight), 0.01)
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.in_flight = 0
+        self.breaker = breaker or CircuitBreaker()
+
+
+class LLMPool:
+    """
+    Load-balanced pool of OpenAI-compatible LLM Servers (see `llm_backends` in config.yaml)
+    Each request goes to the available backend with the fewest requests in flight for its weight, below its
+    `max_concurrency` (requests wait for a free slot otherwise), the pool as a whole starting at most
+    `llm_requests_per_minute`. A backend whose circuit opens is taken out and probed in the background until it answers
+    again. A failed request is retried on another backend, with backoff once every backend has been tried. It has the
+    interface of LLMClient (`complete`, `classify`).
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: the configuration, fields include `llm_backends` (each backend overrides `model`, `base_url`,
+            `api_key` and may set `weight`, `max_concurrency` (default: `llm_max_concurrency`), `requests_per_minute`
+            (default: unlimited)), `llm_requests_per_minute` (shared by the backends), `llm_circuit_failure_threshold`,
+            `llm_circuit_open_seconds`, `llm_max_retries` etc.
+        """
+        self.backends = []
+        for entry in config['llm_backends']:
+            member_config = dict(config, **{key: value for key, value in entry.items() if key in ('model', 'base_url', 'api_key')})
+            member_config.update({
+                # Retries and caching are done by the pool, across backends
+                'llm_max_retries': 0,
+                'llm_cache_enabled': False,
+                'llm_max_concurrency': entry.get('max_concurrency') or config.get('llm_max_concurrency') or 1,
+                'llm_requests_per_minute': entry.get('requests_per_minute') or 0,
+            })
+            self.backends.append(LLMBackend(
+                LLMClient(member_config), weight=entry.get('weight', 1),
+                max_concurrency=member_config['llm_max_concurrency'],
+                breaker=CircuitBreaker(config.get('llm_circuit_failure_threshold', 3), config.get('llm_circuit_open_seconds', 30))
+            ))
+        if not self.backends:
+            raise ValueError('`llm_backends` is empty')
+        self.max_retries = int(config.get('llm_max_retries', 3) or 0)
+        self.timeout = float(config.get('llm_timeout') or 30)
+        # The top-level limit is for the whole pool, on top of the limit of each backend
+        self.limiter = RateLimiter(get_llm_concurrency(config)[1])
+        self.cache = get_llm_cache(config)
+        self.models = '|'.join(sorted(set(backend.client.model for backend in self.backends)))
+        self._condition = threading.Condition()
+
+    @property
+    def backend(self) -> str:
+        """
+        The name of the pool in the run metrics (cache hits), requests are recorded by backend
+        """
+        return 'pool of {} backends'.format(len(self.backends))
+
+    def _start_probe(self, backend: LLMBackend):
+        backend.breaker.state = 'probing'
+
+        def probe():
+            ok = backend.client.probe()
+            with self._condition:
+                backend.breaker.record(ok)
+                if ok:
+                    print('LLM backend {} is back'.format(backend.client.backend))
+                self._condition.notify_all()
+
+        threading.Thread(target=probe, daemon=True).start()
+
+    def _acquire(self, tried: set):
+        """
+        Reserve a slot on the least loaded available backend, preferring the backends not tried yet
+        :return: the LLMBackend or None if every backend stays out of service for longer than the timeout
+        """
+        deadline = None
+        with self._condition:
+            while True:
+                for backend in self.backends:
+                    if backend.breaker.probe_due():
+                        self._start_probe(backend)
+                available = [backend for backend in self.backends if backend.breaker.available]
+                candidates = [backend for backend in available if backend.in_flight < backend.max_concurrency]
+                candidates = [backend for backend in candidates if backend not in tried] or candidates
+                if candidates:
+                    backend = min(candidates, key=lambda backend: (backend.in_flight + 1) / backend.weight)
+                    backend.in_flight += 1
+                    return backend
+                if available:
+                    # Every available backend is busy
+                    deadline = None
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + max(backend.breaker.open_seconds for backend in self.backends) + self.timeout
+                if now >= deadline:
+                    return None
+                self._condition.wait(min(deadline - now, 1.0))
+
+    def _release(self, backend: LLMBackend, ok: bool):
+        with self._condition:
+            backend.in_flight -= 1
+            if backend.breaker.record(ok):
+                print('LLM backend {} is out of service after {} failures'.format(backend.client.backend, backend.breaker.failures))
+                get_run_metrics().increment('llm_circuit_opened')
+            self._condition.notify_all()
+
+    def complete(self, prompt: str, system=None) -> LLMResult:
+        """
+        Send a single-turn chat completion request to a backend of the pool (see `LLMClient.complete`)
+        """
+        return self._call(prompt, system, 'complete', '')
+
+    def classify(self, prompt: str, system=None) -> LLMResult:
+        """
+        Ask a Yes/No question to a backend of the pool (see `LLMClient.classify`)
+        """
+        return self._call(prompt, system, 'classify', '#classify')
+
+    def _call(self, prompt: str, system, method: str, cache_suffix: str) -> LLMResult:
+        start = time.monotonic()
+        # Any backend of the pool may answer, responses are cached by the models of the pool
+        cache_key = LLMCache.make_key(self.models, 'llm_backends' + cache_suffix, _cache_prompt(prompt, system)) if self.cache is not None else None
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                get_run_metrics().observe_llm_call(self.backend, 0.0, True, attempts=0, cached=True)
+                return LLMResult(cached, time.monotonic() - start, 0, None, True)
+
+        attempts = 0
+        tried = set()
+        for attempt in range(1, self.max_retries + 2):
+            self.limiter.acquire()
+            backend = self._acquire(tried)
+            if backend is None:
+                print('LLM Server Error: every backend is out of service')
+                break
+            result = None
+            try:
+                result = getattr(backend.client, method)(prompt, system)
+            except Exception as e:
+                # A failed attempt of this backend, the request moves on to the next one
+                print('LLM Server Error on {}: {}'.format(backend.client.backend, e))
+                get_run_metrics().observe_llm_call(backend.client.backend, 0.0, False, attempts=1)
+                result = LLMResult(None, 0.0, 1, None, False)
+            finally:
+                self._release(backend, result is not None and result.content is not None)
+            attempts += result.attempts
+            if result.content is not None:
+                if self.cache is not None and result.content:
+                    self.cache.set(cache_key, result.content)
+                return LLMResult(result.content, time.monotonic() - start, attempts, result.usage, False)
+            tried.add(backend)
+            if len(tried) == len(self.backends) and attempt <= self.max_retries:
+                # Every backend failed once, back off before the next round
+                tried.clear()
+                time.sleep(backend.client._backoff(attempt))
+        return LLMResult(None, time.monotonic() - start, attempts, None, False)
+
+    def close(self):
+        for backend in self.backends:
+            backend.client.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+CLIENT_CONFIG_FIELDS = (
+    'model', 'base_url', 'api_key', 'llm_timeout', 'llm_max_retries', 'llm_backoff_seconds', 'llm_max_backoff_seconds',
+    'llm_max_concurrency', 'llm_requests_per_minute', 'llm_cache_enabled', 'llm_cache_file',
+    'llm_classify_streaming', 'llm_classify_max_tokens', 'llm_classify_logprobs',
+    'llm_backends', 'llm_circuit_failure_threshold', 'llm_circuit_open_seconds'
+)
+
+
+def get_llm_client(config: dict):
+    """
+    Get the shared LLMClient for the configuration (LLMPool if `llm_backends` is set), creating (and validating) it on first use
+    :param config: LLM Server configuration
+    :return: the LLMClient or LLMPool
+    """
+    key = tuple(str(config.get(field)) for field in CLIENT_CONFIG_FIELDS)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = LLMPool(config) if config.get('llm_backends') else LLMClient(config)
+        return client
+
+
+def get_llm_response(prompt: str, config: dict, system=None):
     """
     Get LLM response
     :param prompt: user prompt
     :param config: LLM Server configuration, fields include `model`, `base_url`, `api_key` etc.
+    :param system: system prompt (if any)
     :return: the response content or None if failed
     """
-    llm_server_config = validate_llm_server_config(config)
-    model = llm_server_config['model']
-    base_url = llm_server_config['base_url']
-    api_key = llm_server_config['api_key']
+    return get_llm_client(config).complete(prompt, system).content
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
 
-    data = {
-        'model': model,
-        'messages': [
-            {
-                'role': 'user',
-                'content': prompt
-            }
-        ],
-        'stream': False
-    }
+def get_llm_verdict(prompt: str, config: dict, system=None):
+    """
+    Get the Yes/No verdict of LLM, streaming the response and stopping as soon as the verdict is known
+    :param prompt: user prompt, asking for a Yes/No answer
+    :param config: LLM Server configuration, fields include `llm_classify_streaming`, `llm_classify_max_tokens` etc.
+    :param system: system prompt (if any)
+    :return: 'Yes', 'No' or None if failed
+    """
+    return get_llm_client(config).classify(prompt, system).content
 
-    try:
-        response = requests.post(
-            base_url,
-            headers=headers,
-            data=json.dumps(data),
-            timeout=30
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        return result['choices'][0]['message']['content'].strip()
-    except Exception as e:
-        print('LLM Server Error: {}'.format(e))
-        return None
+
+TOKEN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[A-Za-z]{1,4}|\d{1,3}|[^\sA-Za-z\d]')
+
+
+def truncate_to_tokens(text: str, max_tokens: int):
+    """
+    Cut a text to about `max_tokens` tokens of a BPE tokenizer, at a word boundary
+    Tokens are estimated without a tokenizer: one per CJK character, per 4 letters, per 3 digits or per punctuation mark.
+    :param text: the text
+    :param max_tokens: the budget (0 or None for no limit)
+    :return: (the text, followed by '...' if cut, whether it was cut)
+    """
+    if not max_tokens or len(text) <= max_tokens:
+        return text, False
+    for count, match in enumerate(TOKEN_PATTERN.finditer(text)):
+        if count == max_tokens:
+            cut = text[:match.start()]
+            if re.match(r'[A-Za-z\d]', match.group()) and re.search(r'[A-Za-z\d]$', cut):
+                # Do not leave half a word
+                cut = cut[:len(cut) - len(re.search(r'[A-Za-z\d]*$', cut).group())]
+            return cut.rstrip() + '...', True
+    return text, False
+
+
+def get_llm_concurrency(config: dict):
+    """
+    Get the concurrency settings of LLM Server
+    :param config: the configuration of LLM Server
+    :return: (max_concurrency, requests_per_minute)
+    """
+    max_concurrency = int(config.get('llm_max_concurrency') or 1)
+    if config.get('llm_backends'):
+        # Enough requests in flight to fill every backend of the pool
+        max_concurrency = sum(int(backend.get('max_concurrency') or max_concurrency) for backend in config['llm_backends'])
+    requests_per_minute = int(config.get('llm_requests_per_minute') or 0)
+    return max(max_concurrency, 1), max(requests_per_minute, 0)
+
+
+def map_concurrently(func, items, max_concurrency=1, requests_per_minute=0):
+    """
+    Apply `func` to every item with a bounded thread pool, keeping the input order
+    :param func: the function to apply
+    :param items: the items to process
+    :param max_concurrency: the maximum number of calls in flight
+    :param requests_per_minute: the maximum number of calls started per minute (0 for unlimited)
+    :return: a list of results in the same order as `items`
+    """
+    limiter = RateLimiter(requests_per_minute)
+
+    def call(item):
+        limiter.acquire()
+        return func(item)
+
+    items = list(items)
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(items))) as executor:
+        return list(executor.map(call, items))
 
 
 if __name__ == '__main__':